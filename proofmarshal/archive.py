@@ -0,0 +1,289 @@
+# Copyright (C) 2015 Peter Todd <pete@petertodd.org>
+#
+# This file is part of python-proofmarshal.
+#
+# It is subject to the license terms in the LICENSE file found in the top-level
+# directory of this distribution.
+#
+# No part of python-proofmarshal, including this file, may be copied, modified,
+# propagated, or distributed except according to the terms contained in the
+# LICENSE file.
+
+import bisect
+import mmap
+import os
+
+from proofmarshal.lazy import lazy_deserialize
+from proofmarshal.serialize import BytesSerializationContext, BytesDeserializationContext, \
+                                   DeserializationError, DIGEST_LENGTH
+
+"""Indexed archives of proofs
+
+An archive is a single file holding any number of serialized proofs of one
+class, with an index allowing them to be looked up by hash.
+
+File format
+===========
+
+    MAGIC
+    record*
+    index_entry*
+    index_offset count digest_length MAGIC
+
+Each record is a proof serialized as by Serializer.serialize_many(): a varuint
+length followed by the serialized proof. Index entries are the proof hash
+followed by the offset of its record, as an 8-byte big-endian integer, sorted
+by hash. index_offset is the offset of the first index entry and count the
+number of entries, both 8-byte big-endian integers. digest_length is the
+length of the hashes, a single byte, as it depends on the hash function used by
+the proofs.
+
+Appending to an archive truncates the index and footer, appends the new
+records, and then writes a new index and footer after them.
+"""
+
+MAGIC = b'\x00pmarch\x00'
+
+OFFSET_LENGTH = 8
+FOOTER_LENGTH = OFFSET_LENGTH + OFFSET_LENGTH + 1 + len(MAGIC)
+
+def _read_footer(buf):
+    """Return (index_offset, count, digest_length) from the footer of an archive"""
+    if len(buf) < len(MAGIC) + FOOTER_LENGTH or \
+            buf[0:len(MAGIC)] != MAGIC or buf[-len(MAGIC):] != MAGIC:
+        raise DeserializationError('Not a proof archive')
+
+    footer = len(buf) - FOOTER_LENGTH
+    index_offset = int.from_bytes(buf[footer:footer + OFFSET_LENGTH], 'big')
+    count = int.from_bytes(buf[footer + OFFSET_LENGTH:footer + 2*OFFSET_LENGTH], 'big')
+    digest_length = buf[footer + 2*OFFSET_LENGTH]
+    if index_offset < len(MAGIC) or \
+            index_offset + count*(digest_length + OFFSET_LENGTH) != footer:
+        raise DeserializationError('Corrupt proof archive footer')
+
+    return index_offset, count, digest_length
+
+def _digest_length(proof_class):
+    """Return the length of the hashes of proof_class, or None if unknown"""
+    try:
+        hashtag_class = proof_class._hashtag_class()
+    except AttributeError:
+        # e.g. ProofUnion, whose classes may differ
+        return None
+    return hashtag_class.DIGEST_LENGTH
+
+class _IndexHashes:
+    """Sequence of the hashes in an archive index, for bisect"""
+    def __init__(self, buf, index_offset, count, digest_length):
+        self.buf = buf
+        self.index_offset = index_offset
+        self.count = count
+        self.digest_length = digest_length
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        start = self.index_offset + i*(self.digest_length + OFFSET_LENGTH)
+        return bytes(self.buf[start:start + self.digest_length])
+
+class ProofArchive:
+    """Read-only access to a proof archive
+
+    The file is mmapped, and proofs are deserialized directly from the map.
+    """
+
+    def __init__(self, path, proof_class):
+        self.proof_class = proof_class
+
+        with open(path, 'rb') as fd:
+            self.mmap = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+        self.buf = memoryview(self.mmap)
+
+        try:
+            self.index_offset, self.count, self.digest_length = _read_footer(self.buf)
+        except:
+            self.close()
+            raise
+
+        self.hashes = _IndexHashes(self.buf, self.index_offset, self.count, self.digest_length)
+
+    def close(self):
+        """Close the archive
+
+        Lazily deserialized proofs, and unfinished iterations over the archive,
+        use the map directly, so they must be dropped first. If any are still
+        in use BufferError is raised, and the archive is left open.
+        """
+        if self.mmap.closed:
+            return
+
+        self.buf.release()
+        try:
+            self.mmap.close()
+        except BufferError:
+            self.buf = memoryview(self.mmap)
+            self.hashes.buf = self.buf
+            raise BufferError("Can't close archive; lazily deserialized proofs or iterators still in use")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            self.close()
+        except BufferError:
+            # The traceback of an exception may be what's using the map;
+            # don't hide the exception.
+            if exc_type is None:
+                raise
+
+    def __len__(self):
+        return self.count
+
+    def _find(self, proof_hash):
+        """Return the offset of the record for proof_hash"""
+        i = bisect.bisect_left(self.hashes, proof_hash)
+        if i < self.count and self.hashes[i] == proof_hash:
+            start = self.index_offset + i*(self.digest_length + OFFSET_LENGTH) + self.digest_length
+            offset = int.from_bytes(self.buf[start:start + OFFSET_LENGTH], 'big')
+            if not (len(MAGIC) <= offset < self.index_offset):
+                raise DeserializationError('Corrupt proof archive index; record offset %d out of range' % offset)
+            return offset
+
+        raise KeyError(proof_hash)
+
+    def __contains__(self, proof_hash):
+        try:
+            self._find(proof_hash)
+        except KeyError:
+            return False
+        return True
+
+    def get(self, proof_hash, lazy=False):
+        """Return the proof with the specified hash
+
+        If lazy is true, the proof is deserialized lazily; see
+        proofmarshal.lazy. Raises KeyError if the proof is not in the archive.
+        """
+        ctx = BytesDeserializationContext(self.buf[:self.index_offset], self._find(proof_hash))
+        length = ctx.read_varuint()
+
+        if lazy:
+            return lazy_deserialize(self.proof_class, self.buf[ctx.offset:ctx.offset + length])
+
+        else:
+            start = ctx.offset
+            r = self.proof_class.ctx_deserialize(ctx)
+            if ctx.offset - start != length:
+                raise DeserializationError('Record length was %d bytes; deserialized %d bytes' % \
+                                               (length, ctx.offset - start))
+            return r
+
+    def __getitem__(self, proof_hash):
+        return self.get(proof_hash)
+
+    def __iter__(self):
+        """Iterate through the proofs in the order they were added"""
+        ctx = BytesDeserializationContext(self.buf[:self.index_offset], len(MAGIC))
+        yield from self.proof_class.ctx_deserialize_many(ctx)
+
+    def keys(self):
+        """Iterate through the proof hashes in sorted order"""
+        for i in range(self.count):
+            yield self.hashes[i]
+
+class ProofArchiveWriter:
+    """Create, or append to, a proof archive
+
+    Proofs already in the archive are skipped. The index isn't written until
+    close() is called; until then the archive can't be read.
+
+    When appending to an existing archive, the new records overwrite the old
+    index, so if the writer isn't closed after the first proof is appended,
+    e.g. due to a crash, the archive is left unreadable. Keep a copy if that
+    matters.
+    """
+
+    def __init__(self, path, proof_class):
+        self.proof_class = proof_class
+        self.index = {}
+        self.digest_length = None
+
+        if os.path.exists(path) and os.path.getsize(path):
+            with ProofArchive(path, proof_class) as archive:
+                if archive.count:
+                    expected = _digest_length(proof_class)
+                    if expected is not None and archive.digest_length != expected:
+                        raise ValueError('Archive has %d byte hashes; %r has %d byte hashes' % \
+                                             (archive.digest_length, proof_class, expected))
+                    self.digest_length = archive.digest_length
+
+                for proof_hash in archive.keys():
+                    self.index[proof_hash] = archive._find(proof_hash)
+                index_offset = archive.index_offset
+
+            # The existing index is left in place until something is appended.
+            self.fd = open(path, 'r+b')
+            self.fd.seek(index_offset)
+            self.modified = False
+
+        else:
+            self.fd = open(path, 'wb')
+            self.fd.write(MAGIC)
+            self.modified = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def append(self, proof):
+        """Append a proof to the archive
+
+        Returns the hash of the proof.
+        """
+        proof_hash = proof.hash
+        if self.digest_length is None:
+            self.digest_length = len(proof_hash)
+        elif len(proof_hash) != self.digest_length:
+            raise ValueError('Expected %d byte hash; got %d bytes' % (self.digest_length, len(proof_hash)))
+
+        if proof_hash not in self.index:
+            if not self.modified:
+                self.fd.truncate(self.fd.tell())
+                self.modified = True
+
+            self.index[proof_hash] = self.fd.tell()
+
+            ctx = BytesSerializationContext()
+            self.proof_class.ctx_serialize_many((proof,), ctx)
+            with ctx.getbuffer() as buf:
+                self.fd.write(buf)
+
+        return proof_hash
+
+    def extend(self, proofs):
+        for proof in proofs:
+            self.append(proof)
+
+    def close(self):
+        """Write the index and close the archive"""
+        if self.fd.closed:
+            return
+
+        if not self.modified:
+            self.fd.close()
+            return
+
+        index_offset = self.fd.tell()
+        for proof_hash in sorted(self.index):
+            self.fd.write(proof_hash + self.index[proof_hash].to_bytes(OFFSET_LENGTH, 'big'))
+
+        digest_length = DIGEST_LENGTH if self.digest_length is None else self.digest_length
+        self.fd.write(index_offset.to_bytes(OFFSET_LENGTH, 'big') +
+                      len(self.index).to_bytes(OFFSET_LENGTH, 'big') +
+                      bytes([digest_length]) +
+                      MAGIC)
+        self.fd.close()
@@ -14,13 +14,25 @@ import hashlib
 import hmac
 import operator
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 import proofmarshal.serialize
 
 @functools.total_ordering
 class Bits:
-    """Immutable array of bits"""
+    """Immutable array of bits
+
+    Bits are stored in a buffer, most significant bit first, starting at a
+    bit offset into that buffer. Slices share the buffer of the bits they're
+    sliced from. For operations such as concatenation and finding common
+    prefixes the bits are also viewed as an unsigned integer, again most
+    significant bit first; that view is created on demand and cached.
+    """
 
-    __slots__ = ['__length', '__buf']
+    __slots__ = ['__length', '__offset', '__buf', '__int']
 
     def __new__(cls, iterable=None):
         """Construct immutable array of bits from an iterable"""
@@ -30,6 +42,7 @@ class Bits:
             except AttributeError:
                 self = object().__new__(cls)
                 self.__length = 0
+                self.__offset = 0
                 self.__buf = b''
                 cls.__empty_Bits_singleton = self
                 return self
@@ -54,6 +67,7 @@ class Bits:
             if length:
                 self = object().__new__(cls)
                 self.__length = length
+                self.__offset = 0
                 self.__buf = bytes(buf)
                 return self
 
@@ -88,28 +102,109 @@ class Bits:
 
         self = object().__new__(cls)
         self.__length = length
+        self.__offset = 0
         self.__buf = buf if length else b''
         return self
 
+    @classmethod
+    def from_buffer(cls, buf, length=None, offset=0):
+        """Create bits from any object supporting the buffer protocol
+
+        offset - Offset of the first bit, in bits
+        length - Length in bits (if not all bits in buf after offset)
+
+        As with from_bytes() the buffer is used in place, so bits can be
+        created from memoryview or mmap objects without copying. The buffer
+        must not be modified while the bits are in use.
+        """
+        if buf.__class__ is not bytes:
+            buf = memoryview(buf).cast('B')
+
+        if offset.__class__ is not int:
+            raise TypeError('Expected int offset; got %s' % offset.__class__.__qualname__)
+        if not (0 <= offset <= len(buf)*8):
+            raise ValueError('Offset out of range')
+
+        if length is None:
+            length = len(buf)*8 - offset
+
+        if length.__class__ is not int:
+            raise TypeError('Expected int length; got %s' % length.__class__.__qualname__)
+        if length < 0:
+            raise ValueError('Length must be non-negative int')
+        if len(buf) * 8 < offset + length:
+            raise ValueError('Length longer than bits in buf')
+
+        if not length:
+            return Bits()
+
+        self = object().__new__(cls)
+        self.__length = length
+        self.__offset = offset
+        self.__buf = buf
+        return self
+
+    @classmethod
+    def __from_int(cls, value, length):
+        """Create bits from the integer view"""
+        if not length:
+            return Bits()
+
+        nbytes = (length + 7) // 8
+        self = object().__new__(cls)
+        self.__length = length
+        self.__offset = 0
+        self.__buf = (value << (nbytes*8 - length)).to_bytes(nbytes, 'big')
+        self.__int = value
+        return self
+
+    def __as_int(self):
+        """Return the bits as an unsigned integer, most significant bit first"""
+        try:
+            return self.__int
+        except AttributeError:
+            start = self.__offset // 8
+            end = (self.__offset + self.__length + 7) // 8
+            value = int.from_bytes(self.__buf[start:end], 'big') >> (end*8 - self.__offset - self.__length)
+            self.__int = value & ((1 << self.__length) - 1)
+            return self.__int
+
     def __iter__(self):
-        for i in range(self.__length):
-            yield (self.__buf[i // 8] >> (7 - i % 8)) & 0b1
+        buf = self.__buf
+        for i in range(self.__offset, self.__offset + self.__length):
+            yield (buf[i // 8] >> (7 - i % 8)) & 0b1
 
     def __len__(self):
         return self.__length
 
     def __full_width_prefix(self):
-        """Return the part of the buf with full-width bytes"""
-        return self.__buf[0:self.__length // 8]
+        """Return the full-width bytes
+
+        Byte-aligned bits return the buffer, or a memoryview of it, rather
+        than a copy.
+        """
+        if self.__offset % 8:
+            # Not byte-aligned, so the bytes have to be shifted into place.
+            return (self.__as_int() >> (self.__length % 8)).to_bytes(self.__length // 8, 'big')
+
+        else:
+            start = self.__offset // 8
+            end = start + self.__length // 8
+            if not start and end == len(self.__buf):
+                return self.__buf
+            return memoryview(self.__buf)[start:end]
 
     def __tail_bits(self):
         """Return the non-full-width tail, with unused bits masked to zero"""
         odd_bits = self.__length % 8
-        if odd_bits:
-            return self.__buf[self.__length // 8] & (0xFF << (8 - odd_bits))
+        if not odd_bits:
+            return 0
+
+        elif self.__offset % 8:
+            return (self.__as_int() << (8 - odd_bits)) & 0xFF
 
         else:
-            return 0
+            return self.__buf[(self.__offset + self.__length) // 8] & (0xFF << (8 - odd_bits)) & 0xFF
 
     def __eq__(self, rhs):
         if self.__class__ is not rhs.__class__:
@@ -129,8 +224,9 @@ class Bits:
         if self.__class__ is not rhs.__class__:
             return NotImplemented
 
-        self_fwp = self.__full_width_prefix()
-        rhs_fwp = rhs.__full_width_prefix()
+        # Views don't support ordering
+        self_fwp = bytes(self.__full_width_prefix())
+        rhs_fwp = bytes(rhs.__full_width_prefix())
         if self_fwp < rhs_fwp:
             return True
 
@@ -149,23 +245,31 @@ class Bits:
             if not (0 <= idx < self.__length):
                 raise IndexError('Bits index out of range')
 
+            idx += self.__offset
             return (self.__buf[idx // 8] >> (7 - idx % 8)) & 0b1
 
         elif isinstance(idx, slice):
             start, stop, step = idx.indices(self.__length)
 
-            # We can reuse self.__buf if the slice starts at index zero and has a standard step
-            if step == 1 and start == 0:
-                if stop == 0:
+            # Slices with a standard step are views of self.__buf
+            if step == 1:
+                if stop <= start:
                     return self.__class__()
 
-                elif stop == self.__length:
+                elif start == 0 and stop == self.__length:
                     return self
 
                 else:
                     r = super().__new__(self.__class__)
-                    r.__length = stop
+                    r.__length = stop - start
+                    r.__offset = self.__offset + start
                     r.__buf = self.__buf
+
+                    try:
+                        r.__int = (self.__int >> (self.__length - stop)) & ((1 << r.__length) - 1)
+                    except AttributeError:
+                        pass
+
                     return r
 
             else:
@@ -187,35 +291,8 @@ class Bits:
             return self
 
         else:
-            # Do we need to shift the bits of the right-hand-side before we concatenate it to our buffer?
-            rhs_offset = self.__length % 8
-            rhs_buf = rhs.__buf
-            if rhs_offset:
-                # Because we have an offset subsequent bytes need to be
-                # "merged" together in pairs.
-                rhs_buf = []
-
-                # Init the tail bits from the tail of the lhs
-                tail_bits = self.__buf[self.__length // 8] & (0xFF << (8 - self.__length % 8))
-
-                # For every byte in the RHS
-                for byte in rhs.__buf[0:rhs.__length // 8 + (1 if rhs.__length % 8 else 0)]:
-                    # For every byte on the rhs, shift it's MSB's right by the
-                    # offset, and or it with the tail bits.
-                    rhs_buf.append(tail_bits | (byte >> rhs_offset))
-
-                    # Then save LSB's as the new tail bits, shifted to the
-                    # left the amount of the offset
-                    tail_bits = (byte << (8 - rhs_offset)) & 0xFF
-
-                # Last tail bits get saved
-                rhs_buf.append(tail_bits)
-                rhs_buf = bytes(rhs_buf)
-
-            r = super().__new__(self.__class__)
-            r.__length = self.__length + rhs.__length
-            r.__buf = self.__buf[0:self.__length // 8] + rhs_buf
-            return r
+            return self.__from_int((self.__as_int() << rhs.__length) | rhs.__as_int(),
+                                   self.__length + rhs.__length)
 
     def __invert__(self):
         # Technically we should check types of self, but... yeah.
@@ -224,10 +301,7 @@ class Bits:
             return self
 
         else:
-            # Can just blindly invert all bytes, as we don't care about what the
-            # unused tail bits end up as.
-            inverted_buf = bytes([~byte & 0xff for byte in self.__buf[:self.__length // 8 + 1]])
-            return Bits.from_bytes(inverted_buf, self.__length)
+            return self.__from_int(~self.__as_int() & ((1 << self.__length) - 1), self.__length)
 
     def startswith(self, prefix):
         """Return true if self starts with prefix"""
@@ -235,14 +309,11 @@ class Bits:
             raise TypeError("Can't compute whether <%s>.startswith(<%s>)" % \
                             (self.__class__.__qualname__, prefix.__class__.__qualname__))
 
-        if len(prefix) > len(self):
+        if prefix.__length > self.__length:
             return False
 
-        elif len(prefix) == len(self):
-            return prefix == self
-
         else:
-            return self[:len(prefix)] == prefix
+            return self.__as_int() >> (self.__length - prefix.__length) == prefix.__as_int()
 
     def common_prefix(self, rhs):
         """Return the common prefix"""
@@ -253,44 +324,19 @@ class Bits:
         # Arrange so shorter is the "left-hand-side" and longer is the "right-hand-side"
         lhs, rhs = (self, rhs) if self.__length <= rhs.__length else (rhs, self)
 
-        common_prefix_length = (lhs.__length // 8)*8
-        fwb_eq = False
-        for i in range(lhs.__length // 8):
-            if lhs.__buf[i] != rhs.__buf[i]:
-                # Difference found in full-width bytes
-                common_prefix_length = i * 8
-                break
-
-        else:
-            # No full-width differences found.
-            fwb_eq = True
-
-        # Check remaining bits
-        if common_prefix_length < lhs.__length:
-            # XOR
-            diff_bits = lhs.__buf[common_prefix_length // 8] ^ rhs.__buf[common_prefix_length // 8]
-
-            # and shift left until either the common_prefix_length is the same
-            # length as the lhs, or we find a difference
-            while common_prefix_length < lhs.__length and not diff_bits & 0x80:
-                diff_bits = (diff_bits << 1) & 0xFF
-                common_prefix_length += 1
-
-        assert common_prefix_length <= lhs.__length
+        # The leading bits of the rhs, xored with the lhs, are zero up until
+        # the first difference.
+        diff = lhs.__as_int() ^ (rhs.__as_int() >> (rhs.__length - lhs.__length))
+        common_prefix_length = lhs.__length - diff.bit_length()
 
         # If the common prefix is the same length as the lhs length, then we
         # can just return the lhs directly
         if common_prefix_length == lhs.__length:
-            assert fwb_eq
             return lhs
 
-        # Otherwise, return a new Bits using the lhs's buffer with the common
-        # prefix length
+        # Otherwise, return a view of the lhs with the common prefix length
         else:
-            return Bits.from_bytes(lhs.__buf, common_prefix_length)
-
-
-
+            return lhs[:common_prefix_length]
 
 class BitsSerializer(proofmarshal.serialize.Serializer):
     @classmethod
@@ -305,13 +351,98 @@ class BitsSerializer(proofmarshal.serialize.Serializer):
         if value._Bits__length % 8:
             ctx.write_bytes(bytes([value._Bits__tail_bits()]))
 
+    @classmethod
+    def serialized_size(cls, value):
+        length = value._Bits__length
+        return proofmarshal.serialize.varuint_size(length) + (length + 7) // 8
+
     @classmethod
     def ctx_deserialize(cls, ctx):
         """Deserialize from a context"""
         length = ctx.read_varuint()
         buf = ctx.read_bytes(length // 8 + (1 if length % 8 else 0))
         r = Bits.from_bytes(buf, length)
-        # FIXME: should throw a serialization exception
-        assert r._Bits__tail_bits() == buf[-1]
+        if length % 8 and r._Bits__tail_bits() != buf[-1]:
+            raise proofmarshal.serialize.DeserializationError('Unused tail bits must be zero')
         return r
 
+# Below this many keys the per-call overhead of numpy outweighs the gain.
+NUMPY_MIN_KEYS = 64
+
+def _key_array(keys, width):
+    """Return the keys as a sequence of bytes, and their width"""
+    if width is not None:
+        with memoryview(keys).cast('B') as buf:
+            if len(buf) % width:
+                raise ValueError('Buffer length %d not a multiple of key width %d' % (len(buf), width))
+            return [buf[i:i + width].tobytes() for i in range(0, len(buf), width)], width
+
+    else:
+        keys = list(keys)
+        width = len(keys[0]) if keys else 0
+        for key in keys:
+            if len(key) != width:
+                raise ValueError('Keys must all be the same length; got %d and %d bytes' % (width, len(key)))
+        return keys, width
+
+if numpy is not None:
+    # Number of leading zero bits in each possible byte
+    _LEADING_ZEROS = numpy.array([8 - i.bit_length() for i in range(256)], dtype=numpy.intp)
+
+def _sort_keys_numpy(keys, width):
+    if width is not None:
+        a = numpy.frombuffer(keys, dtype=numpy.uint8)
+        if len(a) % width:
+            raise ValueError('Buffer length %d not a multiple of key width %d' % (len(a), width))
+    else:
+        keys, width = _key_array(keys, width)
+        a = numpy.frombuffer(b''.join(keys), dtype=numpy.uint8)
+
+    n = len(a) // width
+    a = a.reshape(n, width)
+
+    # Fixed-width byte strings sort in the same order as the bits they contain.
+    order = numpy.argsort(a.view('S%d' % width).ravel(), kind='stable')
+    a = a[order]
+
+    diff = a[1:] ^ a[:-1]
+    nonzero = diff != 0
+    first_diff = numpy.argmax(nonzero, axis=1)
+    first_diff_byte = diff[numpy.arange(n - 1), first_diff]
+    lengths = numpy.where(nonzero.any(axis=1),
+                          first_diff*8 + _LEADING_ZEROS[first_diff_byte],
+                          width*8)
+
+    sorted_buf = a.tobytes()
+    sorted_keys = [sorted_buf[i:i + width] for i in range(0, len(sorted_buf), width)]
+    return sorted_keys, lengths.tolist()
+
+def sort_keys(keys, width=None):
+    """Sort fixed-width keys into prefix order
+
+    keys is either an iterable of bytes-like keys, all of the same length, or if
+    width is given, a single buffer of concatenated width-byte keys.
+
+    Returns (sorted_keys, common_prefix_lengths), where sorted_keys is a list
+    of bytes and common_prefix_lengths[i] is the length in bits of the common
+    prefix of sorted_keys[i] and sorted_keys[i+1]. Equal keys have a common
+    prefix of their full length. Large numbers of keys are processed with
+    numpy, if available.
+    """
+    if width is not None and width <= 0:
+        raise ValueError('Key width must be positive; got %d' % width)
+
+    if width is None:
+        keys = list(keys)
+
+    if numpy is not None:
+        n = memoryview(keys).nbytes // width if width is not None else len(keys)
+        if n >= NUMPY_MIN_KEYS:
+            return _sort_keys_numpy(keys, width)
+
+    keys, width = _key_array(keys, width)
+    sorted_keys = sorted(bytes(key) for key in keys)
+
+    values = [int.from_bytes(key, 'big') for key in sorted_keys]
+    common_prefix_lengths = [width*8 - (a ^ b).bit_length() for a, b in zip(values, values[1:])]
+    return sorted_keys, common_prefix_lengths
@@ -0,0 +1,191 @@
+# Copyright (C) 2015 Peter Todd <pete@petertodd.org>
+#
+# This file is part of python-proofmarshal.
+#
+# It is subject to the license terms in the LICENSE file found in the top-level
+# directory of this distribution.
+#
+# No part of python-proofmarshal, including this file, may be copied, modified,
+# propagated, or distributed except according to the terms contained in the
+# LICENSE file.
+
+import collections
+import heapq
+import itertools
+import weakref
+
+"""Bounded caches of proof nodes
+
+A NodeCache keeps recently loaded proof nodes, keyed by hash, so loading the
+same node again returns the existing instance rather than reading it again.
+The cache holds on to no more than a given number of bytes worth of nodes,
+evicting nodes according to a policy when full.
+
+Nodes loaded from a store hold on to their children, so a tree someone holds
+on to would keep every node ever loaded from it. Such nodes are added with an
+unload function; when evicted they're unloaded back into stubs, letting go of
+their children, and are loaded again if used again.
+
+Evicted nodes that are still in use elsewhere can't be freed anyway. They're
+kept track of weakly, so they can still be found in the cache until they are
+no longer in use. They're unloaded all the same, as there's no telling
+whether they're only in use by their parents; being loaded again when used
+is transparent.
+"""
+
+class CachePolicy:
+    """Base class for cache eviction policies"""
+
+    def add(self, key, size):
+        """Add a new key, of size bytes"""
+        raise NotImplementedError
+
+    def touch(self, key):
+        """Record a use of a key"""
+        raise NotImplementedError
+
+    def pop_victim(self):
+        """Remove and return the key to evict next"""
+        raise NotImplementedError
+
+class LRUPolicy(CachePolicy):
+    """Evict the least recently used node"""
+
+    def __init__(self):
+        self.keys = collections.OrderedDict()
+
+    def add(self, key, size):
+        self.keys[key] = None
+
+    def touch(self, key):
+        self.keys.move_to_end(key)
+
+    def pop_victim(self):
+        return self.keys.popitem(last=False)[0]
+
+class GreedyDualSizePolicy(CachePolicy):
+    """Evict by GreedyDual-Size
+
+    Every node has a priority of the inflation value plus cost/size, set
+    when it's added and again whenever it's used. The node with the lowest
+    priority is evicted, and the inflation value is raised to its priority,
+    so nodes that haven't been used recently are eventually evicted
+    regardless of size. With the default cost of one, large nodes are evicted
+    before small ones used as recently.
+    """
+
+    def __init__(self, cost=1.0):
+        self.cost = cost
+        self.inflation = 0.0
+        self.sizes = {}
+        self.priorities = {}
+        self.heap = []
+        self.counter = itertools.count()
+
+    def __set_priority(self, key):
+        entry = (self.inflation + self.cost / max(self.sizes[key], 1), next(self.counter), key)
+        self.priorities[key] = entry
+
+        # Old heap entries are skipped when popped, and dropped when they
+        # outnumber the current ones.
+        heapq.heappush(self.heap, entry)
+        if len(self.heap) > 2 * len(self.priorities):
+            self.heap = list(self.priorities.values())
+            heapq.heapify(self.heap)
+
+    def add(self, key, size):
+        self.sizes[key] = size
+        self.__set_priority(key)
+
+    def touch(self, key):
+        self.__set_priority(key)
+
+    def pop_victim(self):
+        while True:
+            entry = heapq.heappop(self.heap)
+            priority, n, key = entry
+            if self.priorities.get(key) == entry:
+                del self.priorities[key]
+                del self.sizes[key]
+                self.inflation = priority
+                return key
+
+class NodeCache:
+    """Cache of proof nodes, bounded by size
+
+    max_bytes - Total size of the nodes to keep
+    policy    - Eviction policy; LRUPolicy if not specified
+
+    The sizes of the nodes are given by the loader adding them, usually their
+    serialized sizes.
+    """
+
+    def __init__(self, max_bytes, policy=None):
+        self.max_bytes = max_bytes
+        self.policy = policy if policy is not None else LRUPolicy()
+
+        self.entries = {}
+        self.in_use = weakref.WeakValueDictionary()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.resident_bytes = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, proof_hash):
+        return proof_hash in self.entries or proof_hash in self.in_use
+
+    def get(self, proof_hash):
+        """Return the node with the specified hash, or None if not cached"""
+        try:
+            node, size, unload = self.entries[proof_hash]
+        except KeyError:
+            node = self.in_use.get(proof_hash)
+            if node is None:
+                self.misses += 1
+                return None
+
+        else:
+            self.policy.touch(proof_hash)
+
+        self.hits += 1
+        return node
+
+    def touch(self, proof_hash):
+        """Record a use of a node, if cached, without looking it up"""
+        if proof_hash in self.entries:
+            self.policy.touch(proof_hash)
+
+    def add(self, node, size, unload=None):
+        """Add a node to the cache
+
+        Nodes are evicted as required to stay within max_bytes, possibly
+        including the node itself if it's larger than that. If given, unload
+        is called with the node when it's evicted.
+        """
+        proof_hash = node.hash
+        if proof_hash in self.entries:
+            return
+
+        self.entries[proof_hash] = (node, size, unload)
+        self.in_use[proof_hash] = node
+        self.policy.add(proof_hash, size)
+        self.resident_bytes += size
+
+        while self.resident_bytes > self.max_bytes:
+            victim = self.policy.pop_victim()
+            victim_node, victim_size, victim_unload = self.entries.pop(victim)
+            self.resident_bytes -= victim_size
+            self.evictions += 1
+
+            if victim_unload is not None:
+                victim_unload(victim_node)
+
+    @property
+    def hit_rate(self):
+        """Fraction of lookups that found the node"""
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
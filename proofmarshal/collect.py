@@ -0,0 +1,169 @@
+# Copyright (C) 2015 Peter Todd <pete@petertodd.org>
+#
+# This file is part of python-proofmarshal.
+#
+# It is subject to the license terms in the LICENSE file found in the top-level
+# directory of this distribution.
+#
+# No part of python-proofmarshal, including this file, may be copied, modified,
+# propagated, or distributed except according to the terms contained in the
+# LICENSE file.
+
+from proofmarshal.store import record_class, record_refs
+
+"""Garbage collection of proof stores
+
+Nodes in a proof store are never removed when committing, so old versions of
+proofs accumulate. Garbage collection removes every node that can't be
+reached from a given set of roots, by marking the reachable nodes and then
+sweeping away the rest.
+
+Both marking and sweeping are incremental, so collection can be interleaved
+with use of the store. Nodes added after collection starts are never swept,
+and proofs committed to the store during collection are added as roots, so
+committing new versions while collecting is safe. Proofs loaded from the store
+that aren't reachable from the roots must not be used after being swept.
+
+Only commits made through the store object being collected are seen by the
+collector. A commit can reuse existing nodes that aren't reachable from the
+roots, so commits made by other processes, or through other store objects
+for the same SQLite database, can lose nodes; there must be no other writers
+while collecting.
+
+Roots are given as (proof_class, hash) pairs, as the class is needed to find
+the children of a node.
+"""
+
+class GarbageCollector:
+    """Incremental mark-and-sweep garbage collector for a proof store
+
+    Commits through store while collecting are safe; there must be no other
+    writers to the store.
+    """
+
+    def __init__(self, store, roots=()):
+        if store.collector is not None:
+            raise ValueError('Store is already being collected')
+
+        self.store = store
+        self.watermark = store.watermark()
+        self.marked = set()
+        self.pending = []
+        self.sweep_position = 0
+        self.swept = 0
+
+        for proof_class, proof_hash in roots:
+            self.add_root(proof_class, proof_hash)
+
+        store.collector = self
+
+    def add_root(self, proof_class, proof_hash):
+        """Add a root to keep"""
+        if proof_hash not in self.marked:
+            self.pending.append((proof_class, proof_hash))
+
+    def mark(self, limit=None):
+        """Mark reachable nodes
+
+        Marks at most limit nodes, if given. Returns True if marking is
+        finished.
+        """
+        n = 0
+        while self.pending:
+            if limit is not None and n >= limit:
+                return False
+
+            proof_class, proof_hash = self.pending.pop()
+            if proof_hash in self.marked:
+                continue
+
+            record = self.store.get_record(proof_hash)
+            self.marked.add(proof_hash)
+            n += 1
+
+            # Subtrees already marked are skipped.
+            for ref in record_refs(record_class(proof_class, record), record):
+                if ref[1] not in self.marked:
+                    self.pending.append(ref)
+
+        return True
+
+    def sweep(self, limit=None):
+        """Delete unreachable nodes
+
+        Marking is finished first, if necessary. At most limit nodes are
+        examined, if given. Returns True if collection is finished.
+        """
+        self.mark()
+
+        rows = self.store._serials(self.sweep_position, self.watermark, limit)
+        garbage = [proof_hash for serial, proof_hash in rows if proof_hash not in self.marked]
+        self.store._delete(garbage)
+        self.swept += len(garbage)
+
+        if rows:
+            self.sweep_position = rows[-1][0]
+
+        if limit is None or len(rows) < limit:
+            self.close()
+            return True
+
+        else:
+            return False
+
+    def close(self):
+        """Stop collecting
+
+        Collection can't be resumed after this.
+        """
+        if self.store.collector is self:
+            self.store.collector = None
+
+def collect(store, roots):
+    """Remove every node not reachable from roots
+
+    There must be no other writers to the store while collecting. Returns the
+    number of nodes removed.
+    """
+    collector = GarbageCollector(store, roots)
+    try:
+        collector.sweep()
+    finally:
+        collector.close()
+    return collector.swept
+
+# Number of records written to the destination store at a time by compact()
+COMPACT_BATCH_SIZE = 10000
+
+def compact(store, roots, dest):
+    """Copy the nodes reachable from roots to another store
+
+    Nodes are copied in depth-first order, each subtree after the one before
+    it, so nodes visited together when descending a tree are stored together,
+    and nodes not reachable from roots are left behind. Children are copied
+    before their parents, as with commits, so if interrupted dest only lacks
+    the parts not yet copied. Returns the number of nodes copied.
+    """
+    stack = [(proof_class, proof_hash, None) for proof_class, proof_hash in reversed(list(roots))]
+    copied = set()
+    records = []
+    while stack:
+        proof_class, proof_hash, record = stack.pop()
+        if record is not None:
+            # Children done
+            records.append((proof_hash, record))
+            if len(records) >= COMPACT_BATCH_SIZE:
+                dest._put_records(records)
+                records = []
+            continue
+
+        if proof_hash in copied or proof_hash in dest:
+            continue
+        copied.add(proof_hash)
+
+        record = store.get_record(proof_hash)
+        stack.append((proof_class, proof_hash, record))
+        stack.extend((cls, h, None) for cls, h in reversed(record_refs(record_class(proof_class, record), record)))
+
+    dest._put_records(records)
+    return len(copied)
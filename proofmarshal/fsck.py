@@ -0,0 +1,175 @@
+# Copyright (C) 2015 Peter Todd <pete@petertodd.org>
+#
+# This file is part of python-proofmarshal.
+#
+# It is subject to the license terms in the LICENSE file found in the top-level
+# directory of this distribution.
+#
+# No part of python-proofmarshal, including this file, may be copied, modified,
+# propagated, or distributed except according to the terms contained in the
+# LICENSE file.
+
+import collections
+import concurrent.futures
+import os
+
+from proofmarshal.proof import VarProof
+from proofmarshal.serialize import DeserializationError
+from proofmarshal.store import decode_record, record_class, is_proof_serializer
+
+"""Integrity checking of proof stores
+
+Every node in a proof store is stored under its hash, with its children
+stored as references to their hashes. A node can therefore be checked on its
+own, by recomputing its hash from its record and comparing it to the hash it
+is stored under; checking every node reachable from a root checks the whole
+proof.
+
+The top of each proof is checked first, until there are enough nodes below it
+to share out among a pool of worker processes. The rest is checked level by
+level, each level shared out among the workers, which return the children of
+the nodes they checked. Subtrees are often shared, between proofs and within
+them, so the children are deduplicated before the next level is shared out,
+and every node is only checked once.
+
+Nodes are added to stores children first, and never modified afterwards. To
+check only what has changed since a previous check, the descent stops at nodes
+already in the store as of that check.
+"""
+
+# Subtrees per worker process to split the proofs into
+SPLIT_FACTOR = 4
+
+def _class_ref(cls):
+    """Return a picklable reference to a proof class
+
+    The variant classes of VarProof subclasses are often created dynamically,
+    and can't be pickled, so they're referred to by their family class and
+    variant index instead.
+    """
+    if issubclass(cls, VarProof) and cls.VARIANT_INDEX is not None:
+        for base in cls.__mro__[1:]:
+            if 'UNION_CLASSES' in base.__dict__ and cls in base.UNION_CLASSES:
+                return (base, cls.VARIANT_INDEX)
+
+    return (cls, None)
+
+def _from_class_ref(ref):
+    cls, i = ref
+    return cls if i is None else cls.UNION_CLASSES[i]
+
+def _check_node(store, proof_class, proof_hash, path, since, errors):
+    """Check a single node
+
+    Errors are appended to errors. Returns the (cls, hash, path) of the
+    children to check.
+    """
+    try:
+        if since and store._serial(proof_hash) <= since:
+            return []
+        record = store.get_record(proof_hash)
+    except KeyError:
+        errors.append((proof_hash, path, 'missing'))
+        return []
+
+    try:
+        cls = record_class(proof_class, record)
+        attrs = decode_record(cls, record)
+    except DeserializationError as exp:
+        errors.append((proof_hash, path, 'corrupt record: %s' % exp))
+        return []
+
+    node = object.__new__(cls)
+    children = []
+    for attr_name, value in attrs:
+        if is_proof_serializer(cls.SERIALIZED_ATTRS_BY_NAME[attr_name]):
+            children.append((value[0], value[1], path + (attr_name,)))
+            value = store._stub(*value)
+        object.__setattr__(node, attr_name, value)
+    object.__setattr__(node, 'is_fully_pruned', False)
+    object.__setattr__(node, 'is_pruned', False)
+    object.__setattr__(node, '_Proof__orig_instance', None)
+
+    if node.hash != proof_hash:
+        errors.append((proof_hash, path, 'hash mismatch'))
+
+    return children
+
+# Store being checked, in worker processes
+_worker_store = None
+
+def _init_worker(store):
+    """Initialize a worker process, unpickling the store only once"""
+    global _worker_store
+    _worker_store = store
+
+def _check_nodes(tasks, since):
+    """Check nodes in a worker process
+
+    Returns (errors, children), with the children as tasks.
+    """
+    store = _worker_store
+    errors = []
+    children = []
+    for ref, proof_hash, path in tasks:
+        for cls, child_hash, child_path in _check_node(store, _from_class_ref(ref), proof_hash, path,
+                                                       since, errors):
+            children.append((_class_ref(cls), child_hash, child_path))
+    return errors, children
+
+def fsck(store, roots, since=0, max_workers=None):
+    """Check the proofs reachable from roots
+
+    roots       - (proof_class, hash) pairs
+    since       - Checkpoint from a previous check; only nodes added since are
+                  checked
+    max_workers - Number of worker processes; with 1 everything is checked in
+                  this process. Otherwise the store is pickled once for each
+                  worker process.
+
+    Returns (errors, checkpoint). errors is a list of (hash, path, reason) for
+    each bad node, where path is the hash of the root the node was found
+    from, followed by the names of the attributes leading to the node.
+    checkpoint can be passed as since to a later check.
+    """
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+
+    checkpoint = store.watermark()
+    errors = []
+
+    # Check the top of the proofs breadth first, until there are enough
+    # subtrees to go around.
+    queue = collections.deque((proof_class, proof_hash, (proof_hash,)) for proof_class, proof_hash in roots)
+    seen = set()
+    while queue and (max_workers == 1 or len(queue) < max_workers * SPLIT_FACTOR):
+        proof_class, proof_hash, path = queue.popleft()
+        if proof_hash not in seen:
+            seen.add(proof_hash)
+            queue.extend(_check_node(store, proof_class, proof_hash, path, since, errors))
+
+    if not queue:
+        return errors, checkpoint
+
+    # Check the rest level by level
+    level = [(_class_ref(proof_class), proof_hash, path) for proof_class, proof_hash, path in queue]
+    with concurrent.futures.ProcessPoolExecutor(max_workers, initializer=_init_worker,
+                                                initargs=(store,)) as executor:
+        while level:
+            tasks = {}
+            for ref, proof_hash, path in level:
+                if proof_hash not in seen and proof_hash not in tasks:
+                    tasks[proof_hash] = (ref, proof_hash, path)
+            seen.update(tasks)
+            tasks = list(tasks.values())
+
+            chunks = [tasks[i::max_workers * SPLIT_FACTOR] for i in range(max_workers * SPLIT_FACTOR)]
+            futures = [executor.submit(_check_nodes, chunk, since) for chunk in chunks if chunk]
+
+            level = []
+            for future in futures:
+                chunk_errors, children = future.result()
+                errors.extend(chunk_errors)
+                level.extend(children)
+
+    return errors, checkpoint
@@ -0,0 +1,185 @@
+# Copyright (C) 2015 Peter Todd <pete@petertodd.org>
+#
+# This file is part of python-proofmarshal.
+#
+# It is subject to the license terms in the LICENSE file found in the top-level
+# directory of this distribution.
+#
+# No part of python-proofmarshal, including this file, may be copied, modified,
+# propagated, or distributed except according to the terms contained in the
+# LICENSE file.
+
+from proofmarshal.proof import Proof, VarProof, ProofUnion
+from proofmarshal.serialize import BytesDeserializationContext, DeserializationError
+
+"""Lazy deserialization of proofs
+
+Deserializing a proof normally creates every node in it. Lazily deserialized
+proofs instead only decode the top-level node; the attributes of each node are
+decoded from the serialized data when they're first accessed, using the same
+mechanism pruned proofs use to get attributes from their original instance.
+Only the nodes on the paths actually visited are ever created.
+
+Finding where an attribute starts requires skipping over the attributes
+before it, which in turn means scanning the subtrees of any proofs among
+them. Where every subtree scanned ends is recorded in an index shared by all
+the nodes of a proof, so no subtree is scanned twice. build_index() can be
+used to make a single pass over the data in advance instead.
+
+The serialized data is used in place, so it may be bytes, a memoryview, an
+mmap, etc.
+"""
+
+def _concrete_class(ser_cls, ctx):
+    """Read the header of a serialized proof
+
+    Returns (cls, is_fully_pruned), where cls is the class the proof will be
+    deserialized as. ctx is left at the start of the data hash or first
+    attribute respectively.
+    """
+    if issubclass(ser_cls, ProofUnion):
+        i = ctx.read_varuint()
+        try:
+            ser_cls = ser_cls.UNION_CLASSES[i]
+        except IndexError:
+            raise DeserializationError('bad union class number %d' % i)
+
+    if ctx.read_bool():
+        return ser_cls, True
+
+    elif issubclass(ser_cls, VarProof):
+        i = ctx.read_varuint()
+        try:
+            return ser_cls.UNION_CLASSES[i], False
+        except IndexError:
+            raise DeserializationError('bad union class number %d' % i)
+
+    else:
+        return ser_cls, False
+
+def _skip(ser_cls, ctx, index):
+    """Skip over a serialized value
+
+    Returns True if the value is, or contains, a pruned proof.
+    """
+    if not issubclass(ser_cls, (Proof, ProofUnion)):
+        ser_cls.ctx_deserialize(ctx)
+        return False
+
+    start = ctx.offset
+    if index is not None:
+        try:
+            ctx.offset, is_pruned = index[start]
+            return is_pruned
+        except KeyError:
+            pass
+
+    cls, is_pruned = _concrete_class(ser_cls, ctx)
+    if is_pruned:
+        ctx.read_bytes(cls._hashtag_class().DIGEST_LENGTH)
+
+    else:
+        for attr_name, attr_ser_cls in cls.SERIALIZED_ATTRS:
+            is_pruned |= _skip(attr_ser_cls, ctx, index)
+
+    if index is not None:
+        index[start] = (ctx.offset, is_pruned)
+    return is_pruned
+
+def build_index(proof_class, buf):
+    """Build an index of a serialized proof
+
+    Makes a single pass over the serialized data, returning a dict that
+    lazy_deserialize() can use to skip over proofs without scanning them.
+    """
+    index = {}
+    _skip(proof_class, BytesDeserializationContext(buf), index)
+    return index
+
+class LazyProofSource:
+    """Source of the attributes of a lazily deserialized proof"""
+    __slots__ = ['proof_class', 'buf', 'index', 'attr_offsets']
+
+    def __init__(self, proof_class, buf, offset, index):
+        self.proof_class = proof_class
+        self.buf = buf
+        self.index = index
+
+        # Offsets of the attributes found so far; the first attribute
+        # immediately follows the header.
+        self.attr_offsets = [offset]
+
+    def _attr_ctx(self, name):
+        """Return a context positioned at the start of attribute name"""
+        attrs = self.proof_class.SERIALIZED_ATTRS
+        for i, (attr_name, ser_cls) in enumerate(attrs):
+            if attr_name == name:
+                break
+        else:
+            raise AttributeError("%r object has no attribute %r" % (self.proof_class, name))
+
+        # Skip over the attributes before this one if we haven't already.
+        if len(self.attr_offsets) <= i:
+            ctx = BytesDeserializationContext(self.buf, self.attr_offsets[-1])
+            for attr_name, ser_cls in attrs[len(self.attr_offsets) - 1:i]:
+                _skip(ser_cls, ctx, self.index)
+                self.attr_offsets.append(ctx.offset)
+
+        return BytesDeserializationContext(self.buf, self.attr_offsets[i]), attrs[i][1]
+
+    def _source_attr(self, instance, name):
+        ctx, ser_cls = self._attr_ctx(name)
+        if issubclass(ser_cls, (Proof, ProofUnion)):
+            return _lazy_ctx_deserialize(ser_cls, ctx, self.index)
+        else:
+            return ser_cls.ctx_deserialize(ctx)
+
+    def _source_loaded(self, instance):
+        pass
+
+    def _source_data_hash(self, instance):
+        hasher = instance._hashtag_class().HASH_FUNCTION()
+        instance._hash_attrs(hasher)
+        return hasher.digest()
+
+    def _source_hash(self, instance):
+        return instance.HASHTAG.digest(instance.data_hash)
+
+    def _source_is_pruned(self, instance):
+        # Every attribute has to be skipped over, so find their offsets while
+        # we're at it.
+        ctx = BytesDeserializationContext(self.buf, self.attr_offsets[0])
+        is_pruned = False
+        for i, (attr_name, ser_cls) in enumerate(self.proof_class.SERIALIZED_ATTRS):
+            is_pruned |= _skip(ser_cls, ctx, self.index)
+            if len(self.attr_offsets) == i + 1:
+                self.attr_offsets.append(ctx.offset)
+        return is_pruned
+
+def _lazy_ctx_deserialize(ser_cls, ctx, index):
+    start = ctx.offset
+    cls, is_fully_pruned = _concrete_class(ser_cls, ctx)
+
+    if is_fully_pruned:
+        # Fully pruned proofs have nothing to be lazy about.
+        ctx.offset = start
+        return ser_cls.ctx_deserialize(ctx)
+
+    else:
+        self = object.__new__(cls)
+        object.__setattr__(self, 'is_fully_pruned', False)
+        object.__setattr__(self, '_Proof__orig_instance',
+                           LazyProofSource(cls, ctx.buf, ctx.offset, index))
+        return self
+
+def lazy_deserialize(proof_class, buf, index=None):
+    """Lazily deserialize a proof
+
+    buf may be any object supporting the buffer protocol. It must not be
+    modified while the proof, or anything derived from it, is in use.
+
+    If index is given it should be from build_index() on the same data.
+    """
+    if index is None:
+        index = {}
+    return _lazy_ctx_deserialize(proof_class, BytesDeserializationContext(buf), index)
@@ -14,6 +14,7 @@ import hmac
 import operator
 
 import proofmarshal.proof
+import proofmarshal.serialize
 
 from proofmarshal.bits import Bits, BitsSerializer
 
@@ -230,6 +231,103 @@ class MerbinnerTree(proofmarshal.proof.VarProof):
         else:
             return self._MerbinnerTree__issubset(other)
 
+    # Compact serialization
+    #
+    # The prefix of every inner node below the top of the tree starts with the
+    # prefix of its parent, followed by the bit selecting which side of the
+    # parent it's on. The compact format is the same as the standard format,
+    # except that inner nodes only serialize the remainder of their prefix.
+    # The full prefixes are reconstructed on deserialization, so hashes are
+    # unaffected.
+    #
+    # The hash of a node depends on its variant, which the standard format
+    # doesn't record for fully pruned nodes. The compact format records it as
+    # the variant index plus one, or zero if unknown, e.g. for fully pruned
+    # nodes deserialized from the standard format.
+
+    def _ctx_serialize_compact(self, ctx, known_prefix):
+        if self.is_fully_pruned:
+            ctx.write_bool(True)
+            ctx.write_varuint(self.VARIANT_INDEX + 1 if self.VARIANT_INDEX is not None else 0)
+            ctx.write_bytes(self.data_hash)
+            return
+
+        ctx.write_bool(False)
+        ctx.write_varuint(self.VARIANT_INDEX)
+
+        if isinstance(self, self.InnerNodeClass):
+            if not self.prefix.startswith(known_prefix):
+                raise proofmarshal.serialize.SerializerValueError('Inner node prefix does not extend its parent prefix')
+            BitsSerializer.ctx_serialize(self.prefix[len(known_prefix):], ctx)
+
+            self.left._ctx_serialize_compact(ctx, self.prefix + Bits([0]))
+            self.right._ctx_serialize_compact(ctx, self.prefix + Bits([1]))
+
+        else:
+            self._serialize_attrs(ctx)
+
+    @classmethod
+    def _ctx_deserialize_compact_variant(cls, i):
+        try:
+            return cls.UNION_CLASSES[i]
+        except IndexError:
+            raise proofmarshal.serialize.DeserializationError('bad union class number %d' % i)
+
+    @classmethod
+    def _ctx_deserialize_compact(cls, ctx, known_prefix):
+        if ctx.read_bool():
+            i = ctx.read_varuint()
+            if not i:
+                return cls._ctx_deserialize_fully_pruned(ctx)
+            return cls._ctx_deserialize_compact_variant(i - 1)._ctx_deserialize_fully_pruned(ctx)
+
+        variant = cls._ctx_deserialize_compact_variant(ctx.read_varuint())
+
+        if issubclass(variant, cls.InnerNodeClass):
+            prefix = known_prefix + BitsSerializer.ctx_deserialize(ctx)
+
+            left = cls._ctx_deserialize_compact(ctx, prefix + Bits([0]))
+            right = cls._ctx_deserialize_compact(ctx, prefix + Bits([1]))
+
+            # As with _deserialize_attrs(), the deserialized values don't need
+            # to be checked.
+            self = object.__new__(variant)
+            object.__setattr__(self, 'prefix', prefix)
+            object.__setattr__(self, 'left', left)
+            object.__setattr__(self, 'right', right)
+            object.__setattr__(self, 'is_fully_pruned', False)
+            object.__setattr__(self, 'is_pruned', left.is_pruned or right.is_pruned)
+            object.__setattr__(self, '_Proof__orig_instance', None)
+            return self._intern()
+
+        else:
+            return variant._deserialize_attrs(ctx)._intern()
+
+    def ctx_serialize_compact(self, ctx):
+        """Serialize to a context in the compact format"""
+        self._ctx_serialize_compact(ctx, Bits())
+
+    def serialize_compact(self):
+        """Serialize to bytes in the compact format"""
+        ctx = proofmarshal.serialize.BytesSerializationContext()
+        self.ctx_serialize_compact(ctx)
+        return ctx.getbytes()
+
+    @classmethod
+    def ctx_deserialize_compact(cls, ctx):
+        """Deserialize from a context in the compact format"""
+        return cls._ctx_deserialize_compact(ctx, Bits())
+
+    @classmethod
+    def deserialize_compact(cls, serialized_value):
+        """Deserialize from bytes in the compact format"""
+        ctx = proofmarshal.serialize.BytesDeserializationContext(serialized_value)
+        r = cls.ctx_deserialize_compact(ctx)
+        if not ctx.at_end():
+            raise proofmarshal.serialize.DeserializationError('Junk at end of serialized value; %d bytes unused' % \
+                                                                  (ctx.end - ctx.offset))
+        return r
+
 def make_MerbinnerTree_subclass(subclass):
     @subclass.declare_variant
     class MerbinnerTreeEmptyNodeClass(subclass):
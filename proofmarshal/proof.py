@@ -11,9 +11,12 @@
 
 import binascii
 import copy
-import hashlib
+import keyword
+import weakref
 
-from proofmarshal.serialize import HashingSerializer, BytesSerializationContext, SerializerTypeError, HashTag
+from proofmarshal.serialize import HashingSerializer, BytesSerializationContext, HashingSerializationContext, \
+                                   SegmentedSerializationContext, DeserializationError, SerializerTypeError, TruncationError, \
+                                   HashTag, varuint_size
 
 """Proof representation
 
@@ -28,7 +31,67 @@ class PrunedError(Exception):
         self.instance = instance
         super().__init__('Attribute %r not available, pruned away.' % attr_name)
 
-class Proof(HashingSerializer):
+class InternTable:
+    """Table of canonical proof instances
+
+    Equal proofs are usually separate objects. Interning them through a table
+    returns the instance already in the table, if any, so identical subtrees
+    are shared. Instances are held weakly, and removed from the table when no
+    longer used elsewhere.
+
+    Interning is enabled by setting the INTERN_TABLE attribute of a Proof
+    class; every proof of that class, or its subclasses, is then interned when
+    created or deserialized. As interning requires the hash, hashes are
+    calculated eagerly.
+    """
+
+    def __init__(self):
+        self.instances = weakref.WeakValueDictionary()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.instances)
+
+    def intern(self, proof):
+        """Return the canonical instance equal to proof"""
+        key = (proof.__class__, proof.hash)
+        canonical = self.instances.get(key)
+        if canonical is not None:
+            self.hits += 1
+            return canonical
+
+        else:
+            self.misses += 1
+            self.instances[key] = proof
+            return proof
+
+    @property
+    def hit_rate(self):
+        """Fraction of interned proofs that were already in the table"""
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+class _ProofMeta(type):
+    """Metaclass of proof classes
+
+    Sets up the attribute handling of a class whenever SERIALIZED_ATTRS is
+    set, whether in the class body or afterwards. The latter is needed for
+    proofs that refer to their own class.
+    """
+
+    def __init__(cls, name, bases, namespace, **kwargs):
+        super().__init__(name, bases, namespace, **kwargs)
+        # Proof itself has nothing to set up
+        if 'SERIALIZED_ATTRS' in namespace and any(isinstance(base, _ProofMeta) for base in bases):
+            cls._setup_attrs()
+
+    def __setattr__(cls, name, value):
+        super().__setattr__(name, value)
+        if name == 'SERIALIZED_ATTRS':
+            cls._setup_attrs()
+
+class Proof(HashingSerializer, metaclass=_ProofMeta):
     """Base class for all proof objects
 
     Proofs are structures that support pruning, automatically track
@@ -37,18 +100,56 @@ class Proof(HashingSerializer):
     """
     HASHTAG = None
 
-    __slots__ = ['is_pruned', 'is_fully_pruned','__orig_instance','data_hash','hash']
+    # InternTable, if proofs of this class are to be interned
+    INTERN_TABLE = None
+
+    __slots__ = ['is_pruned', 'is_fully_pruned','__orig_instance','data_hash','hash','__serialized_size']
     SERIALIZED_ATTRS = ()
-    SERIALIZED_ATTRS_BY_NAME = None
+    SERIALIZED_ATTRS_BY_NAME = {}
+
+    @classmethod
+    def _setup_attrs(cls):
+        """Set up attribute handling for cls.SERIALIZED_ATTRS"""
+        cls.SERIALIZED_ATTRS_BY_NAME = {name:ser_cls for name, ser_cls in cls.SERIALIZED_ATTRS}
+
+        # Replace the generic attribute handling with specialized versions,
+        # unless the class, or a class it inherits from, provides its own.
+        # Versions generated for previous SERIALIZED_ATTRS are replaced, or
+        # removed if the generic versions have to be used.
+        previous = cls.__dict__.get('_generated_attr_functions', ())
+        for name in previous:
+            delattr(cls, name)
+
+        generated = []
+        for name, func in _generate_attr_functions(cls).items():
+            if _has_standard_method(cls, name):
+                setattr(cls, name, func)
+                generated.append(name)
+        cls._generated_attr_functions = tuple(generated)
 
     def __new__(cls, **kwargs):
         """Basic creation/initialization"""
-        if cls.SERIALIZED_ATTRS_BY_NAME is None:
-            cls.SERIALIZED_ATTRS_BY_NAME = {name:ser_cls for name, ser_cls in cls.SERIALIZED_ATTRS}
+        self = object.__new__(cls)
+        cls._init_attrs(self, kwargs)
+        return self._intern()
+
+    def _intern(self):
+        """Return the canonical instance equal to self, if interning"""
+        if self.INTERN_TABLE is None or self.__orig_instance is not None or self.is_pruned:
+            # Pruned proofs vary in what has been pruned, so they're never
+            # interned.
+            return self
+
+        else:
+            return self.INTERN_TABLE.intern(self)
 
+    def _init_attrs(self, kwargs):
+        """Initialize a new instance from keyword arguments
+
+        Generic version; subclasses normally have a generated version instead.
+        """
         is_pruned = False
-        self = object.__new__(cls)
-        for name, ser_cls in cls.SERIALIZED_ATTRS_BY_NAME.items():
+        for name, ser_cls in self.SERIALIZED_ATTRS_BY_NAME.items():
             value = kwargs[name]
             ser_cls.check_instance(value)
             object.__setattr__(self, name, value)
@@ -59,7 +160,6 @@ class Proof(HashingSerializer):
         object.__setattr__(self, 'is_fully_pruned', False)
         object.__setattr__(self, 'is_pruned', is_pruned)
         object.__setattr__(self, '_Proof__orig_instance', None)
-        return self
 
     @classmethod
     def check_instance(cls, instance):
@@ -117,6 +217,13 @@ class Proof(HashingSerializer):
             object.__setattr__(self, 'hash', hash)
             return hash
 
+        elif name == 'is_pruned' and self.__orig_instance is not None:
+            # Sources other than an original instance may not know this in
+            # advance.
+            is_pruned = self.__orig_instance._source_is_pruned(self)
+            object.__setattr__(self, 'is_pruned', is_pruned)
+            return is_pruned
+
         if self.__orig_instance is None:
             # Don't have the original instance. Is this an attribute we should
             # have?
@@ -127,17 +234,11 @@ class Proof(HashingSerializer):
                 raise AttributeError("%r object has no attribute %r" % (self.__class__, name))
 
         else:
-            assert self.is_pruned
-
-            # We are pruned. Try getting that attribute from the original,
-            # non-pruned, instance. If it doesn't exist, the above code will throw
-            # an exception as expected.
-            value = getattr(self.__orig_instance, name)
-
-            # If the value is itself a proof, prune it to track dependencies
-            # recursively.
-            if isinstance(value, Proof):
-                value = value.prune()
+            # We are pruned, or otherwise have a source for our attributes,
+            # such as lazy deserialization. Get the attribute from that
+            # source. If it doesn't exist, the source will throw an exception
+            # as expected.
+            value = self.__orig_instance._source_attr(self, name)
 
             # For efficiency, we can now add that value to self to avoid going
             # through this process over again.
@@ -146,43 +247,103 @@ class Proof(HashingSerializer):
             # We succesfully brought something back into view, which means this
             # instance must not be fully pruned.
             object.__setattr__(self, 'is_fully_pruned', False)
+
+            # Only now can the source let go of this instance, e.g. by
+            # unloading it, without the value being stored again.
+            self.__orig_instance._source_loaded(self)
             return value
 
+    # A proof whose attributes aren't all available gets them on demand from
+    # its source, stored as __orig_instance. For pruned proofs the source is
+    # the original proof, which implements the following methods. Other
+    # sources, e.g. in proofmarshal.lazy, implement the same methods.
+
+    def _source_attr(self, instance, name):
+        """Return attribute name for instance, which we are the source of"""
+        assert instance.is_pruned
+
+        value = getattr(self, name)
+
+        # If the value is itself a proof, prune it to track dependencies
+        # recursively.
+        if isinstance(value, Proof):
+            value = value.prune()
+
+        return value
+
+    def _source_loaded(self, instance):
+        """Called once an attribute from _source_attr() is stored on instance"""
+        pass
+
+    def _source_data_hash(self, instance):
+        # Avoid unpruning unnecessarily
+        return self.data_hash
+
+    def _source_hash(self, instance):
+        return self.hash
+
+    def _source_is_pruned(self, instance):
+        return True
+
+    @classmethod
+    def _hashtag_class(cls):
+        """Return the HashTag class, and so hash function, of data hashes
+
+        Proofs without a HASHTAG have no hash, but still have a data hash,
+        using the default hash function.
+        """
+        return cls.HASHTAG.__class__ if cls.HASHTAG is not None else HashTag
+
     def calc_data_hash(self):
         if self.__orig_instance is not None:
-            # Avoid unpruning unnecessarily
-            return self.__orig_instance.data_hash
+            return self.__orig_instance._source_data_hash(self)
 
         else:
             # FIXME: catch pruning errors; should never happen
-            hasher = hashlib.sha256()
+            hasher = self._hashtag_class().HASH_FUNCTION()
+            self._hash_attrs(hasher)
+            return hasher.digest()
+
+    def _hash_attrs(self, hasher):
+        """Feed the attributes to hasher
 
-            for attr_name, ser_cls in self.SERIALIZED_ATTRS:
-                attr_value = getattr(self, attr_name)
+        Generic version; subclasses normally have a generated version instead.
+        """
+        ctx = HashingSerializationContext(hasher)
 
-                if issubclass(ser_cls, HashingSerializer):
-                    hasher.update(ser_cls.get_hash(attr_value))
+        for attr_name, ser_cls in self.SERIALIZED_ATTRS:
+            attr_value = getattr(self, attr_name)
 
-                else:
-                    hasher.update(ser_cls.serialize(attr_value))
+            if issubclass(ser_cls, HashingSerializer):
+                hasher.update(ser_cls.get_hash(attr_value))
 
-            return hasher.digest()
+            else:
+                ser_cls.ctx_serialize(attr_value, ctx)
 
     def calc_hash(self):
         if self.__orig_instance is not None:
-            # Avoid unpruning unnecessarily
-            return self.__orig_instance.hash
+            return self.__orig_instance._source_hash(self)
 
         else:
-            return self.HASHTAG(self.data_hash).digest()
+            return self.HASHTAG.digest(self.data_hash)
 
     def get_hash(self):
         return self.hash
 
     def _ctx_serialize(self, ctx):
+        self._serialize_attrs(ctx)
+
+    def _serialize_attrs(self, ctx):
+        """Serialize the attributes
+
+        Generic version; subclasses normally have a generated version instead.
+        """
         for attr_name, ser_cls in self.SERIALIZED_ATTRS:
             attr = getattr(self, attr_name)
-            ser_cls.ctx_serialize(attr, ctx)
+            if issubclass(ser_cls, HashingSerializer):
+                ctx.write_obj(attr, ser_cls)
+            else:
+                ser_cls.ctx_serialize(attr, ctx)
 
     def ctx_serialize(self, ctx):
         if self.is_fully_pruned:
@@ -194,65 +355,278 @@ class Proof(HashingSerializer):
             self._ctx_serialize(ctx)
 
 
+    def _ctx_serialized_size(self):
+        return self._attrs_serialized_size()
+
+    def _attrs_serialized_size(self):
+        """Return the total serialized size of the attributes"""
+        size = 0
+        for attr_name, ser_cls in self.SERIALIZED_ATTRS:
+            size += ser_cls.serialized_size(getattr(self, attr_name))
+        return size
+
+    def serialized_size(self):
+        """Return the length of the serialized proof, in bytes
+
+        Unpruned proofs are immutable, so their sizes are cached.
+        """
+        if self.is_fully_pruned:
+            return 1 + len(self.data_hash)
+
+        elif self.is_pruned:
+            # Unpruning attributes changes the size
+            return 1 + self._ctx_serialized_size()
+
+        try:
+            return object.__getattribute__(self, '_Proof__serialized_size')
+        except AttributeError:
+            size = 1 + self._ctx_serialized_size()
+            object.__setattr__(self, '_Proof__serialized_size', size)
+            return size
+
     def serialize(self):
         """Serialize to bytes"""
-        ctx = BytesSerializationContext()
+        # Preallocate if the size is already known
+        try:
+            size_hint = object.__getattribute__(self, '_Proof__serialized_size')
+        except AttributeError:
+            size_hint = 0
+
+        ctx = BytesSerializationContext(size_hint)
         self.ctx_serialize(ctx)
         return ctx.getbytes()
 
+    def serialize_segments(self, min_segment_size=512):
+        """Serialize to a list of buffer segments
+
+        See SegmentedSerializationContext.
+        """
+        ctx = SegmentedSerializationContext(min_segment_size)
+        self.ctx_serialize(ctx)
+        return ctx.getsegments()
+
     @classmethod
     def _ctx_deserialize(cls, ctx):
+        return cls._deserialize_attrs(ctx)
+
+    @classmethod
+    def _deserialize_attrs(cls, ctx):
+        """Deserialize the attributes, returning a new instance
+
+        Generic version; subclasses normally have a generated version instead.
+        """
         kwargs = {}
 
         for name, ser_cls in cls.SERIALIZED_ATTRS:
-            value = ser_cls.ctx_deserialize(ctx)
+            if issubclass(ser_cls, HashingSerializer):
+                value = ctx.read_obj(ser_cls)
+            else:
+                value = ser_cls.ctx_deserialize(ctx)
             kwargs[name] = value
 
-        return Proof.__new__(cls, **kwargs)
+        self = object.__new__(cls)
+        cls._init_attrs(self, kwargs)
+        return self
 
     @classmethod
     def ctx_deserialize(cls, ctx):
         fully_pruned = ctx.read_bool()
 
         if fully_pruned:
-            self = object.__new__(cls)
+            return cls._ctx_deserialize_fully_pruned(ctx)
 
-            data_hash = ctx.read_bytes(32) # FIXME
-            object.__setattr__(self, 'data_hash', data_hash)
+        else:
+            return cls._ctx_deserialize(ctx)._intern()
 
-            object.__setattr__(self, 'is_fully_pruned', True)
-            object.__setattr__(self, 'is_pruned', True)
-            object.__setattr__(self, '_Proof__orig_instance', None)
+    @classmethod
+    def _ctx_deserialize_variant(cls, ctx):
+        """Deserialize the class of a not fully pruned instance"""
+        return cls
 
-            return self
+    @classmethod
+    def _ctx_deserialize_resumable(cls, ctx):
+        # Child proofs already deserialized are kept when the data runs out,
+        # so a proof is deserialized in time proportional to its size however
+        # the data arrives. Only possible if deserialization hasn't been
+        # customized.
+        if not _has_standard_method(cls, 'ctx_deserialize') or \
+           not _has_standard_method(cls, '_ctx_deserialize'):
+            return (yield from super()._ctx_deserialize_resumable(ctx))
+
+        start = ctx.offset
+        while True:
+            try:
+                if ctx.read_bool():
+                    return cls._ctx_deserialize_fully_pruned(ctx)
+                variant = cls._ctx_deserialize_variant(ctx)
+                break
 
-        else:
-            return cls._ctx_deserialize(ctx)
+            except TruncationError:
+                ctx.offset = start
+                yield
+
+        if not _has_standard_method(variant, '_deserialize_attrs') or \
+           not _has_standard_method(variant, '_init_attrs'):
+            start = ctx.offset
+            while True:
+                try:
+                    return variant._deserialize_attrs(ctx)._intern()
+                except TruncationError:
+                    ctx.offset = start
+                    yield
+
+        values = []
+        for name, ser_cls in variant.SERIALIZED_ATTRS:
+            values.append((yield from ser_cls._ctx_deserialize_resumable(ctx)))
+
+        # Same as the generated _deserialize_attrs()
+        self = object.__new__(variant)
+        is_pruned = False
+        for (name, ser_cls), value in zip(variant.SERIALIZED_ATTRS, values):
+            ser_cls.check_instance(value)
+            object.__setattr__(self, name, value)
+            if issubclass(ser_cls, Proof):
+                is_pruned |= value.is_pruned
+        object.__setattr__(self, 'is_fully_pruned', False)
+        object.__setattr__(self, 'is_pruned', is_pruned)
+        object.__setattr__(self, '_Proof__orig_instance', None)
+        return self._intern()
+
+    @classmethod
+    def _ctx_deserialize_fully_pruned(cls, ctx):
+        """Deserialize a fully pruned instance, following the fully pruned flag"""
+        self = object.__new__(cls)
+
+        data_hash = ctx.read_bytes(cls._hashtag_class().DIGEST_LENGTH)
+        object.__setattr__(self, 'data_hash', data_hash)
+
+        object.__setattr__(self, 'is_fully_pruned', True)
+        object.__setattr__(self, 'is_pruned', True)
+        object.__setattr__(self, '_Proof__orig_instance', None)
+
+        return self
 
     def __repr__(self):
         # FIXME: better way to get a fully qualified name?
         return '%s.%s(<%s>)' % (self.__class__.__module__, self.__class__.__qualname__,
                                 binascii.hexlify(self.hash).decode('utf8'))
 
+def _has_standard_method(cls, name):
+    """Return True if cls uses a standard or generated version of a method"""
+    for klass in cls.__mro__:
+        if name in klass.__dict__:
+            return klass in (Proof, VarProof) or name in klass.__dict__.get('_generated_attr_functions', ())
+    return False
+
+def _generate_attr_functions(cls):
+    """Generate specialized attribute handling functions for a Proof class
+
+    The generic _init_attrs(), _serialize_attrs(), _deserialize_attrs() and
+    _hash_attrs() methods loop over SERIALIZED_ATTRS for every instance. The
+    functions generated here do the same work in straight-line code, with the
+    serializers bound in advance.
+
+    Returns a dict of name:function; empty if the generic versions have to be
+    used.
+    """
+    names = [name for name, ser_cls in cls.SERIALIZED_ATTRS]
+    for name in names:
+        if not name.isidentifier() or keyword.iskeyword(name):
+            return {}
+    if len(set(names)) != len(names):
+        return {}
+
+    namespace = {'object_new': object.__new__,
+                 'object_setattr': object.__setattr__,
+                 'HashingSerializationContext': HashingSerializationContext}
+
+    init_lines = []
+    setattr_lines = []
+    serialize_lines = []
+    deserialize_lines = []
+    hash_lines = []
+    proof_values = []
+    for i, (name, ser_cls) in enumerate(cls.SERIALIZED_ATTRS):
+        ser = 'ser%d' % i
+        value = 'value%d' % i
+        namespace[ser] = ser_cls
+
+        init_lines.append('%s = kwargs[%r]' % (value, name))
+        init_lines.append('%s.check_instance(%s)' % (ser, value))
+        setattr_lines.append('object_setattr(self, %r, %s)' % (name, value))
+
+        if issubclass(ser_cls, HashingSerializer):
+            # Go through the context, which may memoize them.
+            serialize_lines.append('ctx.write_obj(self.%s, %s)' % (name, ser))
+            deserialize_lines.append('%s = ctx.read_obj(%s)' % (value, ser))
+        else:
+            serialize_lines.append('%s.ctx_serialize(self.%s, ctx)' % (ser, name))
+            deserialize_lines.append('%s = %s.ctx_deserialize(ctx)' % (value, ser))
+
+        # Checked as the generic version does, via _init_attrs()
+        deserialize_lines.append('%s.check_instance(%s)' % (ser, value))
+
+        if issubclass(ser_cls, Proof):
+            proof_values.append(value)
+
+        if issubclass(ser_cls, Proof) and ser_cls.get_hash is Proof.get_hash:
+            hash_lines.append('hasher.update(self.%s.hash)' % name)
+        elif issubclass(ser_cls, HashingSerializer):
+            hash_lines.append('hasher.update(%s.get_hash(self.%s))' % (ser, name))
+        else:
+            hash_lines.append('%s.ctx_serialize(self.%s, ctx)' % (ser, name))
+
+    is_pruned = ' or '.join('%s.is_pruned' % value for value in proof_values) or 'False'
+    setattr_lines.append("object_setattr(self, 'is_fully_pruned', False)")
+    setattr_lines.append("object_setattr(self, 'is_pruned', %s)" % is_pruned)
+    setattr_lines.append("object_setattr(self, '_Proof__orig_instance', None)")
+
+    def body(lines):
+        return ''.join('    %s\n' % line for line in lines) or '    pass\n'
+
+    source = ('def _init_attrs(self, kwargs):\n' +
+              body(init_lines + setattr_lines) +
+              'def _serialize_attrs(self, ctx):\n' +
+              body(serialize_lines) +
+              'def _deserialize_attrs(cls, ctx):\n' +
+              body(deserialize_lines + ['self = object_new(cls)'] + setattr_lines + ['return self']) +
+              'def _hash_attrs(self, hasher):\n' +
+              body(['ctx = HashingSerializationContext(hasher)'] + hash_lines))
+
+    code = compile(source, '<generated attribute functions of %s>' % cls.__qualname__, 'exec')
+    exec(code, namespace)
+
+    return {'_init_attrs': namespace['_init_attrs'],
+            '_serialize_attrs': namespace['_serialize_attrs'],
+            '_deserialize_attrs': classmethod(namespace['_deserialize_attrs']),
+            '_hash_attrs': namespace['_hash_attrs']}
+
 class VarProof(Proof):
     """Serialization of Proofs with mutliple varient subclasses"""
     __slots__ = []
 
     UNION_CLASSES = None
+    VARIANT_INDEX = None
 
     @classmethod
     def check_instance(cls, value):
-        for cls in cls.UNION_CLASSES:
-            if isinstance(value, cls):
-                break
-        else:
-            raise SerializerTypeError('Class %r is not part of the %r union' % (value.__class__, cls))
+        for union_cls in cls.UNION_CLASSES:
+            if isinstance(value, union_cls):
+                return
+
+        # The variant of fully pruned proofs isn't serialized, so they're
+        # deserialized as the VarProof itself.
+        if value.__class__ is cls and value.is_fully_pruned:
+            return
+
+        raise SerializerTypeError('Class %r is not part of the %r union' % (value.__class__, cls))
 
     @classmethod
     def declare_variant(cls, subclass):
         """Class decorator to make a subclass part of a VarProof
 
-        The HASHTAG for the subclass will be derived from for you.
+        The HASHTAG for the subclass will be derived from for you, using the
+        hash function of our HASHTAG.
         """
         if not issubclass(subclass, VarProof):
             raise TypeError('Only VarProof subclasses can be part of a VarProof')
@@ -260,34 +634,53 @@ class VarProof(Proof):
         if cls.UNION_CLASSES is None:
             cls.UNION_CLASSES = []
 
-        subclass.HASHTAG = subclass.SUB_HASHTAG.derive(cls.HASHTAG)
+        subclass.HASHTAG = subclass.SUB_HASHTAG.derive(cls.HASHTAG, cls.HASHTAG.__class__)
 
+        subclass.VARIANT_INDEX = len(cls.UNION_CLASSES)
         cls.UNION_CLASSES.append(subclass)
 
         return subclass
 
     def _ctx_serialize(self, ctx):
-        for i,cls in enumerate(self.UNION_CLASSES):
-            if isinstance(self, cls):
-                ctx.write_varuint(i)
-                break
+        if self.VARIANT_INDEX is not None:
+            ctx.write_varuint(self.VARIANT_INDEX)
 
         else:
-            raise SerializerTypeError('bad class')
+            for i,cls in enumerate(self.UNION_CLASSES):
+                if isinstance(self, cls):
+                    ctx.write_varuint(i)
+                    break
+
+            else:
+                raise SerializerTypeError('bad class')
 
-        super()._ctx_serialize(ctx)
+        self._serialize_attrs(ctx)
+
+    def _ctx_serialized_size(self):
+        i = self.VARIANT_INDEX
+        if i is None:
+            for i,cls in enumerate(self.UNION_CLASSES):
+                if isinstance(self, cls):
+                    break
+
+            else:
+                raise SerializerTypeError('bad class')
+
+        return varuint_size(i) + self._attrs_serialized_size()
 
     @classmethod
-    def _ctx_deserialize(cls, ctx):
+    def _ctx_deserialize_variant(cls, ctx):
         i = ctx.read_varuint()
 
         try:
-            union_cls = cls.UNION_CLASSES[i]
+            return cls.UNION_CLASSES[i]
         except IndexError:
             # FIXME: nicer error message
             raise DeserializationError('bad union class number %d' % i)
 
-        return super(VarProof, union_cls)._ctx_deserialize(ctx)
+    @classmethod
+    def _ctx_deserialize(cls, ctx):
+        return cls._ctx_deserialize_variant(ctx)._deserialize_attrs(ctx)
 
 class ProofUnion(HashingSerializer):
     """Serialization of disjoint unions of proof classes
@@ -329,6 +722,15 @@ class ProofUnion(HashingSerializer):
         else:
             raise SerializerTypeError('bad class')
 
+    @classmethod
+    def serialized_size(cls, self):
+        for i,cls in enumerate(cls.UNION_CLASSES):
+            if isinstance(self, cls):
+                return varuint_size(i) + cls.serialized_size(self)
+
+        else:
+            raise SerializerTypeError('bad class')
+
     @classmethod
     def ctx_deserialize(cls, ctx):
         i = ctx.read_varuint()
@@ -340,3 +742,21 @@ class ProofUnion(HashingSerializer):
             raise DeserializationError('bad union class number %d' % i)
 
         return union_cls.ctx_deserialize(ctx)
+
+    @classmethod
+    def _ctx_deserialize_resumable(cls, ctx):
+        start = ctx.offset
+        while True:
+            try:
+                i = ctx.read_varuint()
+                break
+            except TruncationError:
+                ctx.offset = start
+                yield
+
+        try:
+            union_cls = cls.UNION_CLASSES[i]
+        except IndexError:
+            raise DeserializationError('bad union class number %d' % i)
+
+        return (yield from union_cls._ctx_deserialize_resumable(ctx))
@@ -10,10 +10,15 @@
 # LICENSE file.
 
 import binascii
+import functools
 import hashlib
-import io
 import uuid
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 """Deterministic, (mostly)context-free, object (de)serialization, and hashing
 
 Motivation
@@ -73,6 +78,152 @@ class SerializerValueError(ValueError):
     """Inappropriate value to be serialized (of correct type)"""
 
 
+_SINGLE_BYTE_VARUINTS = tuple(bytes([i]) for i in range(0b10000000))
+
+def encode_varuint(value):
+    """Encode an unsigned integer in LEB128 format
+
+    Returns the encoding as bytes.
+    """
+    if 0 <= value <= 0b01111111:
+        return _SINGLE_BYTE_VARUINTS[value]
+
+    elif value < 0:
+        raise SerializerValueError('Can only encode unsigned integers; got %d' % value)
+
+    else:
+        r = bytearray()
+        while value > 0b01111111:
+            r.append((value & 0b01111111) | 0b10000000)
+            value >>= 7
+        r.append(value)
+        return bytes(r)
+
+def varuint_size(value):
+    """Return the length of the LEB128 encoding of an unsigned integer"""
+    return (value.bit_length() + 6) // 7 or 1
+
+# Below this many integers the per-call overhead of numpy outweighs the gain.
+NUMPY_MIN_VARUINTS = 64
+
+def _encode_varuints_numpy(values):
+    values = numpy.asarray(values)
+    if values.dtype.kind not in 'iu':
+        # Casting would silently truncate floats, and encode_varuint()
+        # rejects them.
+        raise TypeError('Can only encode unsigned integers; got %s array' % values.dtype)
+    values = values.astype(numpy.uint64)
+
+    # Number of bytes in each encoding; at most 10 for 64-bit integers.
+    sizes = numpy.ones(len(values), dtype=numpy.intp)
+    for i in range(1, 10):
+        sizes += (values >> numpy.uint64(7*i)) != 0
+    starts = numpy.cumsum(sizes) - sizes
+
+    r = numpy.empty(int(sizes.sum()), dtype=numpy.uint8)
+    for i in range(int(sizes.max())):
+        mask = sizes > i
+        b = (values[mask] >> numpy.uint64(7*i)) & numpy.uint64(0b01111111)
+        b |= (sizes[mask] > i + 1).astype(numpy.uint64) << numpy.uint64(7)
+        r[starts[mask] + i] = b
+    return r.tobytes()
+
+def encode_varuints(values):
+    """Encode an iterable of unsigned integers in LEB128 format
+
+    Returns the concatenated encodings as bytes, identical to encoding each
+    integer with encode_varuint(). Long sequences of integers that fit in 64
+    bits are encoded with numpy, if available.
+    """
+    # Iterators can't be measured, or gone through twice.
+    if not hasattr(values, '__len__'):
+        values = tuple(values)
+
+    if numpy is not None and len(values) >= NUMPY_MIN_VARUINTS and min(values) >= 0:
+        try:
+            return _encode_varuints_numpy(values)
+        except (OverflowError, TypeError, ValueError):
+            # Out of range for uint64, or not integers; let encode_varuint()
+            # sort it out.
+            pass
+
+    return b''.join(map(encode_varuint, values))
+
+def _decode_varuints_numpy(buf, offset, end, n):
+    a = numpy.frombuffer(buf, dtype=numpy.uint8, count=min(end - offset, 10*n), offset=offset)
+
+    # Every encoding ends with the first byte with the high bit clear.
+    ends = numpy.flatnonzero(a < 0b10000000)[:n]
+    if len(ends) < n:
+        return None
+    starts = numpy.empty(n, dtype=numpy.intp)
+    starts[0] = 0
+    starts[1:] = ends[:-1] + 1
+    sizes = ends - starts + 1
+
+    # Ten bytes can encode up to 70 bits; only 64 fit.
+    if sizes.max() > 10 or (a[ends[sizes == 10]] > 1).any():
+        return None
+
+    l = int(ends[-1]) + 1
+    shifts = (numpy.arange(l) - numpy.repeat(starts, sizes)).astype(numpy.uint64) * numpy.uint64(7)
+    groups = (a[:l] & 0b01111111).astype(numpy.uint64) << shifts
+    values = numpy.bitwise_or.reduceat(groups, starts)
+    return values.tolist(), offset + l
+
+def _decode_varuints(buf, offset, end, n):
+    """Decode up to n LEB128-encoded unsigned integers from buf[offset:end]
+
+    Returns a tuple of (list of integers, offset past the last integer). If
+    there aren't n integers before end, the list is short.
+    """
+    if n <= 0:
+        return [], offset
+
+    if numpy is not None and n >= NUMPY_MIN_VARUINTS:
+        r = _decode_varuints_numpy(buf, offset, end, n)
+        if r is not None:
+            return r
+        # Truncated or very large integers; the slow path handles both.
+
+    r = []
+    try:
+        for i in range(n):
+            start = offset
+            b = buf[offset]
+            offset += 1
+            if offset > end:
+                raise IndexError
+
+            value = b & 0b01111111
+            shift = 7
+            while b & 0b10000000:
+                b = buf[offset]
+                offset += 1
+                if offset > end:
+                    raise IndexError
+                value |= (b & 0b01111111) << shift
+                shift += 7
+
+            r.append(value)
+
+    except IndexError:
+        return r, start
+
+    return r, offset
+
+def decode_varuints(buf, offset, end, n):
+    """Decode n LEB128-encoded unsigned integers from buf[offset:end]
+
+    Returns a tuple of (list of integers, offset past the last integer).
+    Raises TruncationError if there aren't n integers before end.
+    """
+    r, new_offset = _decode_varuints(buf, offset, end, n)
+    if len(r) < n:
+        raise TruncationError('Tried to read %d varuints at offset %d but got only %d' % \
+                              (n, offset, len(r)))
+    return r, new_offset
+
 class SerializationContext:
     """Context for serialization
 
@@ -92,6 +243,13 @@ class SerializationContext:
         """Write fixed-length bytes"""
         raise NotImplementedError
 
+    def write_varuints(self, values):
+        """Write a sequence of variable-length unsigned integers
+
+        Equivalent to calling write_varuint() on each value in turn.
+        """
+        self.write_bytes(encode_varuints(values))
+
     def write_varbytes(self, value):
         """Write variable-length bytes"""
         raise NotImplementedError
@@ -120,6 +278,13 @@ class DeserializationContext:
         """Read a variable-length unsigned integer"""
         raise NotImplementedError
 
+    def read_varuints(self, n):
+        """Read n variable-length unsigned integers
+
+        Returns a list.
+        """
+        return [self.read_varuint() for i in range(n)]
+
     def read_bytes(self, expected_length):
         """Read fixed-length bytes"""
         raise NotImplementedError
@@ -135,6 +300,10 @@ class DeserializationContext:
         """Read a (potentially memoizable/hashable) object"""
         raise NotImplementedError
 
+    def at_end(self):
+        """Return True if there is no more data to deserialize"""
+        raise NotImplementedError
+
 
 class StreamSerializationContext(SerializationContext):
     def __init__(self, fd):
@@ -154,18 +323,7 @@ class StreamSerializationContext(SerializationContext):
 
     def write_varuint(self, value):
         # unsigned little-endian base128 format (LEB128)
-        if value == 0:
-            self.fd.write(b'\x00')
-
-        else:
-            while value != 0:
-                b = value & 0b01111111
-                if value > 0b01111111:
-                    b |= 0b10000000
-                self.fd.write(bytes([b]))
-                if value <= 0b01111111:
-                    break
-                value >>= 7
+        self.fd.write(encode_varuint(value))
 
     def write_bytes(self, value):
         self.fd.write(value)
@@ -220,21 +378,568 @@ class StreamDeserializationContext(DeserializationContext):
     def read_obj(self, serialization_class):
         return serialization_class.ctx_deserialize(self)
 
-class BytesSerializationContext(StreamSerializationContext):
-    def __init__(self):
-        """Serialize to bytes"""
-        super().__init__(io.BytesIO())
+class BufferedStreamDeserializationContext(DeserializationContext):
+    def __init__(self, fd, buffer_size=65536):
+        """Deserialize from a stream, reading ahead into a buffer
+
+        Data is read from fd with readinto() in chunks of up to buffer_size
+        bytes, so values are decoded from memory and the stream is only read
+        when the buffer runs dry. Note that this means data past the end of
+        the deserialized object may be read from the stream too.
+
+        The offset attribute is the number of bytes deserialized so far.
+        """
+        if buffer_size < 1:
+            raise ValueError('buffer_size must be positive; got %d' % buffer_size)
+
+        self.fd = fd
+        self.buf = bytearray(buffer_size)
+        self.view = memoryview(self.buf)
+
+        # buf[pos:end] is data that has been read, but not yet deserialized
+        self.pos = 0
+        self.end = 0
+
+        # Stream offset of buf[0]
+        self.buf_offset = 0
+
+    @property
+    def offset(self):
+        return self.buf_offset + self.pos
+
+    def _fill(self, l):
+        """Make sure at least l bytes are available in the buffer"""
+        avail = self.end - self.pos
+        if self.pos:
+            # Move unread data to the start of the buffer
+            self.view[0:avail] = self.view[self.pos:self.end]
+            self.buf_offset += self.pos
+            self.pos = 0
+            self.end = avail
+
+        while self.end < l:
+            n = self.fd.readinto(self.view[self.end:])
+            if not n:
+                raise TruncationError('Tried to read %d bytes but got only %d bytes' % \
+                                      (l, self.end))
+            self.end += n
+
+    def read_bool(self):
+        if self.pos == self.end:
+            self._fill(1)
+
+        b = self.buf[self.pos]
+        self.pos += 1
+
+        if b == 0xff:
+            return True
+
+        elif b == 0x00:
+            return False
+
+        else:
+            raise DeserializationError('read_bool() expected 0xff or 0x00; got %d' % b)
+
+    def read_varuint(self):
+        buf = self.buf
+        pos = self.pos
+        end = self.end
+
+        value = 0
+        shift = 0
+        while True:
+            if pos == end:
+                self.pos = pos
+                self._fill(1)
+                pos = self.pos
+                end = self.end
+
+            b = buf[pos]
+            pos += 1
+            value |= (b & 0b01111111) << shift
+            if not (b & 0b10000000):
+                break
+            shift += 7
+
+        self.pos = pos
+        return value
+
+    def read_bytes(self, expected_length=None):
+        if expected_length is None:
+            expected_length = self.read_varuint()
+
+        l = expected_length
+        if self.end - self.pos < l:
+            if l <= len(self.buf):
+                self._fill(l)
+
+            else:
+                # Too big for the buffer; use what's there and read the rest
+                # directly.
+                r = bytearray(self.view[self.pos:self.end])
+                self.buf_offset += self.pos + l
+                self.pos = self.end = 0
+
+                while len(r) < l:
+                    chunk = self.fd.read(l - len(r))
+                    if not chunk:
+                        raise TruncationError('Tried to read %d bytes but got only %d bytes' % \
+                                              (l, len(r)))
+                    r += chunk
+
+                return bytes(r)
+
+        pos = self.pos
+        self.pos = pos + l
+        return self.view[pos:pos + l].tobytes()
+
+    def read_obj(self, serialization_class):
+        return serialization_class.ctx_deserialize(self)
+
+    def at_end(self):
+        if self.pos < self.end:
+            return False
+
+        try:
+            self._fill(1)
+        except TruncationError:
+            return True
+        return False
+
+class BytesSerializationContext(SerializationContext):
+    def __init__(self, size_hint=0):
+        """Serialize to bytes
+
+        The data is written to a bytearray. If size_hint is given that many
+        bytes are allocated up front; a good estimate of the final size avoids
+        reallocating the buffer as it grows.
+        """
+        self.buf = bytearray(size_hint)
+        self.offset = 0
+
+    def write_bool(self, value):
+        if value is True:
+            self.write_bytes(b'\xff')
+
+        elif value is False:
+            self.write_bytes(b'\x00')
+
+        else:
+            raise TypeError('Expected bool; got %r' % value.__class__)
+
+    def write_varuint(self, value):
+        encoded = encode_varuint(value)
+        offset = self.offset
+        end = offset + len(encoded)
+        self.buf[offset:end] = encoded
+        self.offset = end
+
+    def write_bytes(self, value):
+        offset = self.offset
+        end = offset + len(value)
+        # Overwrites preallocated space if available, otherwise appends.
+        self.buf[offset:end] = value
+        self.offset = end
+
+    def write_obj(self, value, serialization_class=None):
+        if serialization_class is None:
+            serialization_class = value.__class__
+        serialization_class.ctx_serialize(value, self)
+
+    def getbuffer(self):
+        """Return a memoryview of the bytes serialized to date
+
+        No copy is made. The buffer can't grow while the memoryview exists, so
+        release it before serializing anything else to this context.
+        """
+        return memoryview(self.buf)[:self.offset]
 
     def getbytes(self):
         """Return the bytes serialized to date"""
-        return self.fd.getvalue()
+        with memoryview(self.buf) as buf:
+            return buf[:self.offset].tobytes()
 
-class BytesDeserializationContext(StreamDeserializationContext):
-    def __init__(self, buf):
-        """Deserialize from bytes"""
-        super().__init__(io.BytesIO(buf))
+class SegmentedSerializationContext(SerializationContext):
+    def __init__(self, min_segment_size=512):
+        """Serialize to a list of buffer segments
+
+        Writes of at least min_segment_size bytes are kept by reference as
+        segments of their own, without copying; smaller writes are coalesced
+        into bytearray segments between them. The segments are suitable for
+        os.writev() or socket.sendmsg(), although note that both limit the
+        number of segments per call to os.sysconf('SC_IOV_MAX').
+
+        Buffers written by reference must not be modified until the segments
+        have been written out.
+        """
+        self.segments = []
+        self.buf = bytearray()
+        self.min_segment_size = min_segment_size
+        self.offset = 0
+
+    def write_bool(self, value):
+        if value is True:
+            self.buf += b'\xff'
+
+        elif value is False:
+            self.buf += b'\x00'
+
+        else:
+            raise TypeError('Expected bool; got %r' % value.__class__)
+        self.offset += 1
+
+    def write_varuint(self, value):
+        encoded = encode_varuint(value)
+        self.buf += encoded
+        self.offset += len(encoded)
+
+    def write_bytes(self, value):
+        l = len(value)
+        if l >= self.min_segment_size:
+            if self.buf:
+                self.segments.append(self.buf)
+                self.buf = bytearray()
+            self.segments.append(value)
+
+        else:
+            self.buf += value
+        self.offset += l
+
+    def write_obj(self, value, serialization_class=None):
+        if serialization_class is None:
+            serialization_class = value.__class__
+        serialization_class.ctx_serialize(value, self)
+
+    def getsegments(self):
+        """Return the list of segments serialized to date
+
+        Their total length is the offset attribute.
+        """
+        if self.buf:
+            self.segments.append(self.buf)
+            self.buf = bytearray()
+        return self.segments
+
+class BytesDeserializationContext(DeserializationContext):
+    def __init__(self, buf, offset=0):
+        """Deserialize from bytes
+
+        buf may be bytes, or any object supporting the buffer protocol, such as
+        bytearray, memoryview or mmap. Data is read in place; new bytes objects
+        are only created for values that are themselves bytes.
+
+        Deserialization starts at offset. The offset attribute is advanced as
+        data is read, so after deserializing an object it is the offset of the
+        first byte past the end of that object.
+        """
+        if buf.__class__ is not bytes:
+            buf = memoryview(buf).cast('B')
+        self.buf = buf
+        self.end = len(buf)
+
+        if not (0 <= offset <= self.end):
+            raise ValueError('Offset out of range; 0 <= %d <= %d' % (offset, self.end))
+        self.offset = offset
+
+    def _truncated(self, l):
+        raise TruncationError('Tried to read %d bytes at offset %d but got only %d bytes' % \
+                              (l, self.offset, self.end - self.offset))
+
+    def read_bool(self):
+        try:
+            b = self.buf[self.offset]
+        except IndexError:
+            self._truncated(1)
+        self.offset += 1
+
+        if b == 0xff:
+            return True
+
+        elif b == 0x00:
+            return False
+
+        else:
+            raise DeserializationError('read_bool() expected 0xff or 0x00; got %d' % b)
+
+    def read_varuint(self):
+        buf = self.buf
+        offset = self.offset
+
+        try:
+            b = buf[offset]
+            offset += 1
+
+            # Fast-path for single-byte integers
+            value = b & 0b01111111
+            shift = 7
+            while b & 0b10000000:
+                b = buf[offset]
+                offset += 1
+                value |= (b & 0b01111111) << shift
+                shift += 7
+
+        except IndexError:
+            self._truncated(offset - self.offset + 1)
+
+        self.offset = offset
+        return value
+
+    def read_bytes(self, expected_length=None):
+        if expected_length is None:
+            expected_length = self.read_varuint()
+
+        start = self.offset
+        end = start + expected_length
+        if end > self.end:
+            self._truncated(expected_length)
+        self.offset = end
+
+        # bytes() of a bytes slice is a no-op; of a memoryview slice, a copy
+        return bytes(self.buf[start:end])
+
+    def read_varuints(self, n):
+        r, offset = _decode_varuints(self.buf, self.offset, self.end, n)
+        if len(r) < n:
+            # Every integer not yet read takes at least one more byte.
+            self._truncated(self.end - self.offset + n - len(r))
+        self.offset = offset
+        return r
+
+    def read_obj(self, serialization_class):
+        return serialization_class.ctx_deserialize(self)
+
+    def at_end(self):
+        return self.offset == self.end
+
+class _PushDeserializationContext(BytesDeserializationContext):
+    """Context for PushDeserializer
+
+    The buffer is replaced as data arrives. Records how much data a truncated
+    read needed.
+    """
+    def __init__(self):
+        super().__init__(b'')
+        self.needed = 1
+
+    def _truncated(self, l):
+        self.needed = self.offset + l
+        super()._truncated(l)
+
+class PushDeserializer:
+    def __init__(self, serialization_class, records=False):
+        """Incrementally deserialize a stream of values as data arrives
+
+        Data is pushed in arbitrary chunks with feed(), which returns the
+        values completed so far. No I/O is done, so this can be driven by an
+        event loop.
+
+        By default the stream is serialized values, one after the other. If
+        records is true the stream is instead length-prefixed records as
+        written by Serializer.serialize_many().
+
+        Values are deserialized with _ctx_deserialize_resumable(), which for
+        proofs keeps the nodes deserialized so far when it runs out of data,
+        so deserializing a value takes time proportional to its size no
+        matter how it's split into chunks. The data of an incomplete value is
+        kept until the value is complete.
+        """
+        self.serialization_class = serialization_class
+        self.records = records
+        self.buf = bytearray()
+        self.ctx = _PushDeserializationContext()
+
+        # Suspended deserialization of the current value, if any
+        self.pending = None
+
+    def _deserialize_record(self, ctx):
+        """Deserialize a length-prefixed record; a generator, like _ctx_deserialize_resumable()"""
+        start = ctx.offset
+        while True:
+            try:
+                length = ctx.read_varuint()
+                break
+            except TruncationError:
+                ctx.offset = start
+                yield
+
+        end = ctx.offset + length
+        while end > ctx.end:
+            ctx.needed = end
+            yield
+
+        record_ctx = BytesDeserializationContext(ctx.buf[ctx.offset:end])
+        try:
+            value = self.serialization_class.ctx_deserialize(record_ctx)
+        except TruncationError as err:
+            # The record itself is complete, so it's corrupt.
+            raise DeserializationError('Truncated record: %s' % err)
+        finally:
+            record_ctx.buf.release()
+
+        if record_ctx.offset != length:
+            raise DeserializationError('Record length was %d bytes; deserialized %d bytes' % \
+                                           (length, record_ctx.offset))
+        ctx.offset = end
+        return value
+
+    def feed(self, data):
+        """Feed data to the deserializer
+
+        Returns a list of the values completed by this data, possibly empty.
+        """
+        self.buf += data
+        ctx = self.ctx
+        if len(self.buf) < ctx.needed:
+            return []
+
+        r = []
+        with memoryview(self.buf) as buf:
+            ctx.buf = buf
+            ctx.end = len(buf)
+            try:
+                while self.pending is not None or ctx.offset < ctx.end:
+                    if self.pending is None:
+                        if self.records:
+                            self.pending = self._deserialize_record(ctx)
+                        else:
+                            self.pending = self.serialization_class._ctx_deserialize_resumable(ctx)
+
+                    try:
+                        next(self.pending)
+
+                    except StopIteration as stop:
+                        r.append(stop.value)
+                        self.pending = None
+                        ctx.needed = ctx.offset + 1
+
+                    except:
+                        self.pending = None
+                        raise
+
+                    else:
+                        # Out of data
+                        break
+
+            finally:
+                # Nothing can keep a view of buf, or it can't be resized.
+                ctx.buf = b''
+
+        # Only data before the current value can be discarded, as the
+        # suspended deserialization refers to offsets within it.
+        if self.pending is None:
+            del self.buf[:ctx.offset]
+            ctx.needed -= ctx.offset
+            ctx.offset = 0
+        ctx.end = 0
+
+        return r
 
-    # FIXME: need to check that there isn't extra crap at end of object
+    def close(self):
+        """Signal the end of the stream
+
+        Raises TruncationError if the stream ended partway through a value.
+        """
+        if self.buf:
+            raise TruncationError('Stream ended with %d bytes of an incomplete value' % len(self.buf))
+
+class MemoizedSerializationContext(BytesSerializationContext):
+    def __init__(self, size_hint=0):
+        """Serialize to bytes, with back-references to repeated objects
+
+        Every object written with write_obj() is preceded by a varuint. Zero
+        means the object itself follows. Otherwise the object is the same as
+        the (n-1)th object previously written in full, counting in the order
+        their serializations were completed.
+
+        Objects are identified by their hashes, so the hashes of all objects
+        written will be calculated.
+        """
+        super().__init__(size_hint)
+        self.memo = {}
+        self.memo_length = 0
+
+    def write_obj(self, value, serialization_class=None):
+        if serialization_class is None:
+            serialization_class = value.__class__
+
+        value_hash = serialization_class.get_hash(value)
+        try:
+            idx, memoized_value = self.memo[value_hash]
+        except KeyError:
+            pass
+        else:
+            # A pruned object with the same hash may be missing data this one
+            # has, so only refer back to it if it's the very same object.
+            if memoized_value is value or not getattr(memoized_value, 'is_pruned', False):
+                self.write_varuint(idx + 1)
+                return
+
+        self.write_varuint(0)
+        serialization_class.ctx_serialize(value, self)
+        self.memo[value_hash] = (self.memo_length, value)
+        self.memo_length += 1
+
+class MemoizedDeserializationContext(BytesDeserializationContext):
+    def __init__(self, buf, offset=0):
+        """Deserialize from bytes written by a MemoizedSerializationContext
+
+        Back-references are resolved to the same Python object.
+        """
+        super().__init__(buf, offset)
+        self.memo = []
+
+    def read_obj(self, serialization_class):
+        n = self.read_varuint()
+        if n:
+            try:
+                value = self.memo[n - 1]
+            except IndexError:
+                raise DeserializationError('Back-reference to object %d; only %d objects read' % \
+                                               (n - 1, len(self.memo)))
+
+            # The object referred to was read as whatever it was expected to
+            # be at the time, so make sure it's what's expected here too.
+            # Unions, e.g. ProofUnion, accept any of their classes.
+            expected_classes = getattr(serialization_class, 'UNION_CLASSES', None) or (serialization_class,)
+            if not isinstance(value, tuple(expected_classes)):
+                raise DeserializationError('Back-reference to object %d of class %r; expected %r' % \
+                                               (n - 1, value.__class__, serialization_class))
+            return value
+
+        else:
+            value = serialization_class.ctx_deserialize(self)
+            self.memo.append(value)
+            return value
+
+class HashingSerializationContext(SerializationContext):
+    def __init__(self, hasher):
+        """Serialize directly into a hasher
+
+        hasher is any object with an update() method, such as a hashlib hash
+        object. No intermediate buffers are created.
+        """
+        self.hasher = hasher
+
+    def write_bool(self, value):
+        if value is True:
+            self.hasher.update(b'\xff')
+
+        elif value is False:
+            self.hasher.update(b'\x00')
+
+        else:
+            raise TypeError('Expected bool; got %r' % value.__class__)
+
+    def write_varuint(self, value):
+        self.hasher.update(encode_varuint(value))
+
+    def write_bytes(self, value):
+        self.hasher.update(value)
+
+    def write_obj(self, value, serialization_class=None):
+        if serialization_class is None:
+            serialization_class = value.__class__
+        serialization_class.ctx_serialize(value, self)
 
 class Serializer:
     """(De)serialize an instance of a class
@@ -266,6 +971,35 @@ class Serializer:
         """Deserialize from a context"""
         raise NotImplementedError
 
+    @classmethod
+    def _ctx_deserialize_resumable(cls, ctx):
+        """Deserialize from a context that may not yet have all the data
+
+        A generator, returning the value. It yields if it runs out of data, and
+        is resumed once more has been added to the context. Used by
+        PushDeserializer.
+
+        This version simply deserializes the value again from the start.
+        Serializers of large values made of many parts should keep the parts
+        already deserialized instead.
+        """
+        start = ctx.offset
+        while True:
+            try:
+                return cls.ctx_deserialize(ctx)
+            except TruncationError:
+                ctx.offset = start
+                yield
+
+    @classmethod
+    def serialized_size(cls, self):
+        """Return the length of the serialized value, in bytes
+
+        Subclasses should override this with something faster than
+        serializing the value.
+        """
+        return len(cls.serialize(self))
+
     @classmethod
     def serialize(cls, self):
         """Serialize to bytes"""
@@ -273,14 +1007,93 @@ class Serializer:
         cls.ctx_serialize(self, ctx)
         return ctx.getbytes()
 
+    @classmethod
+    def serialize_segments(cls, self, min_segment_size=512):
+        """Serialize to a list of buffer segments
+
+        See SegmentedSerializationContext.
+        """
+        ctx = SegmentedSerializationContext(min_segment_size)
+        cls.ctx_serialize(self, ctx)
+        return ctx.getsegments()
+
     @classmethod
     def deserialize(cls, serialized_value):
         """Deserialize from bytes"""
         ctx = BytesDeserializationContext(serialized_value)
         r = cls.ctx_deserialize(ctx)
-        # FIXME: check for junk at end
+        if ctx.offset != ctx.end:
+            raise DeserializationError('Junk at end of serialized value; %d bytes unused' % \
+                                           (ctx.end - ctx.offset))
         return r
 
+    @classmethod
+    def ctx_serialize_many(cls, values, ctx):
+        """Serialize multiple values to a context as length-prefixed records
+
+        Each record is the serialized length of the value as a varuint,
+        followed by the serialized value itself.
+        """
+        for value in values:
+            ctx.write_varuint(cls.serialized_size(value))
+            cls.ctx_serialize(value, ctx)
+
+    @classmethod
+    def serialize_many(cls, values, fd=None, flush_size=65536):
+        """Serialize multiple values as length-prefixed records
+
+        If fd is None the records are returned as bytes. Otherwise they're
+        written to fd incrementally, flushing whenever flush_size bytes have
+        accumulated.
+        """
+        if fd is None:
+            ctx = BytesSerializationContext()
+            cls.ctx_serialize_many(values, ctx)
+            return ctx.getbytes()
+
+        ctx = BytesSerializationContext()
+        for value in values:
+            cls.ctx_serialize_many((value,), ctx)
+
+            if ctx.offset >= flush_size:
+                with ctx.getbuffer() as buf:
+                    fd.write(buf)
+                ctx = BytesSerializationContext()
+
+        if ctx.offset:
+            with ctx.getbuffer() as buf:
+                fd.write(buf)
+
+    @classmethod
+    def ctx_deserialize_many(cls, ctx):
+        """Deserialize length-prefixed records from a context
+
+        Yields values until the context has no more data.
+        """
+        while not ctx.at_end():
+            length = ctx.read_varuint()
+            start = ctx.offset
+            value = cls.ctx_deserialize(ctx)
+            if ctx.offset - start != length:
+                raise DeserializationError('Record length was %d bytes; deserialized %d bytes' % \
+                                               (length, ctx.offset - start))
+            yield value
+
+    @classmethod
+    def deserialize_many(cls, serialized_values):
+        """Deserialize length-prefixed records
+
+        serialized_values may be bytes, any other buffer-protocol object such
+        as a memoryview or mmap, or a stream with a readinto() method. Values
+        are yielded as they are deserialized.
+        """
+        if hasattr(serialized_values, 'readinto'):
+            ctx = BufferedStreamDeserializationContext(serialized_values)
+        else:
+            ctx = BytesDeserializationContext(serialized_values)
+
+        yield from cls.ctx_deserialize_many(ctx)
+
 class SerBool(Serializer):
     """Serialization of boolean values"""
     @classmethod
@@ -292,6 +1105,10 @@ class SerBool(Serializer):
     def ctx_serialize(cls, self, ctx):
         ctx.write_bool(self)
 
+    @classmethod
+    def serialized_size(cls, self):
+        return 1
+
     @classmethod
     def ctx_deserialize(cls, ctx):
         return ctx.read_bool()
@@ -325,6 +1142,10 @@ class FixedBytes(Serializer):
     def ctx_serialize(cls, self, ctx):
         ctx.write_bytes(self)
 
+    @classmethod
+    def serialized_size(cls, self):
+        return cls.EXPECTED_LENGTH
+
     @classmethod
     def ctx_deserialize(cls, ctx):
         return ctx.read_bytes(cls.EXPECTED_LENGTH)
@@ -372,6 +1193,10 @@ class VarBytes(Serializer):
         ctx.write_varuint(len(self))
         ctx.write_bytes(self)
 
+    @classmethod
+    def serialized_size(cls, self):
+        return varuint_size(len(self)) + len(self)
+
     @classmethod
     def ctx_deserialize(cls, ctx):
         l = ctx.read_varuint()
@@ -397,6 +1222,10 @@ class UInt(Serializer):
     def ctx_serialize(cls, self, ctx):
         ctx.write_varuint(self)
 
+    @classmethod
+    def serialized_size(cls, self):
+        return varuint_size(self)
+
     @classmethod
     def ctx_deserialize(cls, ctx):
         r = ctx.read_varuint()
@@ -413,6 +1242,119 @@ class UInt32(UInt):
 class UInt64(UInt):
     MAX_INT = 2**64-1
 
+class UIntArray(Serializer):
+    """Serialization of variable-length arrays of unsigned integers
+
+    Arrays are tuples of ints, serialized as a varuint count followed by each
+    integer as a varuint.
+    """
+    INT_CLASS = None
+    MAX_LENGTH = None
+
+    def __new__(cls, int_class, max_length):
+        if not (isinstance(int_class, type) and issubclass(int_class, UInt)):
+            raise TypeError('Expected UInt subclass; got %r' % int_class)
+        if not isinstance(max_length, int):
+            raise TypeError('max length must be an integer')
+        if max_length < 0:
+            raise ValueError('max length must be non-negative; got %d' % max_length)
+
+        # Slightly evil...
+        class r(UIntArray):
+            INT_CLASS = int_class
+            MAX_LENGTH = max_length
+
+        r.__name__ = 'UIntArray(%s,%d)' % (int_class.__name__, max_length)
+        return r
+
+    @classmethod
+    def check_instance(cls, value):
+        if value.__class__ is not tuple:
+            raise SerializerTypeError('Expected tuple; got %r' % value.__class__)
+
+        if len(value) > cls.MAX_LENGTH:
+            raise SerializerValueError('Array too long; %d > %d' % (len(value), cls.MAX_LENGTH))
+
+        for i in value:
+            if i.__class__ is not int:
+                raise SerializerTypeError('Expected an int; got %r' % i.__class__)
+
+        if value and not (0 <= min(value) and max(value) <= cls.INT_CLASS.MAX_INT):
+            raise SerializerValueError('Integer out of range; 0 <= i <= %d' % cls.INT_CLASS.MAX_INT)
+
+    @classmethod
+    def ctx_serialize(cls, self, ctx):
+        ctx.write_varuint(len(self))
+        ctx.write_varuints(self)
+
+    @classmethod
+    def serialized_size(cls, self):
+        return varuint_size(len(self)) + sum(map(varuint_size, self))
+
+    @classmethod
+    def ctx_deserialize(cls, ctx):
+        l = ctx.read_varuint()
+        if l > cls.MAX_LENGTH:
+            raise DeserializationError('Array too long; %d > %d' % (l, cls.MAX_LENGTH))
+
+        r = tuple(ctx.read_varuints(l))
+
+        if r and max(r) > cls.INT_CLASS.MAX_INT:
+            raise DeserializationError('Deserialized integer out of range; 0 <= %d <= %d' % \
+                                           (max(r), cls.INT_CLASS.MAX_INT))
+        return r
+
+class DigestArray(Serializer):
+    """Serialization of variable-length arrays of digests
+
+    Arrays are tuples of digests, serialized as a varuint count followed by
+    the digests themselves, concatenated.
+    """
+    MAX_LENGTH = None
+
+    def __new__(cls, max_length):
+        if not isinstance(max_length, int):
+            raise TypeError('max length must be an integer')
+        if max_length < 0:
+            raise ValueError('max length must be non-negative; got %d' % max_length)
+
+        # Slightly evil...
+        class r(DigestArray):
+            MAX_LENGTH = max_length
+
+        r.__name__ = 'DigestArray(%d)' % max_length
+        return r
+
+    @classmethod
+    def check_instance(cls, value):
+        if value.__class__ is not tuple:
+            raise SerializerTypeError('Expected tuple; got %r' % value.__class__)
+
+        if len(value) > cls.MAX_LENGTH:
+            raise SerializerValueError('Array too long; %d > %d' % (len(value), cls.MAX_LENGTH))
+
+        for digest in value:
+            Digest.check_instance(digest)
+
+    @classmethod
+    def ctx_serialize(cls, self, ctx):
+        ctx.write_varuint(len(self))
+        ctx.write_bytes(b''.join(self))
+
+    @classmethod
+    def serialized_size(cls, self):
+        return varuint_size(len(self)) + len(self)*DIGEST_LENGTH
+
+    @classmethod
+    def ctx_deserialize(cls, ctx):
+        l = ctx.read_varuint()
+        if l > cls.MAX_LENGTH:
+            raise DeserializationError('Array too long; %d > %d' % (l, cls.MAX_LENGTH))
+
+        # Read all the digests at once, then split them up.
+        buf = ctx.read_bytes(l*DIGEST_LENGTH)
+        return tuple(buf[i:i + DIGEST_LENGTH] for i in range(0, l*DIGEST_LENGTH, DIGEST_LENGTH))
+
 class HashingSerializer(Serializer):
     """Serialization of objects with globally unique hashes
 
@@ -442,19 +1384,34 @@ class HashTag(bytes):
     Instances of this class implement tagged hashing, where a single hash
     function is turned into a family of hash functions, such that every (tag, msg)
     pair maps to a unique digest.
+
+    The underlying hash function is HASH_FUNCTION, a hashlib-style constructor
+    returning hash objects with DIGEST_LENGTH byte digests. This class uses
+    SHA256; subclasses such as Blake2bHashTag use other hash functions.
     """
     __slots__ = ()
+
+    HASH_FUNCTION = staticmethod(hashlib.sha256)
+    DIGEST_LENGTH = DIGEST_LENGTH
+
     def __new__(cls, tag):
         return bytes.__new__(cls, uuid.UUID(tag).bytes)
 
-    def derive(self, subtag):
-        """Derive a new tagged hash function from this tag"""
+    def derive(self, subtag, hashtag_class=None):
+        """Derive a new tagged hash function from this tag
+
+        The derived tag is of the same class, and so uses the same hash
+        function, as this tag, unless hashtag_class is given.
+        """
         # We need to make sure that derivations can't themselves collide in any
         # way with any other hash, so all derivations start with a unique root
         # for the purpose of deriving only.
         derivation_hasher = HashTag('8125d227-981c-4ca0-afa7-ab9911352c85')
         derived_digest = derivation_hasher(self + subtag).digest()
-        return bytes.__new__(HashTag, derived_digest[0:16])
+
+        if hashtag_class is None:
+            hashtag_class = self.__class__
+        return bytes.__new__(hashtag_class, derived_digest[0:16])
 
     def __str__(self):
         h = binascii.hexlify(self).decode('utf8')
@@ -464,6 +1421,25 @@ class HashTag(bytes):
         return "%s('%s')" % (self.__class__.__qualname__, str(self))
 
     def __call__(self, msg=b''):
-        r = hashlib.sha256(self)
+        r = self.HASH_FUNCTION(self)
         r.update(msg)
         return r
+
+    def digest(self, msg=b''):
+        """Return the tagged digest of msg
+
+        Same as self(msg).digest(), but faster for short messages.
+        """
+        return self.HASH_FUNCTION(self + msg).digest()
+
+class Blake2bHashTag(HashTag):
+    """Tagged hashing with BLAKE2b, with 32 byte digests"""
+    __slots__ = ()
+    HASH_FUNCTION = staticmethod(functools.partial(hashlib.blake2b, digest_size=32))
+    DIGEST_LENGTH = 32
+
+class Blake2sHashTag(HashTag):
+    """Tagged hashing with BLAKE2s, with 32 byte digests"""
+    __slots__ = ()
+    HASH_FUNCTION = staticmethod(functools.partial(hashlib.blake2s, digest_size=32))
+    DIGEST_LENGTH = 32
@@ -0,0 +1,483 @@
+# Copyright (C) 2015 Peter Todd <pete@petertodd.org>
+#
+# This file is part of python-proofmarshal.
+#
+# It is subject to the license terms in the LICENSE file found in the top-level
+# directory of this distribution.
+#
+# No part of python-proofmarshal, including this file, may be copied, modified,
+# propagated, or distributed except according to the terms contained in the
+# LICENSE file.
+
+import binascii
+import bisect
+import sqlite3
+
+from proofmarshal.proof import Proof, VarProof, ProofUnion, PrunedError
+from proofmarshal.serialize import BytesSerializationContext, BytesDeserializationContext, \
+                                   DeserializationError, SerializerTypeError
+
+"""Content-addressed storage of proofs
+
+A store holds proofs node by node, each node keyed by its hash. Committing a
+proof writes every node not already in the store; as nodes are shared between
+versions of a tree, only the nodes that changed are written.
+
+Loading a proof returns a stub that gets its attributes from the store when
+they're first accessed, using the same mechanism pruned proofs use to get
+attributes from their original instance. Proofs much larger than memory can
+be worked with, as only the nodes on the paths actually visited are loaded.
+
+Record format
+=============
+
+Each node is stored as the variant index, for VarProof subclasses, followed by
+its attributes. Attributes that are proofs are stored as references rather
+than inline: the union index, for ProofUnion serializers, the variant index,
+for VarProof subclasses, and the hash of the proof.
+"""
+
+def is_proof_serializer(ser_cls):
+    """Return True if values of ser_cls are stored as references"""
+    return issubclass(ser_cls, (Proof, ProofUnion))
+
+def _variant_index(cls, value):
+    """Return the index of value's class in cls.UNION_CLASSES"""
+    for i, union_cls in enumerate(cls.UNION_CLASSES):
+        if isinstance(value, union_cls):
+            return i, union_cls
+
+    raise SerializerTypeError('Class %r is not part of the %r union' % (value.__class__, cls))
+
+def _read_variant(cls, ctx):
+    i = ctx.read_varuint()
+    try:
+        return cls.UNION_CLASSES[i]
+    except IndexError:
+        raise DeserializationError('bad union class number %d' % i)
+
+def _write_ref(ser_cls, value, ctx):
+    if issubclass(ser_cls, ProofUnion):
+        i, ser_cls = _variant_index(ser_cls, value)
+        ctx.write_varuint(i)
+
+    if issubclass(ser_cls, VarProof):
+        i, ser_cls = _variant_index(ser_cls, value)
+        ctx.write_varuint(i)
+
+    ctx.write_bytes(value.hash)
+
+def _read_ref(ser_cls, ctx):
+    """Read a reference, returning (cls, hash)"""
+    if issubclass(ser_cls, ProofUnion):
+        ser_cls = _read_variant(ser_cls, ctx)
+
+    if issubclass(ser_cls, VarProof):
+        ser_cls = _read_variant(ser_cls, ctx)
+
+    return ser_cls, ctx.read_bytes(ser_cls.HASHTAG.DIGEST_LENGTH)
+
+def encode_record(proof):
+    """Encode a proof node as a record"""
+    ctx = BytesSerializationContext()
+
+    if isinstance(proof, VarProof):
+        ctx.write_varuint(_variant_index(proof.__class__, proof)[0])
+
+    for attr_name, ser_cls in proof.SERIALIZED_ATTRS:
+        value = getattr(proof, attr_name)
+        if is_proof_serializer(ser_cls):
+            _write_ref(ser_cls, value, ctx)
+        else:
+            ser_cls.ctx_serialize(value, ctx)
+
+    return ctx.getbytes()
+
+def record_class(proof_class, record):
+    """Return the class of the node a record is for"""
+    if issubclass(proof_class, VarProof):
+        return _read_variant(proof_class, BytesDeserializationContext(record))
+    else:
+        return proof_class
+
+def decode_record(cls, record):
+    """Decode a record for a node of class cls
+
+    Returns a list of (attr_name, value) in the order of cls.SERIALIZED_ATTRS,
+    with proofs replaced by (cls, hash) references.
+    """
+    ctx = BytesDeserializationContext(record)
+
+    if issubclass(cls, VarProof):
+        if _read_variant(cls, ctx) is not cls:
+            raise DeserializationError('Record is not for a %s node' % cls.__qualname__)
+
+    attrs = []
+    for attr_name, ser_cls in cls.SERIALIZED_ATTRS:
+        if is_proof_serializer(ser_cls):
+            value = _read_ref(ser_cls, ctx)
+        else:
+            value = ser_cls.ctx_deserialize(ctx)
+        attrs.append((attr_name, value))
+
+    if not ctx.at_end():
+        raise DeserializationError('Junk at end of record; %d bytes unused' % (ctx.end - ctx.offset))
+
+    return attrs
+
+def record_refs(cls, record):
+    """Return the (cls, hash) references to the children in a record"""
+    return [value for attr_name, value in decode_record(cls, record)
+                  if is_proof_serializer(cls.SERIALIZED_ATTRS_BY_NAME[attr_name])]
+
+class StoredProofSource:
+    """Source of the attributes of a proof loaded from a store
+
+    The source of the node the proof was found in, if any, is kept as
+    parent, so the nodes on the path to it can be kept in the cache.
+    """
+    __slots__ = ['store', 'record', 'size', 'proof_hash', 'parent']
+
+    def __init__(self, store, proof_hash, record=None, parent=None):
+        self.store = store
+        self.proof_hash = proof_hash
+        self.record = record
+        self.size = None
+        self.parent = parent
+
+    def _source_attr(self, instance, name):
+        if name not in instance.SERIALIZED_ATTRS_BY_NAME:
+            raise AttributeError("%r object has no attribute %r" % (instance.__class__, name))
+
+        record = self.record
+        if record is None:
+            record = self.store.get_record(instance.hash)
+        self.record = None
+        self.size = len(record)
+
+        # Every attribute comes from the same record, so set them all at once.
+        r = None
+        for attr_name, value in decode_record(instance.__class__, record):
+            if is_proof_serializer(instance.SERIALIZED_ATTRS_BY_NAME[attr_name]):
+                value = self.store._node(*value, parent=self)
+            object.__setattr__(instance, attr_name, value)
+
+            if attr_name == name:
+                r = value
+
+        return r
+
+    def _source_loaded(self, instance):
+        # Only once loaded, and the attribute accessed stored, as the node may
+        # be evicted, and unloaded, right away if it's too big.
+        size = self.size
+        self.size = None
+        if size is not None and self.store.cache is not None:
+            # Nodes are only evicted as others are added, so using the nodes
+            # on the path to this one keeps the upper levels of the tree,
+            # which every lookup goes through, in the cache.
+            parent = self.parent
+            while parent is not None:
+                self.store.cache.touch(parent.proof_hash)
+                parent = parent.parent
+
+            self.store.cache.add(instance, size, self._unload)
+
+    def _unload(self, instance):
+        """Turn instance back into a stub, when evicted from the cache"""
+        for attr_name in instance.SERIALIZED_ATTRS_BY_NAME:
+            try:
+                object.__delattr__(instance, attr_name)
+            except AttributeError:
+                pass
+
+    def _source_data_hash(self, instance):
+        hasher = instance._hashtag_class().HASH_FUNCTION()
+        instance._hash_attrs(hasher)
+        return hasher.digest()
+
+    def _source_hash(self, instance):
+        return instance.HASHTAG.digest(instance.data_hash)
+
+    def _source_is_pruned(self, instance):
+        return False
+
+class ProofStore:
+    """Base class for content-addressed stores of proofs
+
+    Subclasses implement get_record(), _put_records(), __contains__(),
+    __len__() and __iter__(), as well as watermark(), _serials() and _delete()
+    for garbage collection.
+
+    If cache is given, it should be a proofmarshal.cache.NodeCache; loaded
+    nodes are added to it, sized by their records, and are reused when the
+    same node is loaded again. Nodes evicted from the cache are unloaded, and
+    loaded again from the store if used again.
+
+    Loading a node counts as a use of the nodes it was found through, so the
+    upper levels of a tree, which every lookup goes through, stay cached.
+    """
+
+    # GarbageCollector in progress, if any; see proofmarshal.collect
+    collector = None
+
+    def __init__(self, cache=None):
+        self.cache = cache
+
+    def get_record(self, proof_hash):
+        """Return the record for proof_hash
+
+        Raises KeyError if the node is not in the store.
+        """
+        raise NotImplementedError
+
+    def _put_records(self, records):
+        """Add (hash, record) pairs to the store, in order"""
+        raise NotImplementedError
+
+    def __contains__(self, proof_hash):
+        raise NotImplementedError
+
+    def __len__(self):
+        raise NotImplementedError
+
+    def __iter__(self):
+        """Iterate through the hashes of the nodes in the store"""
+        raise NotImplementedError
+
+    def watermark(self):
+        """Return the serial number of the most recently added node
+
+        Every node added to the store gets a higher serial number than those
+        added before it; 0 if the store is empty.
+        """
+        raise NotImplementedError
+
+    def _serials(self, after, upto, limit=None):
+        """Return a list of (serial, hash) for nodes with after < serial <= upto
+
+        In order of serial number, with at most limit entries.
+        """
+        raise NotImplementedError
+
+    def _serial(self, proof_hash):
+        """Return the serial number of a node"""
+        raise NotImplementedError
+
+    def _delete(self, hashes):
+        """Delete nodes"""
+        raise NotImplementedError
+
+    def __getstate__(self):
+        # Caches and collectors only make sense within one process.
+        state = self.__dict__.copy()
+        state['cache'] = None
+        state.pop('collector', None)
+        return state
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        pass
+
+    def commit(self, proof):
+        """Add a proof to the store
+
+        Nodes are written children first, so every node in the store can be
+        loaded in full. Nodes already in the store are skipped, along with
+        everything below them, so parts of the proof already in the store may
+        be pruned. Raises ValueError if a pruned part isn't in the store.
+        Returns the hash of the proof.
+        """
+        records = []
+        seen = set()
+        stack = [(proof, None)]
+        while stack:
+            node, record = stack.pop()
+            if record is not None:
+                records.append((node.hash, record))
+                continue
+
+            node_hash = node.hash
+            if node_hash in seen or node_hash in self:
+                continue
+            seen.add(node_hash)
+
+            try:
+                record = encode_record(node)
+            except PrunedError:
+                raise ValueError("Can't commit pruned node %s; not in the store" % \
+                                 binascii.hexlify(node_hash).decode('utf8'))
+
+            stack.append((node, record))
+            for attr_name, ser_cls in node.SERIALIZED_ATTRS:
+                if is_proof_serializer(ser_cls):
+                    stack.append((getattr(node, attr_name), None))
+
+        self._put_records(records)
+
+        # Proofs committed while garbage is being collected are kept.
+        if self.collector is not None:
+            self.collector.add_root(proof.__class__, proof.hash)
+
+        return proof.hash
+
+    def _stub(self, cls, proof_hash, record=None, parent=None):
+        """Create a stub for a node in the store"""
+        stub = object.__new__(cls)
+        object.__setattr__(stub, 'hash', proof_hash)
+        object.__setattr__(stub, 'is_fully_pruned', False)
+        object.__setattr__(stub, 'is_pruned', False)
+        object.__setattr__(stub, '_Proof__orig_instance', StoredProofSource(self, proof_hash, record, parent))
+        return stub
+
+    def _node(self, cls, proof_hash, parent=None):
+        """Return the node for a reference, from the cache if possible"""
+        if self.cache is not None:
+            node = self.cache.get(proof_hash)
+            if node is not None and node.__class__ is cls:
+                return node
+
+        return self._stub(cls, proof_hash, parent=parent)
+
+    def load(self, proof_class, proof_hash):
+        """Load a proof from the store
+
+        The nodes of the proof are loaded as they're used. Raises KeyError if
+        the proof is not in the store.
+        """
+        if self.cache is not None:
+            node = self.cache.get(proof_hash)
+            if node is not None and isinstance(node, proof_class):
+                return node
+
+        record = self.get_record(proof_hash)
+        return self._stub(record_class(proof_class, record), proof_hash, record)
+
+class MemoryProofStore(ProofStore):
+    """Proof store held in memory"""
+
+    def __init__(self, cache=None):
+        super().__init__(cache)
+        self.records = {}
+        self.serials = {}
+        self.last_serial = 0
+
+        # Serial numbers and hashes in order, for _serials(). Deleted nodes
+        # are left in place until they make up half the entries.
+        self.order_serials = []
+        self.order_hashes = []
+
+    def get_record(self, proof_hash):
+        return self.records[proof_hash]
+
+    def _put_records(self, records):
+        for proof_hash, record in records:
+            if proof_hash not in self.records:
+                self.last_serial += 1
+                self.records[proof_hash] = record
+                self.serials[proof_hash] = self.last_serial
+                self.order_serials.append(self.last_serial)
+                self.order_hashes.append(proof_hash)
+
+    def __contains__(self, proof_hash):
+        return proof_hash in self.records
+
+    def __len__(self):
+        return len(self.records)
+
+    def __iter__(self):
+        return iter(self.records)
+
+    def watermark(self):
+        return self.last_serial
+
+    def _serials(self, after, upto, limit=None):
+        r = []
+        for i in range(bisect.bisect_right(self.order_serials, after), len(self.order_serials)):
+            serial = self.order_serials[i]
+            if serial > upto or (limit is not None and len(r) >= limit):
+                break
+
+            proof_hash = self.order_hashes[i]
+            if self.serials.get(proof_hash) == serial:
+                r.append((serial, proof_hash))
+        return r
+
+    def _serial(self, proof_hash):
+        return self.serials[proof_hash]
+
+    def _delete(self, hashes):
+        for proof_hash in hashes:
+            del self.records[proof_hash]
+            del self.serials[proof_hash]
+
+        if len(self.order_serials) > 2*len(self.serials):
+            self.order_serials = list(self.serials.values())
+            self.order_hashes = list(self.serials)
+
+class SQLiteProofStore(ProofStore):
+    """Proof store in an SQLite database
+
+    Each commit is a single transaction. Serial numbers are an AUTOINCREMENT
+    column, so they aren't reused even if the newest nodes are deleted.
+    Pickled stores are reopened from the same path.
+    """
+
+    def __init__(self, path, cache=None):
+        super().__init__(cache)
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        with self.conn:
+            self.conn.execute('CREATE TABLE IF NOT EXISTS nodes (serial INTEGER PRIMARY KEY AUTOINCREMENT, '
+                                                                 'hash BLOB UNIQUE NOT NULL, '
+                                                                 'record BLOB NOT NULL)')
+
+    def __reduce__(self):
+        return (self.__class__, (self.path,))
+
+    def close(self):
+        self.conn.close()
+
+    def get_record(self, proof_hash):
+        row = self.conn.execute('SELECT record FROM nodes WHERE hash = ?', (proof_hash,)).fetchone()
+        if row is None:
+            raise KeyError(proof_hash)
+        return row[0]
+
+    def _put_records(self, records):
+        with self.conn:
+            self.conn.executemany('INSERT OR IGNORE INTO nodes (hash, record) VALUES (?, ?)', records)
+
+    def __contains__(self, proof_hash):
+        return self.conn.execute('SELECT 1 FROM nodes WHERE hash = ?', (proof_hash,)).fetchone() is not None
+
+    def __len__(self):
+        return self.conn.execute('SELECT COUNT(*) FROM nodes').fetchone()[0]
+
+    def __iter__(self):
+        for (proof_hash,) in self.conn.execute('SELECT hash FROM nodes ORDER BY serial'):
+            yield proof_hash
+
+    def watermark(self):
+        # The last serial handed out, even if that node has since been deleted
+        row = self.conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'nodes'").fetchone()
+        return 0 if row is None else row[0]
+
+    def _serials(self, after, upto, limit=None):
+        return self.conn.execute('SELECT serial, hash FROM nodes WHERE serial > ? AND serial <= ? ORDER BY serial LIMIT ?',
+                                 (after, upto, -1 if limit is None else limit)).fetchall()
+
+    def _serial(self, proof_hash):
+        row = self.conn.execute('SELECT serial FROM nodes WHERE hash = ?', (proof_hash,)).fetchone()
+        if row is None:
+            raise KeyError(proof_hash)
+        return row[0]
+
+    def _delete(self, hashes):
+        with self.conn:
+            self.conn.executemany('DELETE FROM nodes WHERE hash = ?', ((proof_hash,) for proof_hash in hashes))
@@ -12,6 +12,7 @@
 import binascii
 import json
 import os
+import tempfile
 
 def x(h):
     h = h.replace(' ','')
@@ -20,6 +21,12 @@ def x(h):
 def b2x(b):
     return binascii.hexlify(b).decode('utf8')
 
+def temp_path(test_case):
+    """Return a path in a temporary directory removed once test_case is done"""
+    tmpdir = tempfile.TemporaryDirectory()
+    test_case.addCleanup(tmpdir.cleanup)
+    return os.path.join(tmpdir.name, 'test')
+
 def load_test_vectors(name):
     with open(os.path.dirname(__file__) + '/data/' + name, 'r') as fd:
         for test_case in json.load(fd):
@@ -0,0 +1,191 @@
+# Copyright (C) 2015 Peter Todd <pete@petertodd.org>
+#
+# This file is part of python-proofmarshal.
+#
+# It is subject to the license terms in the LICENSE file found in the top-level
+# directory of this distribution.
+#
+# No part of python-proofmarshal, including this file, may be copied, modified,
+# propagated, or distributed except according to the terms contained in the
+# LICENSE file.
+
+import os
+import unittest
+
+from proofmarshal.archive import ProofArchive, ProofArchiveWriter, MAGIC, FOOTER_LENGTH, OFFSET_LENGTH
+from proofmarshal.serialize import DeserializationError
+from proofmarshal.test import temp_path
+from proofmarshal.test.test_mmr import IntMMR
+from proofmarshal.test.test_proof import Blake2LeafProof
+
+class Test_ProofArchive(unittest.TestCase):
+    def setUp(self):
+        self.path = temp_path(self)
+
+    def test_empty(self):
+        with ProofArchiveWriter(self.path, IntMMR):
+            pass
+
+        with ProofArchive(self.path, IntMMR) as archive:
+            self.assertEqual(len(archive), 0)
+            self.assertEqual(list(archive), [])
+            self.assertNotIn(b'\x00'*32, archive)
+            with self.assertRaises(KeyError):
+                archive[b'\x00'*32]
+
+    def test_lookup(self):
+        mmrs = [IntMMR(range(i)) for i in range(20)]
+
+        with ProofArchiveWriter(self.path, IntMMR) as writer:
+            hashes = [writer.append(m) for m in mmrs]
+            # duplicates are skipped
+            writer.append(mmrs[3])
+
+        with ProofArchive(self.path, IntMMR) as archive:
+            self.assertEqual(len(archive), 20)
+            self.assertEqual(list(archive.keys()), sorted(hashes))
+
+            for m in mmrs:
+                self.assertIn(m.hash, archive)
+                self.assertEqual(list(archive[m.hash]), list(m))
+
+                lazy_m = archive.get(m.hash, lazy=True)
+                self.assertEqual(lazy_m.hash, m.hash)
+                self.assertEqual(list(lazy_m), list(m))
+                del lazy_m
+
+            self.assertNotIn(b'\xff'*32, archive)
+
+            # sequential scan returns proofs in the order they were added
+            self.assertEqual([m.hash for m in archive], hashes)
+
+    def test_append(self):
+        mmrs = [IntMMR(range(i)) for i in range(10)]
+
+        with ProofArchiveWriter(self.path, IntMMR) as writer:
+            writer.extend(mmrs[:5])
+
+        with ProofArchiveWriter(self.path, IntMMR) as writer:
+            writer.extend(mmrs[3:])
+
+        with ProofArchive(self.path, IntMMR) as archive:
+            self.assertEqual(len(archive), 10)
+            self.assertEqual([m.hash for m in archive], [m.hash for m in mmrs])
+            for m in mmrs:
+                self.assertEqual(archive[m.hash].hash, m.hash)
+
+    def test_close_in_use(self):
+        """Closing an archive with lazy proofs still in use"""
+        m = IntMMR(range(5))
+        with ProofArchiveWriter(self.path, IntMMR) as writer:
+            writer.append(m)
+
+        archive = ProofArchive(self.path, IntMMR)
+        lazy_m = archive.get(m.hash, lazy=True)
+        with self.assertRaises(BufferError):
+            archive.close()
+
+        # Still open and usable
+        self.assertEqual(list(lazy_m), list(m))
+        self.assertIn(m.hash, archive)
+        self.assertEqual(list(archive[m.hash]), list(m))
+
+        del lazy_m
+        archive.close()
+        archive.close()
+
+    def test_reopen_unmodified(self):
+        """The existing index is kept until something is appended"""
+        mmrs = [IntMMR(range(i)) for i in range(5)]
+        with ProofArchiveWriter(self.path, IntMMR) as writer:
+            writer.extend(mmrs)
+        with open(self.path, 'rb') as fd:
+            serialized = fd.read()
+
+        # Nothing new appended
+        with ProofArchiveWriter(self.path, IntMMR) as writer:
+            writer.extend(mmrs)
+
+        # Writer abandoned without being closed
+        writer = ProofArchiveWriter(self.path, IntMMR)
+        writer.append(mmrs[0])
+        writer.fd.close()
+
+        with open(self.path, 'rb') as fd:
+            self.assertEqual(fd.read(), serialized)
+
+    def test_digest_length(self):
+        """Proofs with hashes other than 32 bytes long"""
+        proofs = [Blake2LeafProof(value=i) for i in range(10)]
+        with ProofArchiveWriter(self.path, Blake2LeafProof) as writer:
+            writer.extend(proofs)
+
+            with self.assertRaises(ValueError):
+                writer.append(IntMMR())
+
+        with ProofArchive(self.path, Blake2LeafProof) as archive:
+            self.assertEqual(archive.digest_length, 64)
+            for proof in proofs:
+                self.assertEqual(archive[proof.hash].value, proof.value)
+
+    def test_corrupt(self):
+        with open(self.path, 'wb') as fd:
+            fd.write(b'not an archive')
+
+        with self.assertRaises(DeserializationError):
+            ProofArchive(self.path, IntMMR)
+
+        # The file isn't left open
+        n_fds = len(os.listdir('/proc/self/fd')) if os.path.exists('/proc/self/fd') else None
+        with self.assertRaises(DeserializationError):
+            ProofArchiveWriter(self.path, IntMMR)
+        if n_fds is not None:
+            self.assertEqual(len(os.listdir('/proc/self/fd')), n_fds)
+
+        # truncated footer
+        with ProofArchiveWriter(self.path + '.1', IntMMR) as writer:
+            writer.append(IntMMR(range(3)))
+        with open(self.path + '.1', 'rb') as fd:
+            serialized = fd.read()
+        with open(self.path, 'wb') as fd:
+            fd.write(serialized[:-1])
+
+        with self.assertRaises(DeserializationError):
+            ProofArchive(self.path, IntMMR)
+
+    def test_corrupt_index(self):
+        """Corrupt indexes raise DeserializationError"""
+        with ProofArchiveWriter(self.path, IntMMR) as writer:
+            m_hash = writer.append(IntMMR(range(3)))
+        with open(self.path, 'rb') as fd:
+            serialized = bytearray(fd.read())
+        footer = len(serialized) - FOOTER_LENGTH
+        index_offset = int.from_bytes(serialized[footer:footer + OFFSET_LENGTH], 'big')
+
+        # Record offset out of range
+        bad = bytearray(serialized)
+        bad[index_offset + len(m_hash):index_offset + len(m_hash) + OFFSET_LENGTH] = b'\xff'*OFFSET_LENGTH
+        with open(self.path, 'wb') as fd:
+            fd.write(bad)
+        with ProofArchive(self.path, IntMMR) as archive:
+            for lazy in (False, True):
+                with self.assertRaises(DeserializationError):
+                    archive.get(m_hash, lazy)
+
+        # Footer consistent with a single index entry overlapping the magic
+        bad = bytearray(serialized)
+        bad[footer:] = ((0).to_bytes(OFFSET_LENGTH, 'big') + (1).to_bytes(OFFSET_LENGTH, 'big') +
+                        bytes([footer - OFFSET_LENGTH]) + MAGIC)
+        with open(self.path, 'wb') as fd:
+            fd.write(bad)
+        with self.assertRaises(DeserializationError):
+            ProofArchive(self.path, IntMMR)
+
+    def test_reopen_digest_length(self):
+        """Appending proofs of another digest length to an archive"""
+        with ProofArchiveWriter(self.path, IntMMR) as writer:
+            writer.append(IntMMR(range(3)))
+
+        with self.assertRaises(ValueError):
+            ProofArchiveWriter(self.path, Blake2LeafProof)
+
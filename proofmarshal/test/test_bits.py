@@ -10,8 +10,12 @@
 # LICENSE file.
 
 import unittest
+import unittest.mock
 
-from proofmarshal.bits import Bits
+import proofmarshal.bits
+import proofmarshal.serialize
+
+from proofmarshal.bits import Bits, BitsSerializer, sort_keys, NUMPY_MIN_KEYS
 from proofmarshal.test import load_test_vectors, x, b2x
 
 class Test_Bits(unittest.TestCase):
@@ -170,6 +174,76 @@ class Test_Bits(unittest.TestCase):
         with self.assertRaises(TypeError):
             Bits()[0.0:]
 
+    def test_views(self):
+        """Slices are views of the same buffer"""
+        import random
+        rand = random.Random(0)
+
+        bits = tuple(rand.getrandbits(1) for i in range(100))
+        b = Bits(bits)
+        for i in range(500):
+            start = rand.randrange(0, 101)
+            stop = rand.randrange(start, 101)
+            view = b[start:stop]
+            view_bits = bits[start:stop]
+            self.assertEqual(tuple(view), view_bits)
+            self.assertEqual(view, Bits(view_bits))
+            if view_bits:
+                self.assertIs(view._Bits__buf, b._Bits__buf)
+                self.assertEqual(view[-1], view_bits[-1])
+
+            # Views of views
+            start2 = rand.randrange(0, len(view_bits) + 1)
+            stop2 = rand.randrange(start2, len(view_bits) + 1)
+            self.assertEqual(tuple(view[start2:stop2]), view_bits[start2:stop2])
+
+            # Comparisons, concatenation, etc. between views
+            start = rand.randrange(0, 101)
+            other = b[start:start + rand.randrange(0, 30)]
+            other_bits = bits[start:start + len(other)]
+            self.assertEqual(view == other, view_bits == other_bits)
+            self.assertEqual(view < other, Bits(view_bits) < Bits(other_bits))
+            self.assertEqual(tuple(view + other), view_bits + other_bits)
+            self.assertEqual(view.common_prefix(other), Bits(view_bits).common_prefix(Bits(other_bits)))
+            self.assertEqual(view.startswith(other), view_bits[:len(other_bits)] == other_bits)
+
+            serialized = BitsSerializer.serialize(view)
+            self.assertEqual(serialized, BitsSerializer.serialize(Bits(view_bits)))
+            self.assertEqual(BitsSerializer.deserialize(serialized), view)
+
+        # Slices with steps still work
+        self.assertEqual(tuple(b[1:50:3]), bits[1:50:3])
+
+    def test_from_buffer(self):
+        """Bits.from_buffer()"""
+        import mmap
+
+        buf = bytes([0b10100101, 0b11110000])
+        self.assertEqual(Bits.from_buffer(buf), Bits.from_bytes(buf))
+        self.assertEqual(Bits.from_buffer(memoryview(buf), 4, 2), Bits([1,0,0,1]))
+        self.assertEqual(Bits.from_buffer(bytearray(buf), offset=6), Bits([0,1,1,1,1,1,0,0,0,0]))
+        self.assertEqual(Bits.from_buffer(buf, 0, 16), Bits())
+
+        m = mmap.mmap(-1, len(buf))
+        m.write(buf)
+        b = Bits.from_buffer(m, 12)
+        self.assertEqual(b, Bits([1,0,1,0,0,1,0,1,1,1,1,1]))
+        self.assertEqual(BitsSerializer.serialize(b), BitsSerializer.serialize(Bits(tuple(b))))
+        del b
+
+        with self.assertRaises(TypeError):
+            Bits.from_buffer(buf, 1.0)
+        with self.assertRaises(TypeError):
+            Bits.from_buffer(buf, 1, 1.0)
+        with self.assertRaises(ValueError):
+            Bits.from_buffer(buf, 17)
+        with self.assertRaises(ValueError):
+            Bits.from_buffer(buf, 10, 7)
+        with self.assertRaises(ValueError):
+            Bits.from_buffer(buf, -1)
+        with self.assertRaises(ValueError):
+            Bits.from_buffer(buf, offset=17)
+
     def test___hash__(self):
         """__hash__() special method"""
 
@@ -334,3 +408,124 @@ class Test_Bits(unittest.TestCase):
                     not_b = ~b
                     self.assertEqual(not_a.common_prefix(not_b), not_common_prefix)
                     self.assertEqual(not_b.common_prefix(not_a), not_common_prefix)
+
+    def test_ops_vs_tuples(self):
+        """Concatenation, inversion, startswith and common_prefix match tuple equivalents"""
+        import random
+        rand = random.Random(0)
+
+        def rand_bits(n):
+            # Random garbage in the unused tail bits too
+            bits = tuple(rand.getrandbits(1) for i in range(n))
+            buf = bytearray(Bits(bits)._Bits__buf)
+            if n % 8:
+                buf[-1] |= rand.getrandbits(8 - n % 8)
+            return bits, Bits.from_bytes(bytes(buf), n)
+
+        for i in range(500):
+            a_tuple, a = rand_bits(rand.randrange(0, 70))
+            b_tuple, b = rand_bits(rand.randrange(0, 70))
+            if rand.getrandbits(1):
+                # share a prefix
+                b_tuple = a_tuple[:rand.randrange(0, len(a_tuple) + 1)] + b_tuple
+                b = Bits(b_tuple)
+
+            self.assertEqual(tuple(a + b), a_tuple + b_tuple)
+            self.assertEqual(tuple(~a), tuple(1 - bit for bit in a_tuple))
+            self.assertEqual(b.startswith(a), b_tuple[:len(a_tuple)] == a_tuple)
+
+            l = 0
+            while l < min(len(a_tuple), len(b_tuple)) and a_tuple[l] == b_tuple[l]:
+                l += 1
+            self.assertEqual(tuple(a.common_prefix(b)), a_tuple[:l])
+            self.assertEqual(a.common_prefix(b), b.common_prefix(a))
+
+class Test_BitsSerializer(unittest.TestCase):
+    def test_serialization(self):
+        """BitsSerializer round-trip and serialized_size()"""
+        for l in range(20):
+            b = Bits([i % 3 == 0 for i in range(l)])
+            serialized = BitsSerializer.serialize(b)
+            self.assertEqual(BitsSerializer.serialized_size(b), len(serialized))
+            self.assertEqual(BitsSerializer.deserialize(serialized), b)
+
+    def test_serialize_view(self):
+        """Byte-aligned views are serialized without copying"""
+        buf = bytearray(range(256))*4
+        b = Bits.from_buffer(buf)
+        for view in (b, b[8:], b[8:8*1000 + 3]):
+            ctx = proofmarshal.serialize.SegmentedSerializationContext(min_segment_size=512)
+            BitsSerializer.ctx_serialize(view, ctx)
+            segments = ctx.getsegments()
+            self.assertIsInstance(segments[1], memoryview)
+            self.assertIs(segments[1].obj, buf)
+            self.assertEqual(b''.join(segments), BitsSerializer.serialize(view))
+
+        # Unaligned views are still serialized correctly
+        view = b[3:8*1000]
+        self.assertEqual(BitsSerializer.deserialize(BitsSerializer.serialize(view)), view)
+
+    def test_invalid_deserialization(self):
+        with self.assertRaises(proofmarshal.serialize.DeserializationError):
+            BitsSerializer.deserialize(b'\x01\xff')
+
+class Test_sort_keys(unittest.TestCase):
+    def check_sort_keys(self):
+        import os
+
+        def T(keys):
+            sorted_keys, common_prefix_lengths = sort_keys(keys)
+            self.assertEqual(sorted_keys, sorted(keys))
+
+            sorted_bits = sorted(Bits.from_bytes(key) for key in keys)
+            self.assertEqual([Bits.from_bytes(key) for key in sorted_keys], sorted_bits)
+            self.assertEqual(common_prefix_lengths,
+                             [len(a.common_prefix(b)) for a, b in zip(sorted_bits, sorted_bits[1:])])
+
+            # Same result from an iterator
+            self.assertEqual(sort_keys(iter(keys)), (sorted_keys, common_prefix_lengths))
+
+            # Same result from a buffer of concatenated keys
+            if keys:
+                self.assertEqual(sort_keys(b''.join(keys), len(keys[0])),
+                                 (sorted_keys, common_prefix_lengths))
+
+        T([])
+        T([b'\x00'])
+        T([b'\xff', b'\x00', b'\x80', b'\x81', b'\x00'])
+        for n in (NUMPY_MIN_KEYS - 1, NUMPY_MIN_KEYS, 500):
+            T([os.urandom(4) for i in range(n)])
+
+            # Keys sharing long prefixes, and duplicates
+            keys = [b'\x00'*30 + os.urandom(2) for i in range(n)]
+            T(keys + keys[:10])
+
+    def test_sort_keys(self):
+        """sort_keys() matches sorting Bits and common_prefix()"""
+        self.check_sort_keys()
+
+    def test_without_numpy(self):
+        """The pure Python version is used when numpy is missing"""
+        with unittest.mock.patch.object(proofmarshal.bits, 'numpy', None), \
+             unittest.mock.patch.object(proofmarshal.bits, '_sort_keys_numpy') as sort_keys_numpy:
+            self.check_sort_keys()
+
+        sort_keys_numpy.assert_not_called()
+
+    @unittest.skipIf(proofmarshal.bits.numpy is None, 'numpy not installed')
+    def test_with_numpy(self):
+        """The numpy version is used, when available, even for few keys"""
+        with unittest.mock.patch.object(proofmarshal.bits, 'NUMPY_MIN_KEYS', 1), \
+             unittest.mock.patch.object(proofmarshal.bits, '_sort_keys_numpy',
+                                        wraps=proofmarshal.bits._sort_keys_numpy) as sort_keys_numpy:
+            self.check_sort_keys()
+
+        self.assertTrue(sort_keys_numpy.called)
+
+    def test_invalid(self):
+        with self.assertRaises(ValueError):
+            sort_keys([b'\x00', b'\x00\x00'])
+        with self.assertRaises(ValueError):
+            sort_keys(b'\x00'*3, 2)
+        with self.assertRaises(ValueError):
+            sort_keys(b'\x00'*3, 0)
@@ -0,0 +1,200 @@
+# Copyright (C) 2015 Peter Todd <pete@petertodd.org>
+#
+# This file is part of python-proofmarshal.
+#
+# It is subject to the license terms in the LICENSE file found in the top-level
+# directory of this distribution.
+#
+# No part of python-proofmarshal, including this file, may be copied, modified,
+# propagated, or distributed except according to the terms contained in the
+# LICENSE file.
+
+import random
+import unittest
+
+from proofmarshal.cache import NodeCache, LRUPolicy, GreedyDualSizePolicy
+from proofmarshal.test.test_merbinnertree import IntMBTree
+from proofmarshal.test.test_proof import BarProof, FooProof
+from proofmarshal.test.test_store import CountingProofStore
+
+class Test_policies(unittest.TestCase):
+    def test_lru(self):
+        policy = LRUPolicy()
+        for key in 'abc':
+            policy.add(key, 1)
+        policy.touch('a')
+        self.assertEqual([policy.pop_victim() for i in range(3)], ['b', 'c', 'a'])
+
+    def test_greedy_dual_size(self):
+        policy = GreedyDualSizePolicy()
+        policy.add('small', 1)
+        policy.add('large', 100)
+        policy.add('medium', 10)
+        self.assertEqual(policy.pop_victim(), 'large')
+
+        # Nodes that aren't used are eventually evicted, even if small.
+        policy = GreedyDualSizePolicy()
+        policy.add('small', 1)
+        for i in range(200):
+            policy.add(i, 100)
+            victim = policy.pop_victim()
+            if victim == 'small':
+                break
+            self.assertEqual(victim, i)
+        self.assertGreater(i, 50)
+
+    def test_greedy_dual_size_bounded(self):
+        """Repeated uses don't grow the heap without bound"""
+        policy = GreedyDualSizePolicy()
+        policy.add('a', 1)
+        policy.add('b', 10)
+        for i in range(10000):
+            policy.touch('a')
+            self.assertLessEqual(len(policy.heap), 4)
+        self.assertEqual(policy.pop_victim(), 'b')
+        self.assertEqual(policy.pop_victim(), 'a')
+
+class Test_NodeCache(unittest.TestCase):
+    def test_eviction(self):
+        """Nodes are evicted to stay within the budget"""
+        for policy in (LRUPolicy(), GreedyDualSizePolicy()):
+            cache = NodeCache(10, policy)
+            nodes = [FooProof(n=i) for i in range(10)]
+            for node in nodes:
+                cache.add(node, 3)
+
+            self.assertEqual(len(cache), 3)
+            self.assertEqual(cache.resident_bytes, 9)
+            self.assertEqual(cache.evictions, 7)
+
+            # Evicted nodes are still found while in use
+            self.assertIs(cache.get(nodes[0].hash), nodes[0])
+            self.assertEqual(cache.hits, 1)
+
+            n_hash = nodes[0].hash
+            del nodes
+            self.assertIsNone(cache.get(n_hash))
+            self.assertEqual(cache.misses, 1)
+            self.assertEqual(cache.hit_rate, 0.5)
+
+    def test_oversized(self):
+        """Nodes larger than the budget aren't kept"""
+        cache = NodeCache(10)
+        cache.add(FooProof(n=1), 11)
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.resident_bytes, 0)
+
+    def test_store(self):
+        """Caching nodes loaded from a store"""
+        cache = NodeCache(1000000)
+        store = CountingProofStore()
+        store.cache = cache
+
+        m = IntMBTree()
+        for i in range(64):
+            m = m.put(bytes([i*4])*32, i)
+        store.commit(m)
+
+        m2 = store.load(IntMBTree, m.hash)
+        self.assertEqual(list(m2.items()), list(m.items()))
+        self.assertEqual(len(cache), len(store))
+        self.assertEqual(cache.resident_bytes, sum(len(store.get_record(h)) for h in store))
+        reads = store.reads
+
+        # Loading again doesn't read anything
+        del m2
+        m3 = store.load(IntMBTree, m.hash)
+        self.assertEqual(list(m3.items()), list(m.items()))
+        self.assertEqual(store.reads, reads)
+
+    def test_store_bounded(self):
+        """Memory use is bounded, even while the whole tree is in use"""
+        cache = NodeCache(2000)
+        store = CountingProofStore()
+        store.cache = cache
+
+        m = IntMBTree()
+        for i in range(200):
+            m = m.put(bytes([i])*32, i)
+        store.commit(m)
+
+        m2 = store.load(IntMBTree, m.hash)
+        for i in range(200):
+            self.assertEqual(m2[bytes([i])*32], i)
+            self.assertLessEqual(cache.resident_bytes, 2000)
+
+            # Evicted nodes let go of their children, so only the cached
+            # nodes, their children, and the root can be in use.
+            self.assertLessEqual(len(cache.in_use), 3*len(cache) + 1)
+        self.assertGreater(cache.evictions, 0)
+        self.assertLess(len(cache.in_use), len(store) // 4)
+
+        # Unloaded nodes are loaded again when used
+        reads = store.reads
+        self.assertEqual(list(m2.items()), list(m.items()))
+        self.assertGreater(store.reads, reads)
+        self.assertIs(store.load(IntMBTree, m.hash), m2)
+
+    def test_store_residency(self):
+        """The upper levels of a tree in use stay loaded under a tight budget"""
+        m = IntMBTree()
+        for i in range(256):
+            m = m.put(bytes([i])*32, i)
+
+        for policy in (LRUPolicy(), GreedyDualSizePolicy()):
+            store = CountingProofStore()
+            store.commit(m)
+            store.cache = NodeCache(sum(len(store.get_record(h)) for h in store) // 4, policy)
+
+            m2 = store.load(IntMBTree, m.hash)
+            m2.prefix
+            upper = (m2, m2.left, m2.right)
+            m2.left.prefix
+            m2.right.prefix
+
+            rng = random.Random(0)
+            for i in range(1000):
+                k = rng.randrange(256)
+                self.assertEqual(m2[bytes([k])*32], k)
+                for node in upper:
+                    self.assertIn(node.hash, store.cache.entries)
+            self.assertGreater(store.cache.evictions, 0)
+
+    def test_store_oversized(self):
+        """Nodes too big for the cache aren't left loaded"""
+        for policy in (LRUPolicy(), GreedyDualSizePolicy()):
+            cache = NodeCache(30, policy)
+            store = CountingProofStore()
+            store.cache = cache
+
+            m = IntMBTree()
+            for i in range(200):
+                m = m.put(bytes([i])*32, i)
+            store.commit(m)
+            self.assertGreater(min(len(store.get_record(h)) for h in store), 30)
+
+            m2 = store.load(IntMBTree, m.hash)
+            for i in range(200):
+                self.assertEqual(m2[bytes([i])*32], i)
+                self.assertEqual(len(cache), 0)
+                self.assertLessEqual(len(cache.in_use), 2)
+
+    def test_store_evicted_on_load(self):
+        """Nodes evicted as soon as they're loaded don't keep the child used"""
+        cache = NodeCache(0)
+        store = CountingProofStore()
+        store.cache = cache
+
+        b = BarProof(left=FooProof(n=1), right=FooProof(n=2), nonproof_attr=3)
+        store.commit(b)
+
+        b2 = store.load(BarProof, b.hash)
+        self.assertEqual(b2.left.n, 1)
+        self.assertNotIn(b2.hash, cache.entries)
+        self.assertNotIn('left', b2.__dict__)
+        self.assertNotIn('right', b2.__dict__)
+        self.assertEqual(len(cache.in_use), 1)
+
+        # Loaded again when used
+        self.assertEqual(b2.right.n, 2)
+
@@ -0,0 +1,148 @@
+# Copyright (C) 2015 Peter Todd <pete@petertodd.org>
+#
+# This file is part of python-proofmarshal.
+#
+# It is subject to the license terms in the LICENSE file found in the top-level
+# directory of this distribution.
+#
+# No part of python-proofmarshal, including this file, may be copied, modified,
+# propagated, or distributed except according to the terms contained in the
+# LICENSE file.
+
+import os
+import unittest
+import unittest.mock
+
+import proofmarshal.collect
+from proofmarshal.collect import GarbageCollector, collect, compact
+from proofmarshal.store import MemoryProofStore, SQLiteProofStore, record_class, record_refs
+from proofmarshal.test import temp_path
+from proofmarshal.test.test_merbinnertree import IntMBTree
+from proofmarshal.test.test_mmr import IntMMR
+
+def make_versions(n):
+    versions = [IntMBTree()]
+    for i in range(n):
+        versions.append(versions[-1].put(bytes([i*4])*32, i))
+    return versions
+
+class Test_collect(unittest.TestCase):
+    def setUp(self):
+        self.path = temp_path(self)
+
+    def make_stores(self):
+        yield MemoryProofStore()
+        with SQLiteProofStore(self.path) as store:
+            yield store
+
+    def test_collect(self):
+        """Unreachable nodes are removed"""
+        for store in self.make_stores():
+            versions = make_versions(32)
+            for m in versions:
+                store.commit(m)
+            mmr = IntMMR(range(10))
+            store.commit(mmr)
+
+            # Only the nodes of the kept versions remain
+            keep = MemoryProofStore()
+            keep.commit(versions[-1])
+            keep.commit(versions[10])
+            keep.commit(mmr)
+
+            n = len(store)
+            self.assertEqual(collect(store, [(IntMBTree, versions[-1].hash),
+                                             (IntMBTree, versions[10].hash),
+                                             (IntMMR, mmr.hash)]),
+                             n - len(keep))
+            self.assertEqual(set(store), set(keep))
+
+            for m in (versions[-1], versions[10]):
+                self.assertEqual(list(store.load(IntMBTree, m.hash).items()), list(m.items()))
+            self.assertEqual(list(store.load(IntMMR, mmr.hash)), list(mmr))
+            self.assertIsNone(store.collector)
+
+            # Collecting everything
+            collect(store, [])
+            self.assertEqual(len(store), 0)
+
+    def test_incremental(self):
+        """Collection interleaved with commits"""
+        for store in self.make_stores():
+            versions = make_versions(32)
+            for m in versions[:16]:
+                store.commit(m)
+
+            collector = GarbageCollector(store, [(IntMBTree, versions[8].hash)])
+            with self.assertRaises(ValueError):
+                GarbageCollector(store)
+
+            self.assertFalse(collector.mark(5))
+
+            # New versions share nodes with old ones that haven't been marked.
+            for m in versions[16:]:
+                store.commit(m)
+
+            while not collector.sweep(10):
+                pass
+            self.assertGreater(collector.swept, 0)
+            self.assertIsNone(store.collector)
+
+            for m in (versions[8], versions[-1]):
+                self.assertEqual(list(store.load(IntMBTree, m.hash).items()), list(m.items()))
+
+    def test_compact(self):
+        for store in self.make_stores():
+            versions = make_versions(32)
+            for m in versions:
+                store.commit(m)
+
+            with SQLiteProofStore(self.path + '.2') as dest:
+                roots = [(IntMBTree, versions[-1].hash), (IntMBTree, versions[5].hash)]
+                n = compact(store, iter(roots), dest)
+                self.assertEqual(n, len(dest))
+
+                for m in (versions[-1], versions[5]):
+                    self.assertEqual(list(dest.load(IntMBTree, m.hash).items()), list(m.items()))
+
+                # Depth-first order, starting from the first root, with
+                # children before parents
+                order = {proof_hash:i for i, proof_hash in enumerate(dest)}
+                leaf = versions[-1]
+                while leaf.__class__ is IntMBTree.InnerNodeClass:
+                    leaf = leaf.left
+                self.assertEqual(order[leaf.hash], 0)
+                self.assertLess(order[versions[-1].hash], order[versions[5].hash])
+
+                for proof_hash in order:
+                    record = dest.get_record(proof_hash)
+                    for cls, child_hash in record_refs(record_class(IntMBTree, record), record):
+                        self.assertLess(order[child_hash], order[proof_hash])
+
+                collect(store, roots)
+                self.assertEqual(set(store), set(dest))
+
+            os.unlink(self.path + '.2')
+
+    def test_compact_interrupted(self):
+        """An interrupted compaction leaves no nodes without their children"""
+        class FailingProofStore(MemoryProofStore):
+            def _put_records(self, records):
+                if len(self):
+                    raise IOError('disk full')
+                super()._put_records(records)
+
+        versions = make_versions(32)
+        store = MemoryProofStore()
+        store.commit(versions[-1])
+
+        dest = FailingProofStore()
+        with unittest.mock.patch.object(proofmarshal.collect, 'COMPACT_BATCH_SIZE', 10):
+            with self.assertRaises(IOError):
+                compact(store, [(IntMBTree, versions[-1].hash)], dest)
+
+        self.assertEqual(len(dest), 10)
+        for proof_hash in dest:
+            record = dest.get_record(proof_hash)
+            for cls, child_hash in record_refs(record_class(IntMBTree, record), record):
+                self.assertIn(child_hash, dest)
@@ -0,0 +1,137 @@
+# Copyright (C) 2015 Peter Todd <pete@petertodd.org>
+#
+# This file is part of python-proofmarshal.
+#
+# It is subject to the license terms in the LICENSE file found in the top-level
+# directory of this distribution.
+#
+# No part of python-proofmarshal, including this file, may be copied, modified,
+# propagated, or distributed except according to the terms contained in the
+# LICENSE file.
+
+import pickle
+import unittest
+
+from proofmarshal.collect import collect
+from proofmarshal.fsck import fsck, _class_ref, _from_class_ref
+from proofmarshal.store import MemoryProofStore, SQLiteProofStore, encode_record
+from proofmarshal.test import temp_path
+from proofmarshal.test.test_merbinnertree import IntMBTree
+from proofmarshal.test.test_mmr import IntMMR
+
+def make_tree(n):
+    m = IntMBTree()
+    for i in range(n):
+        m = m.put(bytes([i*4])*32, i)
+    return m
+
+class Test_fsck(unittest.TestCase):
+    def setUp(self):
+        self.path = temp_path(self)
+
+    def test_class_ref(self):
+        for cls in (IntMBTree, IntMBTree.InnerNodeClass, IntMMR):
+            ref = pickle.loads(pickle.dumps(_class_ref(cls)))
+            self.assertIs(_from_class_ref(ref), cls)
+
+    def test_fsck(self):
+        m = make_tree(64)
+        mmr = IntMMR(range(20))
+        roots = [(IntMBTree, m.hash), (IntMMR, mmr.hash)]
+
+        store = MemoryProofStore()
+        store.commit(m)
+        store.commit(mmr)
+
+        for max_workers in (1, 2):
+            errors, checkpoint = fsck(store, roots, max_workers=max_workers)
+            self.assertEqual(errors, [])
+            self.assertEqual(checkpoint, len(store))
+
+        # Corrupt a leaf, and remove another node
+        leaf = m
+        leaf_path = (m.hash,)
+        while leaf.__class__ is IntMBTree.InnerNodeClass:
+            leaf = leaf.left
+            leaf_path += ('left',)
+        bad_leaf = IntMBTree.LeafNodeClass(leaf.key, leaf.value + 1)
+        store.records[leaf.hash] = encode_record(bad_leaf)
+        del store.records[m.right.right.hash]
+        store.records[mmr.hash] = b'\x7f'
+
+        for max_workers in (1, 2):
+            errors, checkpoint = fsck(store, roots, max_workers=max_workers)
+            self.assertEqual(sorted(errors),
+                             sorted([(leaf.hash, leaf_path, 'hash mismatch'),
+                                     (m.right.right.hash, (m.hash, 'right', 'right'), 'missing'),
+                                     (mmr.hash, (mmr.hash,), 'corrupt record: bad union class number 127')]))
+
+    def test_shared_subtrees(self):
+        """Subtrees shared between proofs are only checked once"""
+        m = make_tree(64)
+        roots = [(IntMBTree, m.hash)]
+        store = MemoryProofStore()
+        store.commit(m)
+        for i in range(8):
+            m2 = m.put(bytes([i*32 + 1])*32, 100 + i)
+            store.commit(m2)
+            roots.append((IntMBTree, m2.hash))
+
+        # Corrupt every leaf, as all are shared by some of the proofs
+        leaves = []
+        for h in store:
+            node = store.load(IntMBTree, h)
+            if node.__class__ is IntMBTree.LeafNodeClass:
+                leaves.append(h)
+                store.records[h] = encode_record(IntMBTree.LeafNodeClass(node.key, node.value + 1))
+
+        for max_workers in (1, 2):
+            errors, checkpoint = fsck(store, roots, max_workers=max_workers)
+            self.assertEqual(sorted(h for h, path, reason in errors), sorted(leaves))
+
+    def test_checkpoint(self):
+        """Checking only the nodes added since a checkpoint"""
+        with SQLiteProofStore(self.path) as store:
+            m = make_tree(32)
+            store.commit(m)
+            errors, checkpoint = fsck(store, [(IntMBTree, m.hash)], max_workers=2)
+            self.assertEqual(errors, [])
+
+            # Old nodes aren't checked again, so corruption of them is missed.
+            leaf = m.right.right.right
+            with store.conn:
+                store.conn.execute('UPDATE nodes SET record = ? WHERE hash = ?', (b'', leaf.hash))
+
+            m2 = m.put(b'\x01'*32, 100)
+            store.commit(m2)
+            errors, checkpoint2 = fsck(store, [(IntMBTree, m2.hash)], since=checkpoint, max_workers=2)
+            self.assertEqual(errors, [])
+            self.assertGreater(checkpoint2, checkpoint)
+
+            errors, checkpoint3 = fsck(store, [(IntMBTree, m2.hash)], max_workers=2)
+            self.assertEqual(len(errors), 1)
+            self.assertEqual(errors[0][0], leaf.hash)
+            self.assertEqual(checkpoint3, checkpoint2)
+
+    def test_checkpoint_after_collect(self):
+        """Nodes added after garbage collection are checked"""
+        with SQLiteProofStore(self.path) as store:
+            a = make_tree(16)
+            b = a.put(b'\x01'*32, 100)
+            store.commit(a)
+            store.commit(b)
+            errors, checkpoint = fsck(store, [(IntMBTree, a.hash), (IntMBTree, b.hash)], max_workers=1)
+            self.assertEqual(errors, [])
+
+            # Removes the newest nodes
+            collect(store, [(IntMBTree, a.hash)])
+
+            c = a.put(b'\x02'*32, 200)
+            store.commit(c)
+            with store.conn:
+                store.conn.execute('UPDATE nodes SET record = ? WHERE hash = ?', (b'\xff'*8, c.hash))
+
+            for max_workers in (1, 2):
+                errors, checkpoint2 = fsck(store, [(IntMBTree, c.hash)], since=checkpoint, max_workers=max_workers)
+                self.assertEqual([(h, path) for h, path, reason in errors], [(c.hash, (c.hash,))])
+                self.assertGreater(checkpoint2, checkpoint)
@@ -0,0 +1,120 @@
+# Copyright (C) 2015 Peter Todd <pete@petertodd.org>
+#
+# This file is part of python-proofmarshal.
+#
+# It is subject to the license terms in the LICENSE file found in the top-level
+# directory of this distribution.
+#
+# No part of python-proofmarshal, including this file, may be copied, modified,
+# propagated, or distributed except according to the terms contained in the
+# LICENSE file.
+
+import mmap
+import unittest
+import unittest.mock
+
+import proofmarshal.lazy
+from proofmarshal.lazy import lazy_deserialize, build_index
+from proofmarshal.proof import PrunedError
+from proofmarshal.test.test_mmr import IntMMR
+from proofmarshal.test.test_merbinnertree import IntMBTree
+from proofmarshal.test.test_proof import FooProof, BarProof, Blake2LeafProof, Blake2InnerProof
+
+def is_loaded(proof, name):
+    try:
+        object.__getattribute__(proof, name)
+    except AttributeError:
+        return False
+    return True
+
+class Test_lazy_deserialize(unittest.TestCase):
+    def test_mmr(self):
+        """Lazy deserialization of MMRs"""
+        m = IntMMR(range(37))
+        serialized = m.serialize()
+
+        for index in (None, build_index(IntMMR, serialized)):
+            lazy_m = lazy_deserialize(IntMMR, serialized, index)
+            self.assertIs(lazy_m.__class__, m.__class__)
+
+            # Only the accessed path is loaded
+            self.assertEqual(lazy_m[5], 5)
+            self.assertTrue(is_loaded(lazy_m.left.left, 'left'))
+            self.assertFalse(is_loaded(lazy_m.left.left, 'right'))
+            self.assertFalse(is_loaded(lazy_m, 'right'))
+
+            self.assertEqual(len(lazy_m), 37)
+            self.assertEqual(list(lazy_m), list(range(37)))
+            self.assertFalse(lazy_m.is_pruned)
+            self.assertEqual(lazy_m.hash, m.hash)
+            self.assertEqual(lazy_m.serialize(), serialized)
+
+    def test_buffers(self):
+        """Lazy deserialization from memoryviews and mmaps"""
+        t = IntMBTree((bytes([i])*32, i) for i in range(20))
+        serialized = t.serialize()
+
+        m = mmap.mmap(-1, len(serialized))
+        m.write(serialized)
+
+        for buf in (memoryview(serialized), m):
+            lazy_t = lazy_deserialize(IntMBTree, buf)
+            self.assertEqual(lazy_t[bytes([7])*32], 7)
+            self.assertEqual(lazy_t, t)
+
+    def test_pruned(self):
+        """Lazy deserialization of pruned proofs"""
+        b = BarProof(left=FooProof(n=1), right=FooProof(n=2), nonproof_attr=3).prune()
+        b.left.n
+        serialized = b.serialize()
+
+        lazy_b = lazy_deserialize(BarProof, serialized)
+        self.assertFalse(lazy_b.is_fully_pruned)
+        self.assertTrue(lazy_b.is_pruned)
+        self.assertEqual(lazy_b.nonproof_attr, 3)
+        self.assertEqual(lazy_b.left.n, 1)
+        self.assertFalse(lazy_b.left.is_pruned)
+        self.assertTrue(lazy_b.right.is_fully_pruned)
+        with self.assertRaises(PrunedError):
+            lazy_b.right.n
+        self.assertEqual(lazy_b, b)
+
+        # Fully pruned top-level proof
+        lazy_f = lazy_deserialize(FooProof, FooProof(n=1).prune().serialize())
+        self.assertTrue(lazy_f.is_fully_pruned)
+
+        # Pruning a lazily deserialized proof
+        pruned = lazy_deserialize(BarProof, serialized).prune()
+        self.assertEqual(pruned.left.n, 1)
+        self.assertTrue(pruned.is_pruned)
+
+    def test_is_pruned_scans_once(self):
+        """Checking if every node is pruned scans each node once"""
+        m = IntMMR(range(256))
+        serialized = m.serialize()
+
+        def walk(proof):
+            self.assertFalse(proof.is_pruned)
+            if hasattr(proof, 'left'):
+                return 1 + walk(proof.left) + walk(proof.right)
+            return 1
+
+        with unittest.mock.patch.object(proofmarshal.lazy, '_concrete_class',
+                                        wraps=proofmarshal.lazy._concrete_class) as concrete_class:
+            n = walk(lazy_deserialize(IntMMR, serialized))
+
+        # Once to skip over it, once to deserialize it
+        self.assertLessEqual(concrete_class.call_count, 2*n)
+
+    def test_digest_length(self):
+        """Skipping fully pruned proofs with other digest lengths"""
+        inner = Blake2InnerProof(left=Blake2LeafProof(value=1), right=Blake2LeafProof(value=2))
+        pruned = inner.prune()
+        pruned.right.value
+        serialized = pruned.serialize()
+
+        for index in (None, build_index(Blake2InnerProof, serialized)):
+            lazy_inner = lazy_deserialize(Blake2InnerProof, serialized, index)
+            self.assertEqual(lazy_inner.right.value, 2)
+            self.assertTrue(lazy_inner.is_pruned)
+            self.assertEqual(lazy_inner.hash, inner.hash)
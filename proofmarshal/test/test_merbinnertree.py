@@ -9,11 +9,12 @@
 # propagated, or distributed except according to the terms contained in the
 # LICENSE file.
 
+import hashlib
 import itertools
 import unittest
 
 from proofmarshal.merbinnertree import MerbinnerTree, make_MerbinnerTree_subclass
-from proofmarshal.serialize import UInt64, Digest, HashTag
+from proofmarshal.serialize import UInt64, Digest, HashTag, DeserializationError
 from proofmarshal.bits import Bits
 
 def str_tree(tip):
@@ -241,3 +242,59 @@ class Test_MerbinnerTree(unittest.TestCase):
         for a in all_subsets(n):
             for b in all_subsets(n):
                 self.assertEqual(a.issubset(b), set(a.values()).issubset(set(b.values())))
+
+    def test_serialized_size(self):
+        """serialized_size() of trees, pruned and unpruned"""
+        m = IntMBTree()
+        for i in range(16):
+            m = m.put(bytes([i*16])*32, i)
+            self.assertEqual(m.serialized_size(), len(m.serialize()))
+
+        pruned = m.prune()
+        pruned[bytes([0])*32]
+        self.assertEqual(pruned.serialized_size(), len(pruned.serialize()))
+
+    def test_compact_serialization(self):
+        """Compact serialization round-trips and is smaller"""
+        m = IntMBTree()
+        self.assertEqual(IntMBTree.deserialize_compact(m.serialize_compact()), m)
+
+        for i in range(64):
+            m = m.put(hashlib.sha256(bytes([i])).digest(), i)
+
+            serialized = m.serialize_compact()
+            m2 = IntMBTree.deserialize_compact(serialized)
+            self.assertEqual(m2.hash, m.hash)
+            self.assertEqual(list(m2.items()), list(m.items()))
+            self.assertLessEqual(len(serialized), len(m.serialize()))
+        self.assertLess(len(serialized), len(m.serialize()))
+
+        # Prefixes are reconstructed in full
+        self.assertEqual(m2.left.left.prefix, m.left.left.prefix)
+
+        # Pruned trees round-trip with the same hash
+        key = hashlib.sha256(bytes([5])).digest()
+        pruned = m.prune()
+        pruned[key]
+        pruned2 = IntMBTree.deserialize_compact(pruned.serialize_compact())
+        self.assertEqual(pruned2[key], 5)
+        self.assertEqual(pruned2.hash, m.hash)
+        self.assertEqual(pruned2.serialize(), pruned.serialize())
+
+        # Fully pruned nodes of unknown variant give the same result as the
+        # standard format
+        pruned3 = IntMBTree.deserialize(pruned.serialize())
+        self.assertEqual(IntMBTree.deserialize_compact(pruned3.serialize_compact()).hash, pruned3.hash)
+
+    def test_compact_invalid(self):
+        """Invalid compact serializations"""
+        m = IntMBTree([(b'\x00'*32, 0), (b'\xff'*32, 1)])
+        serialized = m.serialize_compact()
+        with self.assertRaises(DeserializationError):
+            IntMBTree.deserialize_compact(serialized + b'\x00')
+        with self.assertRaises(DeserializationError):
+            IntMBTree.deserialize_compact(serialized[:-1])
+        with self.assertRaises(DeserializationError):
+            IntMBTree.deserialize_compact(b'\x00\x03')
+        with self.assertRaises(DeserializationError):
+            IntMBTree.deserialize_compact(b'\x01\x04' + b'\x00'*32)
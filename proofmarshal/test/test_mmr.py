@@ -10,9 +10,11 @@
 # LICENSE file.
 
 import unittest
+import unittest.mock
 
 from proofmarshal.mmr import MerkleMountainRange, make_mmr_subclass
-from proofmarshal.serialize import UInt64, HashTag
+from proofmarshal.serialize import UInt64, HashTag, MemoizedSerializationContext, MemoizedDeserializationContext, \
+                                   PushDeserializer
 
 @make_mmr_subclass
 class IntMMR(MerkleMountainRange):
@@ -181,3 +183,62 @@ class Test_MerkleMountainRange(unittest.TestCase):
                          IntMMR.deserialize(bytes.fromhex('00' '010f')))
         self.assertEqual(IntMMR([0x0e, 0x0f]),
                          IntMMR.deserialize(bytes.fromhex('00' '02' '00010e' '00010f' '02')))
+
+    def test_memoized_serialize(self):
+        """Memoized serialization shares identical subtrees"""
+        m = IntMMR([0]*8)
+
+        ctx = MemoizedSerializationContext()
+        ctx.write_obj(m)
+        self.assertLess(len(ctx.getbytes()), len(m.serialize()))
+
+        m2 = MemoizedDeserializationContext(ctx.getbytes()).read_obj(IntMMR)
+        self.assertEqual(m2, m)
+        self.assertEqual(list(m2), [0]*8)
+        self.assertIs(m2.left.left, m2.left.right)
+
+    def test_serialized_size(self):
+        for n in range(10):
+            m = IntMMR(range(n))
+            self.assertEqual(m.serialized_size(), len(m.serialize()))
+
+    def test_serialize_many(self):
+        mmrs = [IntMMR(range(n)) for n in range(10)]
+        serialized = IntMMR.serialize_many(mmrs)
+        self.assertEqual(list(IntMMR.deserialize_many(serialized)), mmrs)
+
+    def test_push_deserialize(self):
+        mmrs = [IntMMR(range(n)) for n in range(10)]
+        serialized = b''.join(m.serialize() for m in mmrs)
+
+        p = PushDeserializer(IntMMR)
+        r = []
+        for i in range(0, len(serialized), 5):
+            r.extend(p.feed(serialized[i:i + 5]))
+        p.close()
+        self.assertEqual(r, mmrs)
+
+    def test_push_deserialize_work(self):
+        """Values already deserialized aren't deserialized again as more data arrives"""
+        mmr = IntMMR(range(2000))
+        serialized = mmr.serialize()
+
+        calls = []
+        orig_ctx_deserialize = UInt64.ctx_deserialize
+        def counting_ctx_deserialize(ctx):
+            calls.append(ctx.offset)
+            return orig_ctx_deserialize(ctx)
+
+        p = PushDeserializer(IntMMR)
+        r = []
+        with unittest.mock.patch.object(UInt64, 'ctx_deserialize', counting_ctx_deserialize):
+            n = 0
+            for i in range(0, len(serialized), 64):
+                r.extend(p.feed(serialized[i:i + 64]))
+                n += 1
+        p.close()
+        self.assertEqual(r, [mmr])
+
+        # Every leaf value and inner node length is deserialized once, plus at
+        # most one retry per chunk.
+        self.assertLessEqual(len(calls), 2*len(mmr) - 1 + n)
@@ -266,6 +266,84 @@ class Test_VarProof(unittest.TestCase):
                          HashTag('498430c5-4ed1-8dd5-3f09-97e0725c3407'))
 
 
+class Blake2HashTag64(HashTag):
+    HASH_FUNCTION = staticmethod(hashlib.blake2b)
+    DIGEST_LENGTH = 64
+
+class Blake2VarProof(VarProof):
+    HASHTAG = Blake2HashTag64('2e0ea466-e5b4-4d84-b0a6-c6b4d7a2c29b')
+
+@Blake2VarProof.declare_variant
+class LeafBlake2VarProof(Blake2VarProof):
+    SUB_HASHTAG = HashTag('a0b4b7f1-a2c5-4ddf-8ea6-3e5b7ff1ac2a')
+    SERIALIZED_ATTRS = [('value', UInt8)]
+
+@Blake2VarProof.declare_variant
+class InnerBlake2VarProof(Blake2VarProof):
+    SUB_HASHTAG = HashTag('f7d1e0a8-2a18-4a3e-8d7f-6c3c8f3d7c71')
+    SERIALIZED_ATTRS = [('left', Blake2VarProof),
+                        ('right', Blake2VarProof)]
+
+class Blake2LeafProof(Proof):
+    HASHTAG = Blake2HashTag64('6a1b5c62-5d8e-4d3f-9e4e-2a0e9b3c8f51')
+
+    __slots__ = ['value']
+    SERIALIZED_ATTRS = [('value', UInt8)]
+
+class Blake2InnerProof(Proof):
+    HASHTAG = Blake2HashTag64('b3e1d8a4-0c3f-4f52-a1d6-7e9c2b5f4a83')
+
+    __slots__ = ['left', 'right']
+    SERIALIZED_ATTRS = [('left',  Blake2LeafProof),
+                        ('right', Blake2LeafProof)]
+
+class Test_hash_function(unittest.TestCase):
+    def test_hashing(self):
+        """Proofs hash with their HASHTAG's hash function"""
+        self.assertIs(LeafBlake2VarProof.HASHTAG.__class__, Blake2HashTag64)
+
+        leaf = LeafBlake2VarProof(value=0x0f)
+        data_hash = hashlib.blake2b(b'\x0f').digest()
+        self.assertEqual(leaf.data_hash, data_hash)
+        self.assertEqual(leaf.hash, hashlib.blake2b(LeafBlake2VarProof.HASHTAG + data_hash).digest())
+
+        inner = InnerBlake2VarProof(left=leaf, right=leaf)
+        self.assertEqual(inner.data_hash, hashlib.blake2b(leaf.hash + leaf.hash).digest())
+
+    def test_fully_pruned(self):
+        """Fully pruned proofs use the digest length of their hash function"""
+        leaf = Blake2LeafProof(value=0x0f)
+        inner = Blake2InnerProof(left=leaf, right=Blake2LeafProof(value=0x10))
+        pruned = inner.prune()
+
+        serialized = pruned.serialize()
+        self.assertEqual(serialized, b'\xff' + inner.data_hash)
+        self.assertEqual(len(serialized), 1 + 64)
+        self.assertEqual(Blake2InnerProof.deserialize(serialized).hash, inner.hash)
+
+        pruned.right.value
+        serialized = pruned.serialize()
+        self.assertEqual(pruned.serialized_size(), len(serialized))
+        inner2 = Blake2InnerProof.deserialize(serialized)
+        self.assertEqual(inner2.hash, inner.hash)
+        self.assertEqual(inner2.right.value, 0x10)
+        with self.assertRaises(PrunedError):
+            inner2.left.value
+
+    def test_variant_hash_function(self):
+        """Variants use the hash function of their VarProof, not of SUB_HASHTAG"""
+        self.assertIs(LeafBlake2VarProof.SUB_HASHTAG.__class__, HashTag)
+        self.assertIs(LeafBlake2VarProof.HASHTAG.__class__, Blake2HashTag64)
+
+    def test_no_hashtag(self):
+        """Proofs without a HASHTAG have data hashes with the default hash function"""
+        class NoHashTagProof(Proof):
+            __slots__ = ['n']
+            SERIALIZED_ATTRS = [('n', UInt8)]
+
+        p = NoHashTagProof(n=1)
+        self.assertEqual(p.data_hash, hashlib.sha256(b'\x01').digest())
+
 class Test_ProofUnion(unittest.TestCase):
     Foo_or_Bar = ProofUnion(FooProof, BarProof)
 
@@ -312,3 +390,264 @@ class Test_ProofUnion(unittest.TestCase):
 
         self.assertEqual(self.Foo_or_Bar.get_hash(f1), f1.hash)
         self.assertEqual(self.Foo_or_Bar.get_hash(b1), b1.hash)
+
+class Test_generated_attr_functions(unittest.TestCase):
+    def test_generated(self):
+        """Proof subclasses get generated attribute functions"""
+        self.assertIn('_serialize_attrs', BarProof.__dict__)
+        self.assertIn('_deserialize_attrs', InnerFooVarProof.__dict__)
+        self.assertEqual(BarProof.SERIALIZED_ATTRS_BY_NAME,
+                         {'left':FooProof, 'right':FooProof, 'nonproof_attr':UInt8})
+
+    def test_generic_equivalence(self):
+        """Generated and generic attribute functions agree"""
+        b = BarProof(left=FooProof(n=1), right=FooProof(n=2).prune(), nonproof_attr=3)
+
+        generic = object.__new__(BarProof)
+        Proof._init_attrs(generic, dict(left=b.left, right=b.right, nonproof_attr=3))
+        self.assertEqual(generic.is_pruned, b.is_pruned)
+
+        generic_ctx = BytesSerializationContext()
+        Proof._serialize_attrs(b, generic_ctx)
+        ctx = BytesSerializationContext()
+        b._serialize_attrs(ctx)
+        self.assertEqual(ctx.getbytes(), generic_ctx.getbytes())
+
+        generic_hasher = hashlib.sha256()
+        Proof._hash_attrs(b, generic_hasher)
+        hasher = hashlib.sha256()
+        b._hash_attrs(hasher)
+        self.assertEqual(hasher.digest(), generic_hasher.digest())
+
+        serialized = b.serialize()[1:]
+        b2 = Proof._deserialize_attrs.__func__(BarProof, BytesDeserializationContext(serialized))
+        b3 = BarProof._deserialize_attrs(BytesDeserializationContext(serialized))
+        self.assertEqual(b2, b3)
+        self.assertEqual(b2.is_pruned, b3.is_pruned)
+
+    def test_explicit_override(self):
+        """Attribute functions defined by the class are kept"""
+        class OverridingProof(Proof):
+            HASHTAG = HashTag('0c7ea8b6-6a5f-4e47-9d0a-0a7a8b6e4d62')
+            SERIALIZED_ATTRS = [('n', UInt8)]
+
+            def _serialize_attrs(self, ctx):
+                ctx.write_varuint(self.n + 1)
+
+        self.assertEqual(OverridingProof(n=1).serialize(), b'\x00\x02')
+        self.assertIsNot(OverridingProof._init_attrs, Proof._init_attrs)
+
+    def test_inherited_override(self):
+        """Attribute functions inherited from a class that defines them are kept"""
+        class OverridingProof(Proof):
+            HASHTAG = HashTag('0c7ea8b6-6a5f-4e47-9d0a-0a7a8b6e4d62')
+            SERIALIZED_ATTRS = [('n', UInt8)]
+
+            def _serialize_attrs(self, ctx):
+                ctx.write_varuint(self.n + 1)
+
+        class DerivedProof(OverridingProof):
+            SERIALIZED_ATTRS = [('n', UInt8)]
+
+        self.assertIs(DerivedProof._serialize_attrs, OverridingProof._serialize_attrs)
+        self.assertEqual(DerivedProof(n=1).serialize(), b'\x00\x02')
+        self.assertIn('_init_attrs', DerivedProof.__dict__)
+
+    def test_deserialization_checked(self):
+        """Generated and generic deserialization check values alike"""
+        class EvenUInt8(UInt8):
+            @classmethod
+            def check_instance(cls, value):
+                super().check_instance(value)
+                if value % 2:
+                    raise SerializerValueError('Odd value %d' % value)
+
+        class EvenProof(Proof):
+            HASHTAG = HashTag('7d1c5a0e-3f2b-4e8a-9c6d-1b0e2f4a5c73')
+            SERIALIZED_ATTRS = [('n', EvenUInt8)]
+
+        self.assertIn('_deserialize_attrs', EvenProof.__dict__)
+        self.assertEqual(EvenProof.deserialize(b'\x00\x02').n, 2)
+        with self.assertRaises(SerializerValueError):
+            EvenProof._deserialize_attrs(BytesDeserializationContext(b'\x01'))
+        with self.assertRaises(SerializerValueError):
+            Proof._deserialize_attrs.__func__(EvenProof, BytesDeserializationContext(b'\x01'))
+
+    def test_self_referential(self):
+        """SERIALIZED_ATTRS set after the class is created"""
+        class ChainProof(Proof):
+            HASHTAG = HashTag('5b0e7c55-0b8e-4f7e-9f5e-8f0d6f4c2a11')
+            __slots__ = ['n', 'prev']
+
+        ChainProof.SERIALIZED_ATTRS = [('n', UInt8), ('prev', ChainProof)]
+        self.assertEqual(ChainProof.SERIALIZED_ATTRS_BY_NAME, {'n':UInt8, 'prev':ChainProof})
+        self.assertIn('_serialize_attrs', ChainProof.__dict__)
+
+        start = ChainProof.deserialize(b'\xff' + b'\x00'*32)
+        c = ChainProof(n=5, prev=ChainProof(n=4, prev=start))
+        self.assertEqual(c.prev.n, 4)
+
+        c2 = ChainProof.deserialize(c.serialize())
+        self.assertEqual(c2.hash, c.hash)
+        self.assertEqual(c2.prev.n, 4)
+        self.assertTrue(c2.is_pruned)
+
+        # Attributes can't be reused with the generic functions
+        ChainProof.SERIALIZED_ATTRS = [('n', UInt8), ('prev', ChainProof), ('n', UInt8)]
+        self.assertNotIn('_serialize_attrs', ChainProof.__dict__)
+
+class Test_memoized_serialization(unittest.TestCase):
+    def test_back_references(self):
+        """Repeated proofs are serialized as back-references"""
+        f = FooProof(n=1)
+        b = BarProof(left=f, right=FooProof(n=1), nonproof_attr=3)
+
+        ctx = MemoizedSerializationContext()
+        ctx.write_obj(b)
+        self.assertEqual(ctx.getbytes(),
+                         (b'\x00' + # new object
+                          b'\x00' + # not pruned
+                          b'\x00' + b'\x00\x01' + # left, new object
+                          b'\x01' + # right, same as object #0
+                          b'\x03'))
+
+        b2 = MemoizedDeserializationContext(ctx.getbytes()).read_obj(BarProof)
+        self.assertEqual(b2, b)
+        self.assertIs(b2.left, b2.right)
+
+    def test_pruned(self):
+        """Pruned proofs aren't used as back-references for unpruned ones"""
+        f = FooProof(n=1)
+        b = BarProof(left=f.prune(), right=f, nonproof_attr=3)
+
+        ctx = MemoizedSerializationContext()
+        ctx.write_obj(b)
+        b2 = MemoizedDeserializationContext(ctx.getbytes()).read_obj(BarProof)
+        self.assertTrue(b2.left.is_fully_pruned)
+        self.assertEqual(b2.right.n, 1)
+
+    def test_bad_back_reference(self):
+        with self.assertRaises(DeserializationError):
+            MemoizedDeserializationContext(b'\x01').read_obj(FooProof)
+
+    def test_mistyped_back_reference(self):
+        """Back-references must be to objects of the expected class"""
+        f = FooProof(n=1)
+        b = BarProof(left=f, right=FooProof(n=2), nonproof_attr=3)
+
+        ctx = MemoizedSerializationContext()
+        ctx.write_obj(b)
+        buf = ctx.getbytes()
+
+        dctx = MemoizedDeserializationContext(buf + b'\x00\x00\x01\x01\x04')
+        dctx.read_obj(BarProof)
+        self.assertIs(dctx.read_obj(BarProof).left, dctx.memo[0])
+
+        # Left referring back to object #2, a BarProof rather than a FooProof
+        dctx = MemoizedDeserializationContext(buf + b'\x00\x00\x03\x01\x04')
+        dctx.read_obj(BarProof)
+        with self.assertRaises(DeserializationError):
+            dctx.read_obj(BarProof)
+
+        # Any of the classes of a union may be referred back to
+        Foo_or_Bar = ProofUnion(FooProof, BarProof)
+        ctx = MemoizedSerializationContext()
+        ctx.write_obj(f)
+        ctx.write_obj(f, Foo_or_Bar)
+        dctx = MemoizedDeserializationContext(ctx.getbytes())
+        f2 = dctx.read_obj(FooProof)
+        self.assertIs(dctx.read_obj(Foo_or_Bar), f2)
+
+        dctx = MemoizedDeserializationContext(ctx.getbytes())
+        dctx.read_obj(FooProof)
+        with self.assertRaises(DeserializationError):
+            dctx.read_obj(ProofUnion(BarProof))
+
+class Test_serialized_size(unittest.TestCase):
+    def test_serialized_size(self):
+        """Proof.serialized_size()"""
+        def T(proof):
+            self.assertEqual(proof.serialized_size(), len(proof.serialize()))
+
+        f = FooProof(n=200)
+        b = BarProof(left=f, right=FooProof(n=2), nonproof_attr=3)
+        T(f)
+        T(b)
+
+        # Cached for unpruned proofs
+        self.assertEqual(b._Proof__serialized_size, len(b.serialize()))
+
+        # Fully and partially pruned
+        pruned = b.prune()
+        T(pruned)
+        self.assertEqual(pruned.nonproof_attr, 3)
+        T(pruned)
+        self.assertEqual(pruned.left.n, 200)
+        T(pruned)
+        T(FooProof.deserialize(b'\xff' + b'\x00'*32))
+
+        T(InnerFooVarProof(left=EmptyFooVarProof(), right=LeafFooVarProof(value=0xf)))
+
+        Foo_or_Bar = ProofUnion(FooProof, BarProof)
+        self.assertEqual(Foo_or_Bar.serialized_size(b), len(Foo_or_Bar.serialize(b)))
+
+class Test_serialize_segments(unittest.TestCase):
+    def test_serialize_segments(self):
+        """Proof.serialize_segments()"""
+        b = BarProof(left=FooProof(n=200), right=FooProof(n=2), nonproof_attr=3)
+        for proof in (b, b.prune(), FooProof.deserialize(b'\xff' + b'\x00'*32)):
+            self.assertEqual(b''.join(proof.serialize_segments()), proof.serialize())
+            self.assertEqual(b''.join(proof.serialize_segments(1)), proof.serialize())
+
+class Test_InternTable(unittest.TestCase):
+    def setUp(self):
+        self.table = InternTable()
+        FooProof.INTERN_TABLE = self.table
+        BarProof.INTERN_TABLE = self.table
+
+    def tearDown(self):
+        del FooProof.INTERN_TABLE
+        del BarProof.INTERN_TABLE
+
+    def test_construction(self):
+        """Equal proofs are interned on construction"""
+        f1 = FooProof(n=1)
+        self.assertIs(FooProof(n=1), f1)
+        self.assertIsNot(FooProof(n=2), f1)
+
+        b1 = BarProof(left=FooProof(n=1), right=FooProof(n=2), nonproof_attr=3)
+        b2 = BarProof(left=FooProof(n=1), right=FooProof(n=2), nonproof_attr=3)
+        self.assertIs(b1, b2)
+        self.assertIs(b1.left, f1)
+
+        # FooProof(n=2) was unused the first time, so was created twice.
+        self.assertEqual(self.table.hits, 5)
+        self.assertEqual(self.table.misses, 4)
+        self.assertEqual(self.table.hit_rate, 5/9)
+
+    def test_deserialization(self):
+        """Equal proofs are interned on deserialization"""
+        b = BarProof(left=FooProof(n=1), right=FooProof(n=2), nonproof_attr=3)
+
+        b2 = BarProof.deserialize(b.serialize())
+        self.assertIs(b2, b)
+
+        # Pruned proofs aren't interned
+        pruned_b = b.prune()
+        pruned_b.left.n
+        pruned_b2 = BarProof.deserialize(pruned_b.serialize())
+        self.assertIsNot(pruned_b2, b)
+        self.assertIs(pruned_b2.left, b.left)
+        self.assertIsNot(BarProof.deserialize(b'\xff' + b.data_hash), b)
+
+    def test_weak(self):
+        """Unused proofs are removed from the table"""
+        f = FooProof(n=1)
+        b = BarProof(left=f, right=FooProof(n=2), nonproof_attr=3)
+        self.assertEqual(len(self.table), 3)
+
+        del b
+        self.assertEqual(len(self.table), 1)
+
+        self.assertIs(FooProof(n=1), f)
+        self.assertEqual(self.table.hit_rate, 0.25)
@@ -11,8 +11,11 @@
 
 import hashlib
 import hmac
+import io
 import unittest
+import unittest.mock
 
+import proofmarshal.serialize
 from proofmarshal.serialize import *
 
 class Test_SerBool(unittest.TestCase):
@@ -136,3 +139,529 @@ class Test_VarBytes(unittest.TestCase):
             VarBytes(2,3).deserialize(b'\x02a')
         with self.assertRaises(DeserializationError):
             VarBytes(2,3).deserialize(b'\x02')
+
+class Test_UIntArray(unittest.TestCase):
+    def test_init(self):
+        with self.assertRaises(TypeError):
+            UIntArray(int, 1)
+        with self.assertRaises(TypeError):
+            UIntArray(UInt8, '1')
+        with self.assertRaises(ValueError):
+            UIntArray(UInt8, -1)
+
+    def test_check_instance(self):
+        with self.assertRaises(SerializerTypeError):
+            UIntArray(UInt8, 2).check_instance([1])
+        with self.assertRaises(SerializerTypeError):
+            UIntArray(UInt8, 2).check_instance((1, 'a'))
+
+        with self.assertRaises(SerializerValueError):
+            UIntArray(UInt8, 2).check_instance((1, 2, 3))
+        with self.assertRaises(SerializerValueError):
+            UIntArray(UInt8, 2).check_instance((256,))
+        with self.assertRaises(SerializerValueError):
+            UIntArray(UInt8, 2).check_instance((-1,))
+
+        UIntArray(UInt8, 2).check_instance(())
+        UIntArray(UInt8, 2).check_instance((0, 255))
+
+    def test_serialization(self):
+        def T(value, expected_serialized):
+            cls = UIntArray(UInt64, 10)
+
+            actual_serialized = cls.serialize(value)
+            self.assertEqual(expected_serialized, actual_serialized)
+            self.assertEqual(cls.serialized_size(value), len(actual_serialized))
+
+            self.assertEqual(cls.deserialize(actual_serialized), value)
+
+        T((), b'\x00')
+        T((0,), b'\x01\x00')
+        T((1, 127, 128), b'\x03\x01\x7f\x80\x01')
+        T((2**64-1,), b'\x01\xff\xff\xff\xff\xff\xff\xff\xff\xff\x01')
+
+    def test_invalid_deserialization(self):
+        with self.assertRaises(DeserializationError):
+            UIntArray(UInt8, 1).deserialize(b'\x02\x00\x00')
+        with self.assertRaises(DeserializationError):
+            UIntArray(UInt8, 1).deserialize(b'\x01\x80\x02')
+        with self.assertRaises(TruncationError):
+            UIntArray(UInt8, 2).deserialize(b'\x02\x00')
+
+class Test_DigestArray(unittest.TestCase):
+    def test_check_instance(self):
+        with self.assertRaises(SerializerTypeError):
+            DigestArray(2).check_instance([b'\x00'*32])
+        with self.assertRaises(SerializerTypeError):
+            DigestArray(2).check_instance(('',))
+
+        with self.assertRaises(SerializerValueError):
+            DigestArray(1).check_instance((b'\x00'*32, b'\x00'*32))
+        with self.assertRaises(SerializerValueError):
+            DigestArray(1).check_instance((b'\x00'*31,))
+
+        DigestArray(2).check_instance(())
+        DigestArray(2).check_instance((b'\x00'*32, b'\xff'*32))
+
+    def test_serialization(self):
+        cls = DigestArray(1000)
+        for n in (0, 1, 2, 1000):
+            value = tuple(hashlib.sha256(bytes([i % 256])).digest() for i in range(n))
+
+            serialized = cls.serialize(value)
+            self.assertEqual(serialized, UInt64.serialize(n) + b''.join(value))
+            self.assertEqual(cls.serialized_size(value), len(serialized))
+            self.assertEqual(cls.deserialize(serialized), value)
+
+    def test_invalid_deserialization(self):
+        with self.assertRaises(DeserializationError):
+            DigestArray(1).deserialize(b'\x02' + b'\x00'*64)
+        with self.assertRaises(TruncationError):
+            DigestArray(2).deserialize(b'\x02' + b'\x00'*63)
+
+class Test_varuints(unittest.TestCase):
+    def check_encode_decode(self):
+        def T(values):
+            expected = b''.join(encode_varuint(v) for v in values)
+            self.assertEqual(encode_varuints(values), expected)
+            self.assertEqual(encode_varuints(iter(values)), expected)
+            self.assertEqual(encode_varuints(v for v in values), expected)
+
+            buf = b'junk' + expected + b'junk'
+            self.assertEqual(decode_varuints(buf, 4, len(buf), len(values)),
+                             (list(values), 4 + len(expected)))
+
+        T(())
+        T((0,))
+        T((127, 128, 2**64-1))
+        for n in (NUMPY_MIN_VARUINTS - 1, NUMPY_MIN_VARUINTS, 1000):
+            T(tuple(range(n)))
+            T(tuple((2**(i % 65) - 1) for i in range(n)))
+            T(tuple((2**(i % 65)) for i in range(n)))
+
+            # larger than 64 bits
+            T(tuple(range(n)) + (2**64,))
+            T(tuple(range(n)) + (2**100,))
+
+    def test_encode_decode(self):
+        """encode_varuints() and decode_varuints() match the scalar versions"""
+        self.check_encode_decode()
+
+    def test_without_numpy(self):
+        """The pure Python versions are used when numpy is missing"""
+        with unittest.mock.patch.object(proofmarshal.serialize, 'numpy', None), \
+             unittest.mock.patch.object(proofmarshal.serialize, '_encode_varuints_numpy') as encode_numpy, \
+             unittest.mock.patch.object(proofmarshal.serialize, '_decode_varuints_numpy') as decode_numpy:
+            self.check_encode_decode()
+
+        encode_numpy.assert_not_called()
+        decode_numpy.assert_not_called()
+
+    @unittest.skipIf(proofmarshal.serialize.numpy is None, 'numpy not installed')
+    def test_with_numpy(self):
+        """The numpy versions are used, when available, even for few values"""
+        with unittest.mock.patch.object(proofmarshal.serialize, 'NUMPY_MIN_VARUINTS', 1), \
+             unittest.mock.patch.object(proofmarshal.serialize, '_encode_varuints_numpy',
+                                        wraps=proofmarshal.serialize._encode_varuints_numpy) as encode_numpy, \
+             unittest.mock.patch.object(proofmarshal.serialize, '_decode_varuints_numpy',
+                                        wraps=proofmarshal.serialize._decode_varuints_numpy) as decode_numpy:
+            self.check_encode_decode()
+
+        self.assertTrue(encode_numpy.called)
+        self.assertTrue(decode_numpy.called)
+
+    def test_encode_negative(self):
+        for n in (1, NUMPY_MIN_VARUINTS):
+            with self.assertRaises(SerializerValueError):
+                encode_varuints((0,)*n + (-1,))
+
+    def test_encode_non_integer(self):
+        """Non-integers are rejected, even by numpy"""
+        for n in (1, NUMPY_MIN_VARUINTS):
+            with self.assertRaises(TypeError):
+                encode_varuints((0,)*n + (1.7,))
+            with self.assertRaises(TypeError):
+                encode_varuints((0,)*n + (200.5,))
+
+    def test_decode_truncated(self):
+        for n in (1, NUMPY_MIN_VARUINTS, 1000):
+            buf = encode_varuints(tuple(range(n)))
+            with self.assertRaises(TruncationError):
+                decode_varuints(buf, 0, len(buf), n + 1)
+
+            # end is respected
+            with self.assertRaises(TruncationError):
+                decode_varuints(buf, 0, len(buf) - 1, n)
+
+        with self.assertRaises(TruncationError):
+            decode_varuints(b'\x00'*100 + b'\x80', 0, 101, 101)
+
+    def test_ctx(self):
+        """Context write_varuints() and read_varuints()"""
+        values = tuple(range(0, 2**20, 997))
+
+        ctx = BytesSerializationContext()
+        ctx.write_varuints(values)
+        serialized = ctx.getbytes()
+        self.assertEqual(serialized, b''.join(encode_varuint(v) for v in values))
+
+        ctx = BytesDeserializationContext(serialized)
+        self.assertEqual(ctx.read_varuints(len(values)), list(values))
+        self.assertTrue(ctx.at_end())
+
+        ctx = BufferedStreamDeserializationContext(io.BytesIO(serialized), buffer_size=16)
+        self.assertEqual(ctx.read_varuints(len(values)), list(values))
+        self.assertTrue(ctx.at_end())
+
+    def test_ctx_truncated(self):
+        """Truncation is reported through the context"""
+        class TruncationRecordingContext(BytesDeserializationContext):
+            needed = None
+            def _truncated(self, l):
+                self.needed = l
+                super()._truncated(l)
+
+        for n in (10, 1000):
+            values = tuple(range(n))
+            serialized = b''.join(encode_varuint(v) for v in values)
+
+            ctx = TruncationRecordingContext(b'junk' + serialized[:-10], 4)
+            with self.assertRaises(TruncationError):
+                ctx.read_varuints(n)
+            self.assertEqual(ctx.offset, 4)
+
+            # At least a byte for each integer not read
+            self.assertGreaterEqual(ctx.needed, len(serialized) - 10 + 1)
+            self.assertLessEqual(ctx.needed, len(serialized))
+
+class Test_BytesDeserializationContext(unittest.TestCase):
+    def test_buffer_types(self):
+        """Deserialization from bytes-like objects"""
+        import mmap
+
+        serialized = b'\x00\x80\x01\x03abc\xff'
+        def T(buf):
+            ctx = BytesDeserializationContext(buf)
+            self.assertEqual(ctx.read_varuint(), 0)
+            self.assertEqual(ctx.read_varuint(), 128)
+            r = ctx.read_bytes()
+            self.assertIs(r.__class__, bytes)
+            self.assertEqual(r, b'abc')
+            self.assertIs(ctx.read_bool(), True)
+            self.assertEqual(ctx.offset, len(serialized))
+
+        T(serialized)
+        T(bytearray(serialized))
+        T(memoryview(serialized))
+
+        m = mmap.mmap(-1, len(serialized))
+        m.write(serialized)
+        T(m)
+
+    def test_offset(self):
+        """Deserialization starting at an offset"""
+        ctx = BytesDeserializationContext(b'junk\x03abc', 4)
+        self.assertEqual(VarBytes(3).ctx_deserialize(ctx), b'abc')
+        self.assertEqual(ctx.offset, 8)
+
+        with self.assertRaises(ValueError):
+            BytesDeserializationContext(b'', 1)
+
+    def test_truncation(self):
+        """Truncated data raises TruncationError"""
+        with self.assertRaises(TruncationError):
+            BytesDeserializationContext(b'').read_bool()
+        with self.assertRaises(TruncationError):
+            BytesDeserializationContext(b'\x80\x80').read_varuint()
+        with self.assertRaises(TruncationError):
+            BytesDeserializationContext(memoryview(b'ab')).read_bytes(3)
+
+    def test_junk_at_end(self):
+        """Serializer.deserialize() rejects junk at the end"""
+        with self.assertRaises(DeserializationError):
+            SerBool.deserialize(b'\xff\x00')
+        with self.assertRaises(DeserializationError):
+            VarBytes(3).deserialize(b'\x01ab')
+
+class Test_BytesSerializationContext(unittest.TestCase):
+    def test_varuint(self):
+        """Varuint encoding"""
+        def T(value, expected):
+            ctx = BytesSerializationContext()
+            ctx.write_varuint(value)
+            self.assertEqual(ctx.getbytes(), expected)
+            self.assertEqual(encode_varuint(value), expected)
+            self.assertEqual(BytesDeserializationContext(expected).read_varuint(), value)
+
+        T(0, b'\x00')
+        T(1, b'\x01')
+        T(0x7f, b'\x7f')
+        T(0x80, b'\x80\x01')
+        T(0x3fff, b'\xff\x7f')
+        T(0x4000, b'\x80\x80\x01')
+        T(2**64-1, b'\xff'*9 + b'\x01')
+
+        with self.assertRaises(SerializerValueError):
+            encode_varuint(-1)
+
+    def test_size_hint(self):
+        """Preallocated buffers only return what was written"""
+        for size_hint in (0, 2, 4, 100):
+            ctx = BytesSerializationContext(size_hint)
+            ctx.write_varuint(300)
+            ctx.write_bytes(b'ab')
+            ctx.write_bool(False)
+            self.assertEqual(ctx.getbytes(), b'\xac\x02ab\x00')
+
+            with ctx.getbuffer() as buf:
+                self.assertEqual(buf, b'\xac\x02ab\x00')
+
+class Test_SegmentedSerializationContext(unittest.TestCase):
+    def test_segments(self):
+        big = b'x'*1000
+        ctx = SegmentedSerializationContext(min_segment_size=100)
+        ctx.write_bool(True)
+        ctx.write_varuint(300)
+        ctx.write_bytes(b'abc')
+        ctx.write_bytes(big)
+        ctx.write_bytes(big)
+        ctx.write_bytes(b'def')
+
+        segments = ctx.getsegments()
+        self.assertEqual(len(segments), 4)
+        self.assertEqual(segments[0], b'\xff\xac\x02abc')
+
+        # Large buffers are passed by reference
+        self.assertIs(segments[1], big)
+        self.assertIs(segments[2], big)
+        self.assertEqual(segments[3], b'def')
+
+        self.assertEqual(ctx.offset, sum(len(s) for s in segments))
+
+        # Writes after getsegments() add new segments
+        ctx.write_bytes(b'ghi')
+        self.assertEqual(ctx.getsegments()[4:], [b'ghi'])
+
+    def test_serialize_segments(self):
+        cls = VarBytes(10000)
+        for l in (0, 10, 511, 512, 10000):
+            value = b'x'*l
+            segments = cls.serialize_segments(value)
+            self.assertEqual(b''.join(segments), cls.serialize(value))
+
+class Test_HashingSerializationContext(unittest.TestCase):
+    def test_hashing(self):
+        """Hashing matches hashing the serialized bytes"""
+        ctx = BytesSerializationContext()
+        hasher = hashlib.sha256()
+        hashing_ctx = HashingSerializationContext(hasher)
+
+        for c in (ctx, hashing_ctx):
+            c.write_bool(True)
+            c.write_varuint(2**32)
+            c.write_bytes(b'abc')
+            c.write_obj(b'def', VarBytes(3))
+
+        self.assertEqual(hasher.digest(), hashlib.sha256(ctx.getbytes()).digest())
+
+class Test_BufferedStreamDeserializationContext(unittest.TestCase):
+    def test_deserialization(self):
+        """Deserialization across buffer refills"""
+        import io
+
+        class CountingBytesIO(io.BytesIO):
+            reads = 0
+            def readinto(self, b):
+                self.reads += 1
+                return super().readinto(b)
+
+        serialized = b'\x00\x80\x01\x03abc\xff' + b'\x81\x80\x80\x80\x01' + b'\x05' + b'x'*5
+        for buffer_size in (1, 2, 3, 4, 7, 8, 100):
+            fd = CountingBytesIO(serialized)
+            ctx = BufferedStreamDeserializationContext(fd, buffer_size)
+            self.assertEqual(ctx.read_varuint(), 0)
+            self.assertEqual(ctx.read_varuint(), 128)
+            self.assertEqual(ctx.read_bytes(), b'abc')
+            self.assertIs(ctx.read_bool(), True)
+            self.assertEqual(ctx.read_varuint(), 2**28 + 1)
+            self.assertEqual(VarBytes(5).ctx_deserialize(ctx), b'x'*5)
+            self.assertEqual(ctx.offset, len(serialized))
+
+            if buffer_size == 100:
+                self.assertEqual(fd.reads, 1)
+
+    def test_truncation(self):
+        """Truncated streams raise TruncationError"""
+        import io
+
+        def T(serialized, f):
+            for buffer_size in (1, 2, 100):
+                ctx = BufferedStreamDeserializationContext(io.BytesIO(serialized), buffer_size)
+                with self.assertRaises(TruncationError):
+                    f(ctx)
+
+        T(b'', lambda ctx: ctx.read_bool())
+        T(b'\x80', lambda ctx: ctx.read_varuint())
+        T(b'\x03ab', lambda ctx: ctx.read_bytes())
+
+class Test_HashTag(unittest.TestCase):
+    def test_digest(self):
+        """HashTag.digest()"""
+        tag = HashTag('19e5278a-76cc-479c-8713-e7648636979c')
+
+        self.assertEqual(tag.digest(), hashlib.sha256(tag).digest())
+        self.assertEqual(tag.digest(b'abc'), tag(b'abc').digest())
+
+        for msg in (b'', b'a', b'b'*32, b'c'*100):
+            self.assertEqual(tag.digest(msg), tag(msg).digest())
+
+    def test_hash_function(self):
+        """HashTag families with other hash functions"""
+        for tag_class, hash_function in ((Blake2bHashTag, hashlib.blake2b),
+                                         (Blake2sHashTag, hashlib.blake2s)):
+            tag = tag_class('19e5278a-76cc-479c-8713-e7648636979c')
+            self.assertEqual(tag, HashTag('19e5278a-76cc-479c-8713-e7648636979c'))
+
+            expected = hash_function(tag + b'abc', digest_size=32).digest()
+            self.assertEqual(tag.digest(b'abc'), expected)
+            self.assertEqual(tag(b'abc').digest(), expected)
+            self.assertEqual(len(expected), tag.DIGEST_LENGTH)
+
+            # Derived tags use the hash function of the tag derived from,
+            # unless another is chosen
+            sha256_tag = HashTag('a5516ff0-99a7-4a00-b918-8d30ea6f25b1')
+            self.assertIs(sha256_tag.derive(tag).__class__, HashTag)
+            self.assertIs(tag.derive(b'foo').__class__, tag_class)
+            self.assertIs(tag.derive(sha256_tag).__class__, tag_class)
+            self.assertIs(sha256_tag.derive(tag, tag_class).__class__, tag_class)
+            self.assertEqual(sha256_tag.derive(tag, tag_class), sha256_tag.derive(tag))
+
+            # Derivation itself doesn't depend on the hash function
+            self.assertEqual(sha256_tag.derive(tag), sha256_tag.derive(HashTag(str(tag))))
+
+class Test_serialized_size(unittest.TestCase):
+    def test_serialized_size(self):
+        """serialized_size() matches the actual serialized length"""
+        def T(ser_cls, value):
+            self.assertEqual(ser_cls.serialized_size(value), len(ser_cls.serialize(value)))
+
+        T(SerBool, True)
+        T(FixedBytes(0), b'')
+        T(FixedBytes(3), b'abc')
+        T(Digest, b'\x00'*32)
+        for l in (0, 1, 127, 128, 300):
+            T(VarBytes(1000), b'x'*l)
+        for i in (0, 1, 127, 128, 2**14-1, 2**14, 2**64-1):
+            T(UInt64, i)
+        for i in (0, 255):
+            T(UInt8, i)
+
+        self.assertEqual(varuint_size(0), 1)
+        self.assertEqual(varuint_size(2**64-1), 10)
+
+class Test_serialize_many(unittest.TestCase):
+    def test_serialize_many(self):
+        """serialize_many() and deserialize_many()"""
+        import io
+
+        values = [0, 1, 2**7, 2**64-1]
+        serialized = UInt64.serialize_many(values)
+        self.assertEqual(serialized, b'\x01\x00' b'\x01\x01' b'\x02\x80\x01' b'\x0a' + b'\xff'*9 + b'\x01')
+
+        self.assertEqual(list(UInt64.deserialize_many(serialized)), values)
+        self.assertEqual(list(UInt64.deserialize_many(memoryview(serialized))), values)
+        self.assertEqual(list(UInt64.deserialize_many(io.BytesIO(serialized))), values)
+
+        self.assertEqual(UInt64.serialize_many([]), b'')
+        self.assertEqual(list(UInt64.deserialize_many(b'')), [])
+
+        values = [b'x'*i for i in range(100)]
+        fd = io.BytesIO()
+        VarBytes(100).serialize_many(values, fd, flush_size=10)
+        self.assertEqual(fd.getvalue(), VarBytes(100).serialize_many(values))
+        self.assertEqual(list(VarBytes(100).deserialize_many(io.BytesIO(fd.getvalue()))), values)
+
+    def test_invalid(self):
+        """Invalid record streams"""
+        # Length doesn't match the record
+        with self.assertRaises(DeserializationError):
+            list(UInt64.deserialize_many(b'\x02\x00'))
+
+        # Truncated record
+        with self.assertRaises(TruncationError):
+            list(VarBytes(10).deserialize_many(b'\x04\x03ab'))
+
+class Test_PushDeserializer(unittest.TestCase):
+    def test_push(self):
+        """Values are returned as soon as they're complete"""
+        p = PushDeserializer(VarBytes(100))
+        self.assertEqual(p.feed(b''), [])
+        self.assertEqual(p.feed(b'\x03a'), [])
+        self.assertEqual(p.feed(b'b'), [])
+        self.assertEqual(p.feed(b'c\x00\x01'), [b'abc', b''])
+        self.assertEqual(p.feed(b'x\x02yz'), [b'x', b'yz'])
+        p.close()
+
+    def test_chunk_sizes(self):
+        values = [b'x'*i for i in range(100)]
+        for records in (False, True):
+            if records:
+                serialized = VarBytes(100).serialize_many(values)
+            else:
+                serialized = b''.join(VarBytes(100).serialize(v) for v in values)
+
+            for chunk_size in (1, 2, 3, 50, len(serialized)):
+                p = PushDeserializer(VarBytes(100), records=records)
+                r = []
+                for i in range(0, len(serialized), chunk_size):
+                    r.extend(p.feed(serialized[i:i + chunk_size]))
+                p.close()
+                self.assertEqual(r, values)
+
+    def test_uint_array_work(self):
+        """Partial arrays aren't decoded again for every chunk"""
+        cls = UIntArray(UInt64, 100000)
+        values = tuple(range(0, 2**40, 2**40 // 10000))
+        serialized = cls.serialize(values)
+
+        attempts = []
+        orig_ctx_deserialize = cls.ctx_deserialize
+        def counting_ctx_deserialize(ctx):
+            attempts.append(ctx.end)
+            return orig_ctx_deserialize(ctx)
+
+        p = PushDeserializer(cls)
+        r = []
+        with unittest.mock.patch.object(cls, 'ctx_deserialize', counting_ctx_deserialize):
+            n = 0
+            for i in range(0, len(serialized), 64):
+                r.extend(p.feed(serialized[i:i + 64]))
+                n += 1
+        p.close()
+        self.assertEqual(r, [values])
+
+        # A truncated array says how many more bytes it needs at least, so
+        # decoding isn't retried until they've arrived.
+        self.assertLess(len(attempts), n // 10)
+
+    def test_truncated(self):
+        for records in (False, True):
+            p = PushDeserializer(UInt64, records=records)
+            p.feed(b'\x02\x80' if records else b'\x80')
+            with self.assertRaises(TruncationError):
+                p.close()
+
+    def test_invalid(self):
+        p = PushDeserializer(SerBool)
+        with self.assertRaises(DeserializationError):
+            p.feed(b'\x01')
+
+        # Length doesn't match the record
+        p = PushDeserializer(UInt64, records=True)
+        with self.assertRaises(DeserializationError):
+            p.feed(b'\x02\x00\x00')
+
+        # Record too short for its contents
+        p = PushDeserializer(VarBytes(10), records=True)
+        with self.assertRaises(DeserializationError):
+            p.feed(b'\x02\x03a')
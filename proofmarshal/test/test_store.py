@@ -0,0 +1,193 @@
+# Copyright (C) 2015 Peter Todd <pete@petertodd.org>
+#
+# This file is part of python-proofmarshal.
+#
+# It is subject to the license terms in the LICENSE file found in the top-level
+# directory of this distribution.
+#
+# No part of python-proofmarshal, including this file, may be copied, modified,
+# propagated, or distributed except according to the terms contained in the
+# LICENSE file.
+
+import binascii
+import unittest
+
+from proofmarshal.serialize import DeserializationError
+from proofmarshal.store import MemoryProofStore, SQLiteProofStore, encode_record
+from proofmarshal.test import temp_path
+from proofmarshal.test.test_merbinnertree import IntMBTree
+from proofmarshal.test.test_mmr import IntMMR
+from proofmarshal.test.test_proof import BarProof, FooProof, Blake2VarProof, InnerBlake2VarProof, LeafBlake2VarProof
+
+class CountingProofStore(MemoryProofStore):
+    """Memory store that counts the records read"""
+    def __init__(self):
+        super().__init__()
+        self.reads = 0
+
+    def get_record(self, proof_hash):
+        self.reads += 1
+        return super().get_record(proof_hash)
+
+class Test_MemoryProofStore(unittest.TestCase):
+    def make_store(self):
+        return MemoryProofStore()
+
+    def test_commit_load(self):
+        """Committed proofs can be loaded"""
+        with self.make_store() as store:
+            b = BarProof(left=FooProof(n=1), right=FooProof(n=2), nonproof_attr=3)
+            self.assertEqual(store.commit(b), b.hash)
+            self.assertEqual(len(store), 3)
+            self.assertEqual(set(store), {b.hash, b.left.hash, b.right.hash})
+
+            b2 = store.load(BarProof, b.hash)
+            self.assertEqual(b2.sum(), 3)
+            self.assertEqual(b2.nonproof_attr, 3)
+            self.assertEqual(b2.data_hash, b.data_hash)
+            self.assertEqual(b2.serialize(), b.serialize())
+
+            with self.assertRaises(KeyError):
+                store.load(BarProof, b'\x00'*32)
+
+    def test_varproof(self):
+        """VarProof nodes, including those with other hash functions"""
+        with self.make_store() as store:
+            v = InnerBlake2VarProof(left=LeafBlake2VarProof(value=1), right=LeafBlake2VarProof(value=2))
+            store.commit(v)
+
+            v2 = store.load(Blake2VarProof, v.hash)
+            self.assertIs(v2.__class__, InnerBlake2VarProof)
+            self.assertIs(v2.right.__class__, LeafBlake2VarProof)
+            self.assertEqual(v2.right.value, 2)
+            self.assertEqual(v2.data_hash, v.data_hash)
+
+    def test_mmr(self):
+        with self.make_store() as store:
+            for i in range(20):
+                m = IntMMR(range(i))
+                store.commit(m)
+
+                m2 = store.load(IntMMR, m.hash)
+                self.assertEqual(list(m2), list(m))
+                self.assertEqual(m2.data_hash, m.data_hash)
+
+    def test_merbinnertree(self):
+        with self.make_store() as store:
+            m = IntMBTree()
+            for i in range(64):
+                m = m.put(bytes([i*4])*32, i)
+            store.commit(m)
+
+            m2 = store.load(IntMBTree, m.hash)
+            self.assertEqual(m2[bytes([20])*32], 5)
+            self.assertEqual(list(m2.items()), list(m.items()))
+
+            # Modify the loaded tree and commit it again
+            m3 = m2.put(b'\x01'*32, 100)
+            store.commit(m3)
+            m4 = store.load(IntMBTree, m3.hash)
+            self.assertEqual(m4[b'\x01'*32], 100)
+            self.assertEqual(list(m4.items()), list(m3.items()))
+
+    def test_lazy(self):
+        """Only the nodes used are loaded"""
+        store = CountingProofStore()
+
+        m = IntMBTree()
+        for i in range(64):
+            m = m.put(bytes([i*4])*32, i)
+        store.commit(m)
+        n = len(store)
+
+        m2 = store.load(IntMBTree, m.hash)
+        self.assertEqual(store.reads, 1)
+        self.assertEqual(m2[bytes([20])*32], 5)
+        self.assertLess(store.reads, 16)
+
+        # Committing a new version only writes the new nodes, without loading
+        # the unchanged ones.
+        m3 = m2.put(b'\x01'*32, 100)
+        reads = store.reads
+        store.commit(m3)
+        self.assertEqual(store.reads, reads)
+        self.assertLess(len(store) - n, 16)
+
+    def test_pruned(self):
+        """Pruned proofs are committed in full"""
+        with self.make_store() as store:
+            b = BarProof(left=FooProof(n=1), right=FooProof(n=2), nonproof_attr=3)
+            store.commit(b.prune())
+            self.assertEqual(store.load(BarProof, b.hash).sum(), 3)
+
+    def test_fully_pruned(self):
+        """Fully pruned parts of a proof must already be in the store"""
+        with self.make_store() as store:
+            f = FooProof(n=1)
+            pruned_f = FooProof.deserialize(f.prune().serialize())
+            self.assertTrue(pruned_f.is_fully_pruned)
+            b = BarProof(left=pruned_f, right=FooProof(n=2), nonproof_attr=3)
+
+            with self.assertRaises(ValueError) as cm:
+                store.commit(b)
+            self.assertIn(binascii.hexlify(f.hash).decode('utf8'), str(cm.exception))
+            self.assertEqual(len(store), 0)
+
+            store.commit(f)
+            store.commit(b)
+            self.assertEqual(store.load(BarProof, b.hash).sum(), 3)
+
+    def test_corrupt(self):
+        with self.make_store() as store:
+            f = FooProof(n=1)
+            store._put_records([(f.hash, encode_record(f) + b'\x00')])
+            with self.assertRaises(DeserializationError):
+                store.load(FooProof, f.hash).n
+
+    def test_serials(self):
+        """Serial numbers are never reused, even after the newest nodes are deleted"""
+        with self.make_store() as store:
+            self.assertEqual(store.watermark(), 0)
+
+            a = IntMBTree().put(b'\x00'*32, 0)
+            store.commit(a)
+            b = a.put(b'\x01'*32, 1)
+            store.commit(b)
+            watermark = store.watermark()
+            rows = store._serials(0, watermark)
+            self.assertEqual([serial for serial, proof_hash in rows], sorted(store._serial(h) for h in store))
+            self.assertEqual(rows[-1], (watermark, b.hash))
+
+            # Delete the nodes added by b
+            newest = [proof_hash for serial, proof_hash in rows if serial > store._serial(a.hash)]
+            store._delete(newest)
+            self.assertEqual(store.watermark(), watermark)
+
+            c = a.put(b'\x02'*32, 2)
+            store.commit(c)
+            self.assertGreater(store._serial(c.hash), watermark)
+            self.assertEqual(store._serials(0, watermark), rows[:-len(newest)])
+
+            # Deleted nodes added again get new serial numbers
+            store.commit(b)
+            rows2 = store._serials(0, store.watermark())
+            self.assertEqual(len(rows2), len(store))
+            self.assertEqual(rows2[-1], (store._serial(b.hash), b.hash))
+            self.assertEqual(store._serials(watermark, store.watermark()), rows2[len(rows) - len(newest):])
+            self.assertEqual(store._serials(watermark, store.watermark(), 2), rows2[len(rows) - len(newest):][:2])
+
+class Test_SQLiteProofStore(Test_MemoryProofStore):
+    def setUp(self):
+        self.path = temp_path(self)
+
+    def make_store(self):
+        return SQLiteProofStore(self.path)
+
+    def test_reopen(self):
+        m = IntMMR(range(10))
+        with self.make_store() as store:
+            store.commit(m)
+
+        with self.make_store() as store:
+            self.assertEqual(len(store), len(set(store)))
+            self.assertEqual(list(store.load(IntMMR, m.hash)), list(m))